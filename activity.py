@@ -0,0 +1,136 @@
+import numpy as np
+import logging
+
+# --- 既定の判定パラメータ ---
+MARGIN_DB = 10.0            # ノイズフロアより何dB大きければ「有音」とみなすか
+MIN_LEVEL_DB = -60.0        # ノイズフロアに関係なく、これ以下は常に無音とみなす
+MIN_ACTIVE_RATIO = 0.05     # 有音ブロックの割合がこれ未満のウィンドウは破棄する
+NOISE_PERCENTILE = 20       # ウィンドウ内のノイズフロア推定に使うパーセンタイル
+NOISE_RISE_RATE = 0.1       # ノイズフロアが上がる方向の追従率（下がる方向は即時追従）
+TRIM_PADDING_SECONDS = 1.0  # 有音区間の前後に残す余白
+
+INT16_FULL_SCALE = 32768.0
+
+class LevelMonitor:
+    """
+    録音コールバックから渡されるブロックごとにRMSを計算し、
+    ウィンドウ単位で有音/無音を判定する。
+
+    ノイズフロアはウィンドウをまたいで保持し、設置場所ごとの環境音に適応させる。
+    """
+    def __init__(self, channels, rate, margin_db=MARGIN_DB, min_level_db=MIN_LEVEL_DB,
+                 min_active_ratio=MIN_ACTIVE_RATIO, trim=True, padding_seconds=TRIM_PADDING_SECONDS):
+        self.channels = channels
+        self.rate = rate
+        self.margin_db = margin_db
+        self.min_level_db = min_level_db
+        self.min_active_ratio = min_active_ratio
+        self.trim = trim
+        self.padding_seconds = padding_seconds
+
+        self.noise_floor_db = None
+        self.last_stats = None
+        self._levels = []
+        self._block_frames = []
+
+    def feed(self, in_data: bytes):
+        """【コールバック内で実行】int16 のブロックのRMS[dBFS]を記録する"""
+        x = np.frombuffer(in_data, dtype=np.int16).astype(np.float32)
+        if len(x) == 0:
+            return
+        mean_square = float(np.dot(x, x)) / len(x)
+        self._levels.append(10.0 * np.log10(mean_square / (INT16_FULL_SCALE ** 2) + 1e-12))
+        self._block_frames.append(len(x) // self.channels)
+
+    def discard_window(self):
+        """中断されたウィンドウの統計を捨てる（ノイズフロアは更新しない）"""
+        self._levels = []
+        self._block_frames = []
+
+    def detach_window(self):
+        """
+        現在のウィンドウのブロック統計を取り出して新しいウィンドウを始める。
+        コールバック内でウィンドウを切り替える場合に使い、判定は evaluate() で後から行う。
+        """
+        levels, block_frames = self._levels, self._block_frames
+        self._levels = []
+        self._block_frames = []
+        return levels, block_frames
+
+    def finish_window(self) -> dict:
+        """現在のウィンドウを締めて判定結果を返す（evaluate() を参照）"""
+        return self.evaluate(*self.detach_window())
+
+    def evaluate(self, levels, block_frames) -> dict:
+        """
+        ウィンドウのブロック統計から有音/無音を判定し、ノイズフロアを更新する。
+
+        :return: keep（送信するか）, active_ratio, noise_floor_db, threshold_db,
+                 rms_db, peak_db, span（残すブロック範囲 [start, end)）などを含む dict
+        """
+        levels = np.asarray(levels, dtype=np.float64)
+        block_frames = np.asarray(block_frames, dtype=np.int64)
+
+        if len(levels) == 0:
+            self.last_stats = {"keep": False, "blocks": 0, "active_ratio": 0.0,
+                               "noise_floor_db": self.noise_floor_db, "threshold_db": None,
+                               "rms_db": None, "peak_db": None, "span": (0, 0), "frame_span": (0, 0),
+                               "seconds": 0.0}
+            logging.info("音量判定: ブロックが無いためウィンドウを破棄します。")
+            return self.last_stats
+
+        window_floor = float(np.percentile(levels, NOISE_PERCENTILE))
+        floor = window_floor if self.noise_floor_db is None else self.noise_floor_db
+        threshold = max(floor + self.margin_db, self.min_level_db)
+
+        active = levels > threshold
+        active_ratio = float(np.mean(active))
+        keep = active_ratio >= self.min_active_ratio
+
+        # 有音区間（前後に余白を付ける）だけを残す
+        span = (0, len(levels)) if keep else (0, 0)
+        if keep and self.trim:
+            active_index = np.flatnonzero(active)
+            mean_block = max(float(np.mean(block_frames)), 1.0)
+            pad = int(np.ceil(self.padding_seconds * self.rate / mean_block))
+            span = (max(int(active_index[0]) - pad, 0), min(int(active_index[-1]) + 1 + pad, len(levels)))
+
+        # ノイズフロアの更新: 下がる方向はすぐ追従し、上がる方向はゆっくり追従する
+        if self.noise_floor_db is None or window_floor < self.noise_floor_db:
+            self.noise_floor_db = window_floor
+        else:
+            self.noise_floor_db += NOISE_RISE_RATE * (window_floor - self.noise_floor_db)
+
+        # 全体のRMSは平均パワーから求める
+        power = np.power(10.0, levels / 10.0)
+        rms_db = float(10.0 * np.log10(np.average(power, weights=block_frames) + 1e-12))
+
+        frame_offsets = np.concatenate([[0], np.cumsum(block_frames)])
+        self.last_stats = {
+            "keep": keep,
+            "blocks": int(len(levels)),
+            "active_ratio": active_ratio,
+            "noise_floor_db": self.noise_floor_db,
+            "threshold_db": threshold,
+            "rms_db": rms_db,
+            "peak_db": float(np.max(levels)),
+            "span": span,
+            "frame_span": (int(frame_offsets[span[0]]), int(frame_offsets[span[1]])),
+            "seconds": float(np.sum(block_frames[span[0]:span[1]])) / self.rate,
+        }
+        logging.info(
+            f"音量判定: {'送信' if keep else '破棄'} active_ratio={active_ratio:.3f} "
+            f"rms={rms_db:.1f}dB peak={self.last_stats['peak_db']:.1f}dB "
+            f"floor={self.noise_floor_db:.1f}dB threshold={threshold:.1f}dB "
+            f"残す長さ={self.last_stats['seconds']:.1f}s")
+        return self.last_stats
+
+    def trim_frames(self, frames: list, stats: dict) -> list:
+        """feed() に渡したブロックの並びと同じ frames から、判定で残す範囲を切り出す"""
+        start, end = stats["span"]
+        return frames[start:end]
+
+    def trim_bytes(self, data, stats: dict, frame_bytes: int):
+        """連続した PCM バッファから、判定で残す範囲を切り出す"""
+        start, end = stats["frame_span"]
+        return data[start * frame_bytes:end * frame_bytes]
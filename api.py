@@ -2,47 +2,59 @@ import requests
 import base64
 import json
 import logging
+import os
 
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import offload
+from spool import PermanentUploadError
 
 BASE_PATH = "http://192.168.111.236:8000"
+UPLOAD_CONNECT_TIMEOUT = 3
+UPLOAD_READ_TIMEOUT = 10
+RETRYABLE_STATUS = (408, 429)   # 4xx でも送り直せば成功しうる応答
 
-def post_data(mp3_path, bme280_data, tsl2572_data) -> dict[str, str] | None:
-    print("* posting data...")
-    url = f"{BASE_PATH}/api/v1/data"
-
-    try:
-        with open(mp3_path, "rb") as f:
-            audio_data = base64.b64encode(f.read()).decode("utf-8")
-    except FileNotFoundError:
-        logging.error(f"音声ファイルが見つかりません: {mp3_path}")
-        return None
-
+def build_payload(audio_bytes: bytes, bme280_data, tsl2572_data) -> dict:
+    """/api/v1/data に送るリクエストボディを作る"""
     environmental_data = {
         "temperature": bme280_data["temperature"],
         "pressure": bme280_data["pressure"],
         "humidity": bme280_data["humidity"],
         "lux": tsl2572_data["lux"]
     }
-
-    payload = {
-        "audio_data": audio_data,
+    return {
+        "audio_data": base64.b64encode(audio_bytes).decode("utf-8"),
         "environmental_data": environmental_data
     }
 
+def post_data(mp3_path, bme280_data, tsl2572_data) -> dict[str, str] | None:
+    """
+    :return: 応答の JSON。送り直せば成功しうる失敗（接続できない・5xx など）は None
+    :raises PermanentUploadError: 送り直しても成功しない失敗（音声ファイルが無い・4xx の応答）
+    """
+    logging.debug("データを送信します...")
+    url = f"{BASE_PATH}/api/v1/data"
+    if not os.path.exists(mp3_path):
+        raise PermanentUploadError(f"音声ファイルが見つかりません: {mp3_path}")
+
+    # base64 と JSON への変換はワーカープロセスで行う
+    body = offload.build_body(mp3_path, bme280_data, tsl2572_data)
+    if body is None:
+        return None
+
     headers = {"Content-Type": "application/json"}
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        response = requests.post(url, data=body, headers=headers, timeout=(UPLOAD_CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT))
         response.raise_for_status()  # ステータスコードが200番台でない場合に例外を発生させる
 
-        print("POST status:", response.status_code)
-        print("bme280:", bme280_data)
-        print("tsl2572:", tsl2572_data)
-        print("* post done")
+        logging.debug(f"送信完了: status={response.status_code} bme280={bme280_data} tsl2572={tsl2572_data}")
 
         return response.json()
+    except requests.exceptions.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if status is not None and 400 <= status < 500 and status not in RETRYABLE_STATUS:
+            raise PermanentUploadError(f"サーバーが受け付けませんでした: {e}") from e
+        logging.error(f"APIへのデータ送信に失敗しました: {e}")
+        return None
     except requests.exceptions.RequestException as e:
         logging.error(f"APIへのデータ送信に失敗しました: {e}")
         return None
@@ -64,6 +76,87 @@ def get_task(task_id: str) -> dict[str, any] | None:
         logging.error(f"レスポンスJSONのデコードに失敗しました: {e}")
         return None
 
+def get_task_status(task_id: str, timeout=10) -> dict[str, any] | None:
+    """
+    結果の音声 (result) を含まない、ステータスのみのレスポンスを取得する。
+    バックエンドが include_result を解釈しない場合でも、result は取り除いて返す。
+    """
+    url = f"{BASE_PATH}/api/v1/status/{task_id}"
+    try:
+        response = requests.get(url, params={"include_result": "false"}, timeout=timeout)
+        response.raise_for_status()
+        task_info = response.json()
+        if isinstance(task_info, dict):
+            task_info.pop("result", None)
+        return task_info
+    except requests.exceptions.RequestException as e:
+        logging.error(f"タスクステータスの取得に失敗しました: {e}")
+        return None
+    except json.JSONDecodeError as e:
+        logging.error(f"レスポンスJSONのデコードに失敗しました: {e}")
+        return None
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def download_task_result(task_id: str, dest_path: str, deadline=None) -> bool:
+    """
+    タスクの結果の音声をストリーミングで dest_path に保存する。
+
+    途中まで保存された dest_path + ".part" がある場合は Range ヘッダーで続きから再開する。
+    結果用のエンドポイントが無いバックエンドでは、get_task() の base64 から保存する。
+    deadline（deadline.Deadline）を過ぎた場合は .part を残したまま False を返す。
+    """
+    url = f"{BASE_PATH}/api/v1/result/{task_id}"
+    part_path = dest_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    try:
+        timeout = (5, 30) if deadline is None else (deadline.timeout(5), deadline.timeout(30))
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 404:
+                return _save_task_result_from_status(task_id, dest_path)
+            if response.status_code == 416:
+                # 保存済みの部分で全体が揃っている
+                os.replace(part_path, dest_path)
+                return True
+            response.raise_for_status()
+            if response.status_code == 206:
+                mode = "ab"
+                logging.info(f"結果のダウンロードを {offset} bytes から再開します: {task_id}")
+            else:
+                mode = "wb"     # Range に対応していない場合は最初から
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    if deadline is not None and deadline.expired():
+                        logging.info(f"期限を過ぎたため結果のダウンロードを中断します（次回は続きから再開します）: {task_id}")
+                        return False
+        os.replace(part_path, dest_path)
+        return True
+    except requests.exceptions.RequestException as e:
+        logging.error(f"結果のダウンロードに失敗しました（次回は続きから再開します）: {e}")
+        return False
+    except OSError as e:
+        logging.error(f"結果の保存に失敗しました: {e}")
+        return False
+
+def _save_task_result_from_status(task_id: str, dest_path: str) -> bool:
+    task_info = get_task(task_id)
+    if not task_info or not task_info.get("result"):
+        return False
+    part_path = dest_path + ".part"
+    try:
+        audio = base64.b64decode(task_info["result"])
+    except (ValueError, TypeError) as e:   # binascii.Error は ValueError のサブクラス
+        logging.error(f"結果の base64 のデコードに失敗しました: {task_id}: {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+    with open(part_path, "wb") as f:
+        f.write(audio)
+    os.replace(part_path, dest_path)
+    return True
+
 def get_mock_task() -> dict[str, any] | None:
     url = f"{BASE_PATH}/api/v1/get_mock_data"
     try:
@@ -77,6 +170,28 @@ def get_mock_task() -> dict[str, any] | None:
         logging.error(f"レスポンスのでコードに失敗しました: {e}")
         return None
 
+def get_mock_task_if_modified(etag: str | None, timeout=5) -> tuple[int, dict[str, any] | None, str | None] | None:
+    """
+    モックのデータを条件付きリクエスト (If-None-Match) で取得する。
+
+    :return: (ステータスコード, レスポンス, ETag)。変更が無い場合は (304, None, etag)。
+             通信に失敗した場合は None
+    """
+    url = f"{BASE_PATH}/api/v1/get_mock_data"
+    headers = {"If-None-Match": etag} if etag else {}
+    try:
+        response = requests.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return 304, None, etag
+        response.raise_for_status()
+        return response.status_code, response.json(), response.headers.get("ETag")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"モックの取得に失敗しました: {e}")
+        return None
+    except json.JSONDecodeError as e:
+        logging.error(f"レスポンスのでコードに失敗しました: {e}")
+        return None
+
 def get_status(task_ids: list[str]) -> bool | None:
     url = f"{BASE_PATH}/api/v1/task_list"
     try:
@@ -88,3 +203,14 @@ def get_status(task_ids: list[str]) -> bool | None:
         logging.error(f"ステータスの取得に失敗しました: {e}")
         return None
 
+
+def open_task_events(read_timeout: float) -> requests.Response:
+    """
+    タスク完了通知のイベントストリーム (Server-Sent Events) に接続する。
+    接続に失敗した場合は requests.exceptions.RequestException を送出する。
+    """
+    url = f"{BASE_PATH}/api/v1/events"
+    response = requests.get(url, stream=True, timeout=(5, read_timeout),
+                            headers={"Accept": "text/event-stream"})
+    response.raise_for_status()
+    return response
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from math import gcd
+import numpy as np
+import logging
+
+@dataclass(frozen=True)
+class CaptureProfile:
+    """
+    録音したバッファをエンコード・送信する際の形式。
+
+    - channels: 送信するチャンネル数（録音より少なければダウンミックス）
+    - sample_rate: 送信するサンプリング周波数（録音と異なればリサンプリング）
+    - bitrate: エンコード時のビットレート（pydub/ffmpeg の指定形式, 例 "64k"）
+    - codec: pydub の export format ("mp3", "ogg" など)
+    """
+    channels: int = 2
+    sample_rate: int = 44100
+    bitrate: str = "128k"
+    codec: str = "mp3"
+
+    @property
+    def extension(self) -> str:
+        return self.codec
+
+# 設置場所ごとに選べるプロファイル
+PROFILES = {
+    "full": CaptureProfile(channels=2, sample_rate=44100, bitrate="128k", codec="mp3"),
+    "mono": CaptureProfile(channels=1, sample_rate=44100, bitrate="96k", codec="mp3"),
+    "analysis": CaptureProfile(channels=1, sample_rate=22050, bitrate="64k", codec="mp3"),
+    "low": CaptureProfile(channels=1, sample_rate=16000, bitrate="32k", codec="mp3"),
+}
+DEFAULT_PROFILE = "full"
+
+RESAMPLE_HALF_TAPS = 8      # 1位相あたりのタップ数の半分（大きいほど高品質・高負荷）
+RESAMPLE_BLOCK = 1 << 15    # 一度に計算する出力サンプル数（メモリ使用量の上限）
+
+def downmix(samples: np.ndarray, channels: int, out_channels: int = 1) -> np.ndarray:
+    """
+    インターリーブされたサンプル列 (N*channels,) を (N, out_channels) に変換する。
+    out_channels == 1 の場合は全チャンネルの平均を取る。
+    """
+    frames = samples.reshape(-1, channels)
+    if out_channels == channels:
+        return frames
+    if out_channels == 1:
+        return frames.mean(axis=1, dtype=np.float32)[:, None]
+    raise ValueError(f"{channels}ch から {out_channels}ch への変換には対応していません。")
+
+@lru_cache(maxsize=8)
+def _design_filter(up: int, down: int, half_taps: int):
+    """
+    カイザー窓付き sinc のローパスフィルタを (up, taps_per_phase) の多相形式とフィルタ遅延で返す。
+    再生のコールバックからバッファごとに呼ばれるため、同じ比率の設計は使い回す（呼び出し側は書き換えない）
+    """
+    n_taps = 2 * half_taps * max(up, down) + 1
+    cutoff = 1.0 / max(up, down)
+    t = np.arange(n_taps) - (n_taps - 1) / 2.0
+    h = cutoff * np.sinc(cutoff * t) * np.kaiser(n_taps, 8.0)
+    h *= up / np.sum(h)     # ゼロ挿入で下がる振幅を補う
+    taps_per_phase = -(-n_taps // up)
+    h = np.concatenate([h, np.zeros(taps_per_phase * up - n_taps)])
+    # phases[p, j] = h[p + up * j]
+    return h.reshape(taps_per_phase, up).T.astype(np.float32), (n_taps - 1) // 2
+
+def resample_poly(x: np.ndarray, in_rate: int, out_rate: int, half_taps: int = RESAMPLE_HALF_TAPS) -> np.ndarray:
+    """
+    多相フィルタによる有理数比リサンプリング。
+
+    x: (N,) または (N, channels) の float 配列。出力も同じ次元で返す。
+    出力サンプルはブロック単位でまとめて計算するため、Python のループは
+    ブロック数ぶんしか回らない。
+    """
+    g = gcd(in_rate, out_rate)
+    up, down = out_rate // g, in_rate // g
+    x = np.asarray(x, dtype=np.float32)
+    if up == down:
+        return x.copy()
+    squeeze = x.ndim == 1
+    if squeeze:
+        x = x[:, None]
+
+    phases, delay = _design_filter(up, down, half_taps)
+    taps_per_phase = phases.shape[1]
+    n_in = x.shape[0]
+    n_out = -(-n_in * up // down)
+    pad = taps_per_phase + delay // up + 1
+    padded = np.concatenate([np.zeros((pad, x.shape[1]), np.float32), x,
+                             np.zeros((pad, x.shape[1]), np.float32)])
+
+    out = np.empty((n_out, x.shape[1]), dtype=np.float32)
+    j = np.arange(taps_per_phase)
+    for start in range(0, n_out, RESAMPLE_BLOCK):
+        n = np.arange(start, min(start + RESAMPLE_BLOCK, n_out), dtype=np.int64)
+        m = n * down + delay                # アップサンプル後の位置（フィルタ遅延を補正）
+        phase = m % up
+        base = m // up
+        index = base[:, None] - j[None, :] + pad
+        # (block, taps) x (block, taps, channels) を畳み込む
+        out[start:start + len(n)] = np.einsum("bt,btc->bc", phases[phase], padded[index])
+    return out[:, 0] if squeeze else out
+
+def convert_pcm(data: bytes, channels: int, rate: int, profile: CaptureProfile) -> bytes:
+    """
+    録音した int16 インターリーブの PCM をプロファイルの形式に変換する。
+    形式が同じ場合はそのまま返す。
+    """
+    if profile.channels == channels and profile.sample_rate == rate:
+        return data
+    samples = np.frombuffer(data, dtype=np.int16)
+    frames = downmix(samples, channels, profile.channels).astype(np.float32)
+    if profile.sample_rate != rate:
+        frames = resample_poly(frames, rate, profile.sample_rate)
+    out = np.clip(np.rint(frames), -32768, 32767).astype(np.int16)
+    logging.info(f"音声形式を変換しました: {channels}ch/{rate}Hz -> {profile.channels}ch/{profile.sample_rate}Hz "
+                 f"({len(data)} -> {out.nbytes} bytes)")
+    return out.tobytes()
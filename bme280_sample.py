@@ -1,8 +1,6 @@
 import smbus
 import logging
-
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from log_config import setup_logging
 
 bus_number  = 1
 i2c_address = 0x76
@@ -127,7 +125,7 @@ def compensate_P(adc_P: float) -> float:
     v2 = ((pressure / 4.0) * digP[7]) / 8192.0
     pressure = pressure + ((v1 + v2 + digP[6]) / 16.0)  
 
-    print(f"pressure : {pressure/100:7.2f} hPa")
+    logging.debug(f"pressure : {pressure/100:7.2f} hPa")
     return pressure/100
 
 def compensate_T(adc_T: float) -> float:
@@ -136,7 +134,7 @@ def compensate_T(adc_T: float) -> float:
     v2 = (adc_T / 131072.0 - digT[0] / 8192.0) * (adc_T / 131072.0 - digT[0] / 8192.0) * digT[2]
     t_fine = v1 + v2
     temperature = t_fine / 5120.0
-    print(f"temp : {temperature:-6.2f} ℃") 
+    logging.debug(f"temp : {temperature:-6.2f} ℃")
     return temperature 
 
 def compensate_H(adc_H: float) -> float:
@@ -151,7 +149,7 @@ def compensate_H(adc_H: float) -> float:
         var_h = 100.0
     elif var_h < 0.0:
         var_h = 0.0
-    print(f"hum : {var_h:6.2f} %")
+    logging.debug(f"hum : {var_h:6.2f} %")
     return var_h
 
 
@@ -178,6 +176,7 @@ def init():
         get_calib_param()
 
 if __name__ == '__main__':
+    setup_logging()
     init()
     if bus:
         bme280_data = readData()
@@ -0,0 +1,321 @@
+import pyaudio
+import logging
+import threading
+import queue
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from record_sample import CHUNK, FORMAT, CHANNELS, RATE
+from echo_cancel import adc_time_from
+from deadline import Deadline, Cancelled
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_BLOCK = "block"
+
+@dataclass
+class Window:
+    """録音が完了した1ウィンドウ分の PCM (int16 インターリーブ)"""
+    seq: int
+    data: memoryview
+    channels: int
+    rate: int
+    started_at: float
+    activity: dict | None = None
+    deadline: Deadline | None = None    # 処理の期限（close() で取り消される）
+    _buffer: bytearray = field(default=None, repr=False)
+
+    @property
+    def seconds(self) -> float:
+        return len(self.data) / (2 * self.channels * self.rate)
+
+class CapturePipeline:
+    """
+    録音ストリームを開いたまま連続で録音し、window_seconds ごとにバッファを切り替える。
+
+    コールバックは事前に確保したバッファへコピーするだけで、ウィンドウが埋まると
+    空いているバッファに切り替えてディスパッチャへ渡す。ディスパッチャは有音判定を行い、
+    有界キュー経由でワーカースレッド群（エンコード・送信）に渡す。
+    キューが満杯の場合は policy に従って最も古いウィンドウを捨てるか、空くまで待つ。
+
+    バッファは起動時に buffers 個（既定では 録音中・ディスパッチャ・キュー・ワーカーの分）だけ確保し、
+    コールバックでは確保しない。空いているバッファが無い場合（block で処理が追いつかない場合など）は、
+    埋まったウィンドウを渡さずに同じバッファへ上書きして録音を続ける（metrics の windows_overwritten）。
+
+    process_window(window) はワーカースレッドで呼ばれる。window.data は処理の終了後に
+    再利用されるため、関数の外に保持してはいけない。処理は window.deadline（既定では
+    ウィンドウの長さ）までに終える。期限切れや close() による取り消しでは、途中まで作ったものを
+    片付けて deadline.Cancelled を送出するか False を返す。
+
+    echo_canceller（echo_cancel.DuplexEchoCanceller）を渡すと、バッファに書き込む前に
+    再生中の音の回り込みを差し引く。再生中も録音を止めずに済む。
+
+    on_activity(window) を渡すと、有音判定の直後にディスパッチャのスレッドで呼ぶ。
+    無音で破棄するウィンドウも含むので、音量の履歴を残すのに使う。
+    """
+    def __init__(self, window_seconds, process_window, workers=1, queue_size=2,
+                 policy=POLICY_DROP_OLDEST, level_monitor=None,
+                 channels=CHANNELS, rate=RATE, chunk=CHUNK, echo_canceller=None, process_timeout=None,
+                 on_activity=None, buffers=None):
+        if policy not in (POLICY_DROP_OLDEST, POLICY_BLOCK):
+            raise ValueError(f"unknown policy: {policy}")
+        self.window_seconds = window_seconds
+        self.process_window = process_window
+        self.policy = policy
+        self.level_monitor = level_monitor
+        self.echo_canceller = echo_canceller
+        self.on_activity = on_activity
+        self.process_timeout = process_timeout if process_timeout is not None else window_seconds
+        self._cancel = threading.Event()
+        self.channels = channels
+        self.rate = rate
+        self.chunk = chunk
+        self.frame_bytes = 2 * channels
+        self.window_bytes = int(window_seconds * rate) * self.frame_bytes
+
+        self._lock = threading.Lock()
+        # 録音中・ディスパッチャが持つ分・キュー・ワーカーが処理中の分
+        self.buffers = buffers if buffers is not None else queue_size + workers + 2
+        self._free = deque(bytearray(self.window_bytes) for _ in range(self.buffers))
+        self._active = None
+        self._fill = 0
+        self._seq = 0
+        self._window_started = 0.0
+
+        self._audio = None
+        self._stream = None
+        # コールバック -> ディスパッチャ。バッファの数より多くは入らない（+1 は close() の終了の合図）
+        self._ready = queue.Queue(maxsize=self.buffers + 1)
+        self._work = queue.Queue(maxsize=queue_size)  # ディスパッチャ -> ワーカー
+        self._metrics = {
+            "windows_captured": 0,
+            "windows_silent": 0,
+            "windows_dropped": 0,
+            "windows_processed": 0,
+            "windows_failed": 0,
+            "windows_discarded": 0,
+            "windows_cancelled": 0,
+            "windows_overwritten": 0,
+            "queue_high_watermark": 0,
+            "blocked_seconds": 0.0,
+            "last_process_seconds": 0.0,
+            "last_stop_seconds": 0.0,
+        }
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="capture-dispatch", daemon=True)
+        self._dispatcher.start()
+        self._workers = [threading.Thread(target=self._worker_loop, name=f"capture-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    # --- 制御 ---
+    def start(self):
+        """録音ストリームを開始する"""
+        with self._lock:
+            if self._stream is not None:
+                return
+            self._active = self._take_buffer()
+            self._fill = 0
+            self._window_started = time.time()
+            if self._audio is None:
+                self._audio = pyaudio.PyAudio()
+            self._stream = self._audio.open(format=FORMAT,
+                                            channels=self.channels,
+                                            rate=self.rate,
+                                            input=True,
+                                            frames_per_buffer=self.chunk,
+                                            stream_callback=self._callback)
+            self._stream.start_stream()
+        logging.info(f"連続録音を開始しました。(ウィンドウ {self.window_seconds}秒, 方式 {self.policy})")
+
+    def stop(self):
+        """
+        録音ストリームを停止する。録音途中のウィンドウは破棄し、キュー内のウィンドウは処理を続ける。
+        再生の前に呼ばれるため、バッファの完了を待たずにストリームを閉じる（数十ms以内）
+        """
+        started = time.perf_counter()
+        with self._lock:
+            if self._stream is None:
+                return
+            stream = self._stream
+            self._stream = None
+            # コールバックが残りのデータを書き込まないようにする
+            active, self._active = self._active, None
+        # stop_stream() は処理中のバッファの完了を待つため使わない（close() は中断として扱われる）
+        stream.close()
+        with self._lock:
+            if active is not None:
+                if self._fill:
+                    self._metrics["windows_discarded"] += 1
+                self._release_buffer(active)
+        if self.level_monitor is not None:
+            self.level_monitor.discard_window()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._metrics["last_stop_seconds"] = elapsed
+        logging.info(f"連続録音を停止しました。({elapsed * 1000:.0f}ms)")
+
+    def close(self, timeout=5.0):
+        """
+        録音を止め、キューに残ったウィンドウを timeout 秒まで処理してからワーカーを終了する。
+        終わらなかったウィンドウの処理は取り消す
+        """
+        self.stop()
+        deadline = Deadline(timeout)
+        self._ready.put(None)
+        self._dispatcher.join(timeout=deadline.remaining())
+        for _ in self._workers:
+            self._work.put(None)
+        for worker in self._workers:
+            worker.join(timeout=deadline.remaining())
+        if any(worker.is_alive() for worker in self._workers):
+            logging.warning("キャプチャ: 時間内に終わらなかったウィンドウの処理を取り消します。")
+            self._cancel.set()
+            for worker in self._workers:
+                worker.join(timeout=1.0)
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+    def is_running(self) -> bool:
+        return self._stream is not None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["queue_depth"] = self._work.qsize()
+        return metrics
+
+    # --- バッファ管理 ---
+    def _take_buffer(self) -> bytearray | None:
+        """空いているバッファ。無ければ None（確保はしない）"""
+        return self._free.pop() if self._free else None
+
+    def _release_buffer(self, buffer):
+        if len(buffer) == self.window_bytes:
+            self._free.append(buffer)
+
+    # --- 録音コールバック（PyAudio のスレッド） ---
+    def _callback(self, in_data, frame_count, time_info, status):
+        if self.echo_canceller is not None:
+            try:
+                in_data = self.echo_canceller.process(in_data, adc_time_from(time_info, frame_count, self.rate))
+            except Exception as e:
+                logging.error(f"キャプチャ: 回り込み音の除去に失敗しました: {e}")
+        with self._lock:
+            if self._stream is None:
+                return (None, pyaudio.paContinue)
+            if self._active is None:
+                # start() の時点ですべてのバッファが処理待ちだった。空くまでの音は捨てる
+                self._active = self._take_buffer()
+                if self._active is None:
+                    return (None, pyaudio.paContinue)
+                self._window_started = time.time()
+            view = memoryview(in_data)
+            while len(view):
+                take = min(len(view), self.window_bytes - self._fill)
+                self._active[self._fill:self._fill + take] = view[:take]
+                if self.level_monitor is not None:
+                    self.level_monitor.feed(view[:take])
+                self._fill += take
+                view = view[take:]
+                if self._fill >= self.window_bytes:
+                    self._swap()
+        return (None, pyaudio.paContinue)
+
+    def _swap(self):
+        """
+        埋まったバッファをディスパッチャに渡し、空いているバッファに切り替える。
+        空いているバッファが無ければ、このウィンドウは渡さずに同じバッファに上書きする
+        """
+        buffer = self._take_buffer()
+        if buffer is None:
+            if self.level_monitor is not None:
+                self.level_monitor.discard_window()
+            self._metrics["windows_overwritten"] += 1
+        else:
+            blocks = self.level_monitor.detach_window() if self.level_monitor is not None else None
+            self._ready.put_nowait((self._seq, self._active, self._fill, self._window_started, blocks))
+            self._metrics["windows_captured"] += 1
+            self._active = buffer
+        self._seq += 1
+        self._fill = 0
+        self._window_started = time.time()
+
+    # --- ディスパッチャ ---
+    def _dispatch_loop(self):
+        while True:
+            item = self._ready.get()
+            if item is None:
+                return
+            seq, buffer, fill, started_at, blocks = item
+            window = Window(seq, memoryview(buffer)[:fill], self.channels, self.rate, started_at, _buffer=buffer)
+            if blocks is not None:
+                window.activity = self.level_monitor.evaluate(*blocks)
+                if self.on_activity is not None:
+                    try:
+                        self.on_activity(window)
+                    except Exception as e:
+                        logging.error(f"ディスパッチャ: 音量の記録に失敗しました: {e}")
+                if not window.activity["keep"]:
+                    with self._lock:
+                        self._metrics["windows_silent"] += 1
+                    self._finish(window)
+                    continue
+            self._enqueue(window)
+
+    def _enqueue(self, window):
+        if self.policy == POLICY_BLOCK:
+            started = time.perf_counter()
+            self._work.put(window)
+            blocked = time.perf_counter() - started
+            with self._lock:
+                self._metrics["blocked_seconds"] += blocked
+            if blocked > 1.0:
+                logging.warning(f"キャプチャ: 処理待ちのため {blocked:.1f}秒 ブロックしました。")
+        else:
+            while True:
+                try:
+                    self._work.put_nowait(window)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self._work.get_nowait()
+                    except queue.Empty:
+                        continue
+                    with self._lock:
+                        self._metrics["windows_dropped"] += 1
+                    logging.warning(f"キャプチャ: キューが満杯のため古いウィンドウ #{dropped.seq} を破棄しました。")
+                    self._finish(dropped)
+        with self._lock:
+            self._metrics["queue_high_watermark"] = max(self._metrics["queue_high_watermark"], self._work.qsize())
+
+    # --- ワーカー ---
+    def _worker_loop(self):
+        while True:
+            window = self._work.get()
+            if window is None:
+                return
+            started = time.perf_counter()
+            ok = False
+            window.deadline = Deadline(self.process_timeout, self._cancel)
+            try:
+                ok = self.process_window(window) is not False
+            except Cancelled as e:
+                logging.warning(f"キャプチャ: ウィンドウ #{window.seq} の処理を中止しました: {e}")
+                with self._lock:
+                    self._metrics["windows_cancelled"] += 1
+                self._finish(window)
+                continue
+            except Exception as e:
+                logging.error(f"キャプチャ: ウィンドウ #{window.seq} の処理中にエラーが発生しました: {e}", exc_info=True)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._metrics["windows_processed" if ok else "windows_failed"] += 1
+                self._metrics["last_process_seconds"] = elapsed
+            self._finish(window)
+
+    def _finish(self, window):
+        with self._lock:
+            self._release_buffer(window._buffer)
@@ -0,0 +1,62 @@
+"""
+処理の期限と取り消し。
+
+録音・エンコード・センサーの読み取り・送信・再生の準備などの各段階は、区切りごとに
+Deadline.check() を呼び、待つ処理（ネットワーク、ワーカープロセス）には remaining() を上限として渡す。
+期限を過ぎるか取り消されると Cancelled を送出するので、呼び出し側は途中まで作ったものを片付けて戻る。
+"""
+import time
+import threading
+
+MIN_TIMEOUT = 0.01  # ネットワークのタイムアウトに渡す最小値（0 はライブラリがエラーにする）
+
+class Cancelled(Exception):
+    """処理が取り消されたか、期限を過ぎた"""
+
+def _monotonic() -> float:
+    """既定の時計。trace_harness が time を仮想時計に差し替えられるよう、呼ぶたびに time.monotonic を引く"""
+    return time.monotonic()
+
+class Deadline:
+    """
+    seconds 秒後の期限と、cancel_event による取り消しをまとめたもの。
+    seconds=None の場合は期限なし（取り消しだけを見る）。clock を省略すると time.monotonic を使う。
+    """
+    def __init__(self, seconds=None, cancel_event: threading.Event | None = None, clock=None):
+        clock = clock if clock is not None else _monotonic
+        self.clock = clock
+        self.expires_at = None if seconds is None else clock() + seconds
+        self.cancel_event = cancel_event
+
+    def remaining(self, cap=None) -> float | None:
+        """期限までの秒数（cap を上限にする）。期限なしで cap も無い場合は None"""
+        if self.expires_at is None:
+            return cap
+        left = max(self.expires_at - self.clock(), 0.0)
+        return left if cap is None else min(left, cap)
+
+    def timeout(self, cap) -> float:
+        """ネットワークなどのタイムアウトに渡す値（期限までの秒数を cap で抑えたもの）"""
+        return max(self.remaining(cap), MIN_TIMEOUT)
+
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def expired(self) -> bool:
+        return self.cancelled() or (self.expires_at is not None and self.clock() >= self.expires_at)
+
+    def check(self, stage=""):
+        """期限切れか取り消されていれば Cancelled を送出する"""
+        if self.cancelled():
+            raise Cancelled(f"{stage}: 取り消されました")
+        if self.expires_at is not None and self.clock() >= self.expires_at:
+            raise Cancelled(f"{stage}: 期限を過ぎました")
+
+    def wait(self, seconds) -> bool:
+        """seconds 秒（期限まで）待つ。取り消されるとすぐに戻る。:return: 期限切れか取り消された場合 True"""
+        timeout = self.remaining(seconds)
+        if self.cancel_event is not None:
+            self.cancel_event.wait(timeout)
+        elif timeout:
+            time.sleep(timeout)
+        return self.expired()
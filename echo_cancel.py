@@ -0,0 +1,200 @@
+"""
+再生中も録音を続けるための回り込み音（エコー）除去。
+
+再生側（playback.CallbackPlayer）は出力したバッファを、スピーカーから出る時刻（DAC 時刻）と共に
+PlaybackReference に書き込む。録音側（capture_pipeline.CapturePipeline）はマイクのバッファが
+取り込まれた時刻（ADC 時刻）で同じ区間の参照信号を読み出し、EchoCanceller で
+スピーカーからマイクまでの伝達特性を推定して差し引く。
+
+適応フィルタは周波数領域のブロック NLMS（overlap-save）で、block サンプルごとに
+FFT 数回とベクトル演算だけで更新する。タップ長は block と同じで、DAC/ADC 時刻のずれと
+部屋の初期反射をこの範囲で吸収する。
+
+部屋の音（残したい信号）が同時に入っている間（ダブルトーク）に一定のステップで適応すると、
+フィルタが部屋の音に引きずられて回り込み音の除去が悪くなり、部屋の音も削られる。
+そのため、誤差のうち回り込み音の消し残りと推定できる割合だけステップを大きくする
+（誤差と推定した回り込み音の相関から消し残りを推定する。部屋の音が大きいほど適応は遅くなる）。
+"""
+import threading
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+from audio_profile import resample_poly
+
+ECHO_BLOCK = 1024           # 適応フィルタのブロック長 = タップ数（44.1kHz で約23ms）
+ECHO_STEP = 0.5             # NLMS のステップサイズの上限（0〜1, 大きいほど速く追従し不安定になりやすい）
+POWER_SMOOTHING = 0.9       # 参照信号のパワー推定の平滑化係数
+LEAK_SMOOTHING = 0.95       # 消し残りの推定に使う相関の平滑化係数
+MIN_STEP_RATIO = 0.03       # 消し残りが無いと推定した場合も、ECHO_STEP のこの割合では適応を続ける（伝達特性の変化に追従する）
+ADAPT_BLOCKS = 40           # 消し残りの推定を使い始めるまでに、上限のステップで適応するブロック数（約1秒）
+ERLE_WINDOW_BLOCKS = 200    # erle_db() を求める直近のブロック数（約5秒）
+REFERENCE_SECONDS = 4.0     # 参照信号を保持する長さ
+SNAP_SECONDS = 0.005        # 前のバッファとの時刻のずれがこれ以下なら連続したものとして扱う
+REFERENCE_SILENCE = 1e-3    # 参照信号がこれ以下のブロックでは適応を止める（int16 フルスケール比）
+
+class PlaybackReference:
+    """
+    再生した信号を、録音側のサンプリング周波数・モノラルに揃えて時刻付きで保持するリングバッファ。
+    write() は再生のコールバック、read() は録音のコールバックから呼ばれる。
+    """
+    def __init__(self, rate, seconds=REFERENCE_SECONDS):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._ring = np.zeros(int(rate * seconds), dtype=np.float32)
+        self._origin = perf_counter()   # 絶対サンプル番号 0 の時刻
+        self._end = None                # 書き込み済みの末尾（絶対サンプル番号）
+
+    def write(self, samples, channels, rate, dac_time):
+        """int16 インターリーブの samples を、先頭が dac_time にスピーカーから出るものとして書き込む"""
+        x = np.asarray(samples, dtype=np.float32).reshape(-1, channels).mean(axis=1)
+        if rate != self.rate and len(x):
+            x = resample_poly(x, rate, self.rate)
+        start = int(round((dac_time - self._origin) * self.rate))
+        size = len(self._ring)
+        with self._lock:
+            if self._end is not None and abs(start - self._end) <= SNAP_SECONDS * self.rate:
+                start = self._end
+            if self._end is not None and start > self._end:
+                # 再生していなかった区間は無音にする
+                gap = np.arange(self._end, min(start, self._end + size)) % size
+                self._ring[gap] = 0.0
+            x = x[-size:]
+            self._ring[np.arange(start, start + len(x)) % size] = x
+            self._end = start + len(x)
+
+    def read(self, adc_time, frames) -> np.ndarray:
+        """adc_time から frames サンプル分の参照信号（書き込まれていない区間は 0）"""
+        start = int(round((adc_time - self._origin) * self.rate))
+        index = np.arange(start, start + frames)
+        with self._lock:
+            if self._end is None:
+                return np.zeros(frames, dtype=np.float32)
+            out = self._ring[index % len(self._ring)]
+            valid = (index < self._end) & (index >= self._end - len(self._ring))
+        return np.where(valid, out, 0.0).astype(np.float32)
+
+class EchoCanceller:
+    """
+    周波数領域ブロック NLMS（overlap-save, 勾配拘束あり）による回り込み音の除去。
+    マイクは channels チャンネルで、チャンネルごとに別の伝達特性を推定する。
+    """
+    def __init__(self, channels, block=ECHO_BLOCK, step=ECHO_STEP, smoothing=POWER_SMOOTHING):
+        self.channels = channels
+        self.block = block
+        self.step = step
+        self.smoothing = smoothing
+        self._weights = np.zeros((channels, block + 1), dtype=np.complex64)
+        self._power = None      # 参照信号のパワー（最初のブロックで初期化する）
+        self._previous = np.zeros(block, dtype=np.float32)
+        self._zeros = np.zeros((channels, block), dtype=np.float32)
+        self._pey = np.zeros(channels)      # 誤差と推定した回り込み音の相関
+        self._pyy = np.zeros(channels)      # 推定した回り込み音のパワー
+        self._adapted_blocks = 0
+
+    def reset(self):
+        self._weights[:] = 0
+        self._power = None
+        self._previous[:] = 0
+        self._pey[:] = 0
+        self._pyy[:] = 0
+        self._adapted_blocks = 0
+
+    def process_block(self, mic, reference) -> np.ndarray:
+        """
+        mic: (block, channels) の float, reference: (block,) の float。
+        :return: 回り込み音を差し引いた (block, channels)
+        """
+        x = np.concatenate([self._previous, reference])
+        self._previous = reference
+        spectrum = np.fft.rfft(x)
+        echo = np.fft.irfft(spectrum * self._weights, axis=-1)[:, self.block:]
+        error = mic.T - echo
+
+        # 参照信号のパワーで正規化した勾配を、タップ長 block に拘束してから加える
+        power = np.abs(spectrum) ** 2
+        if self._power is None:
+            self._power = power
+        else:
+            self._power = self.smoothing * self._power + (1.0 - self.smoothing) * power
+        error_spectrum = np.fft.rfft(np.concatenate([self._zeros, error], axis=-1), axis=-1)
+        gradient = (self._step(echo, error, error_spectrum) * np.conj(spectrum) * error_spectrum
+                    / (self._power + 1e-6 * self._power.max() + 1e-9))
+        gradient = np.fft.irfft(gradient, axis=-1)[:, :self.block]
+        self._weights += np.fft.rfft(np.concatenate([gradient, self._zeros], axis=-1), axis=-1)
+        return error.T
+
+    def _step(self, echo, error, error_spectrum) -> np.ndarray:
+        """
+        周波数ビンごとのステップサイズ。誤差のうち回り込み音の消し残りの割合（推定）に比例させる。
+        消し残りは 推定した回り込み音 × 漏れ率（誤差と推定した回り込み音の相関 / 推定した回り込み音のパワー）とする
+        """
+        self._pey = LEAK_SMOOTHING * self._pey + (1.0 - LEAK_SMOOTHING) * np.sum(error * echo, axis=-1)
+        self._pyy = LEAK_SMOOTHING * self._pyy + (1.0 - LEAK_SMOOTHING) * np.sum(echo * echo, axis=-1)
+        self._adapted_blocks += 1
+        if self._adapted_blocks <= ADAPT_BLOCKS:
+            return self.step
+        leak = np.clip(self._pey / (self._pyy + 1e-9), 0.0, 1.0)
+        echo_power = np.abs(np.fft.rfft(np.concatenate([self._zeros, echo], axis=-1), axis=-1)) ** 2
+        residual = leak[:, None] * echo_power
+        return self.step * np.clip(residual / (np.abs(error_spectrum) ** 2 + 1e-9), MIN_STEP_RATIO, 1.0)
+
+class DuplexEchoCanceller:
+    """
+    録音のコールバックに組み込む回り込み音の除去。
+
+    任意の長さのバッファを受け取り、block 単位で処理して同じ長さを返す（block サンプル分遅れる）。
+    参照信号が無音のブロックは適応も減算も行わず、マイクの信号をそのまま通す。
+    """
+    def __init__(self, reference: PlaybackReference, channels, block=ECHO_BLOCK, step=ECHO_STEP):
+        self.reference = reference
+        self.channels = channels
+        self.block = block
+        self.canceller = EchoCanceller(channels, block, step)
+        self._mic = np.zeros((0, channels), dtype=np.float32)
+        self._ref = np.zeros(0, dtype=np.float32)
+        self._out = np.zeros((block, channels), dtype=np.float32)
+        self.metrics = {"blocks": 0, "cancelled_blocks": 0}
+        self._recent = deque(maxlen=ERLE_WINDOW_BLOCKS)    # 直近の再生中のブロックの (マイク, 差し引いた後) のパワー
+
+    def erle_db(self) -> float | None:
+        """直近 ERLE_WINDOW_BLOCKS の再生中のブロックで、マイクの信号に対して回り込み音をどれだけ減らせたか[dB]"""
+        recent = list(self._recent)
+        residual = sum(power for _, power in recent)
+        if not residual:
+            return None
+        return float(10.0 * np.log10(sum(power for power, _ in recent) / residual))
+
+    def process(self, in_data: bytes, adc_time: float) -> bytes:
+        """【録音のコールバック内で実行】int16 インターリーブのバッファから回り込み音を差し引く"""
+        mic = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.channels).astype(np.float32)
+        frames = len(mic)
+        self._mic = np.concatenate([self._mic, mic])
+        self._ref = np.concatenate([self._ref, self.reference.read(adc_time, frames)])
+        outputs = [self._out]
+        silence = REFERENCE_SILENCE * 32768.0
+        while len(self._mic) >= self.block:
+            mic_block, self._mic = self._mic[:self.block], self._mic[self.block:]
+            ref_block, self._ref = self._ref[:self.block], self._ref[self.block:]
+            self.metrics["blocks"] += 1
+            if np.max(np.abs(ref_block)) <= silence:
+                outputs.append(mic_block)
+                continue
+            cleaned = self.canceller.process_block(mic_block, ref_block)
+            self.metrics["cancelled_blocks"] += 1
+            self._recent.append((float(np.mean(mic_block ** 2)), float(np.mean(cleaned ** 2))))
+            outputs.append(cleaned)
+        out = np.concatenate(outputs)
+        self._out = out[frames:]
+        return np.clip(np.rint(out[:frames]), -32768, 32767).astype(np.int16).tobytes()
+
+def adc_time_from(time_info, frame_count, rate) -> float:
+    """PyAudio の time_info から、バッファの先頭がマイクに入った時刻を perf_counter の基準で求める"""
+    now = perf_counter()
+    adc = time_info.get("input_buffer_adc_time", 0.0) if time_info else 0.0
+    current = time_info.get("current_time", 0.0) if time_info else 0.0
+    if adc and current:
+        return now - (current - adc)
+    return now - frame_count / rate
+
@@ -0,0 +1,196 @@
+"""
+複数台の fuwariumu を1プロセスで模擬し、バックエンドに負荷をかける。
+
+各仮想ユニットは録音ウィンドウごとに、合成した音声（プロファイルのビットレート相当のサイズ）と
+センサーデータを /api/v1/data に送信する。全ユニットで1つのコネクションプールを共有し、
+送信は concurrency 本のスレッドで行う。ウィンドウの開始時刻のずれ（start_jitter）と
+送信ごとの遅延（upload_jitter）を変えて、送信タイミングの戦略を比べられる。
+
+    python fleet_sim.py --serve --units 50 --duration 300 --window_seconds 60 --start_jitter 0
+    python fleet_sim.py --base_url http://127.0.0.1:8000 --units 200 --start_jitter 60
+"""
+import time
+import heapq
+import random
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+import api
+from audio_profile import PROFILES, DEFAULT_PROFILE
+from log_config import setup_logging
+
+WINDOW_SECONDS = 60     # main.RECORDING_SECONDS と同じ
+UNITS = 10
+CONCURRENCY = 8
+DURATION_SECONDS = 300.0
+REQUEST_TIMEOUT = 10
+PERCENTILES = (50, 90, 99)
+
+def synthetic_audio(profile, seconds, rng: random.Random) -> bytes:
+    """プロファイルのビットレートで seconds 秒分エンコードした場合と同じサイズのランダムなバイト列"""
+    bitrate = int(profile.bitrate.rstrip("k")) * 1000
+    return rng.randbytes(int(bitrate * seconds / 8))
+
+def synthetic_sensors(rng: random.Random):
+    bme280 = {"temperature": rng.gauss(24.0, 2.0), "pressure": rng.gauss(1013.0, 5.0),
+              "humidity": rng.uniform(30.0, 70.0)}
+    tsl2572 = {"lux": max(0.0, rng.gauss(300.0, 100.0))}
+    return bme280, tsl2572
+
+class FleetStats:
+    """エンドポイントごとのレイテンシとエラー数、1秒ごとのリクエスト数を集計する"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.per_second = defaultdict(int)
+        self.started = time.monotonic()
+
+    def add(self, endpoint, latency, ok):
+        with self._lock:
+            self.latency[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+            self.per_second[int(time.monotonic() - self.started)] += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            total = sum(len(v) for v in self.latency.values())
+            report = {"elapsed_seconds": elapsed, "requests": total,
+                      "request_rate": total / elapsed,
+                      "peak_rate": max(self.per_second.values(), default=0),
+                      "endpoints": {}}
+            for endpoint, values in self.latency.items():
+                values = np.asarray(values)
+                row = {"count": int(len(values)), "errors": self.errors[endpoint],
+                       "error_rate": self.errors[endpoint] / len(values)}
+                for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                    row[f"p{p}_ms"] = float(v) * 1000
+                row["max_ms"] = float(values.max()) * 1000
+                report["endpoints"][endpoint] = row
+            return report
+
+class FleetSimulator:
+    """
+    units 台の仮想ユニットを window_seconds ごとに送信させる。
+
+    ユニット i のウィンドウは start_jitter の範囲でランダムにずらした位相を持ち、
+    各送信はさらに 0〜upload_jitter 秒遅らせる。start_jitter=0, upload_jitter=0 は、
+    全台が同じ時刻に録音を始めた場合（現在の実機の動作）に相当する。
+    """
+    def __init__(self, base_url, units=UNITS, concurrency=CONCURRENCY, window_seconds=WINDOW_SECONDS,
+                 start_jitter=0.0, upload_jitter=0.0, profile=PROFILES[DEFAULT_PROFILE], seed=0):
+        self.base_url = base_url.rstrip("/")
+        self.units = units
+        self.window_seconds = window_seconds
+        self.start_jitter = start_jitter
+        self.upload_jitter = upload_jitter
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.stats = FleetStats()
+
+        # 全ユニットで共有するコネクションプール
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fleet-upload")
+        # 音声は送信のたびに生成すると CPU がボトルネックになるため、数種類だけ作って使い回す
+        self._audio = [synthetic_audio(profile, window_seconds, random.Random(seed + i)) for i in range(min(units, 8))]
+        self.task_ids = []
+
+    def _upload(self, unit):
+        bme280, tsl2572 = synthetic_sensors(self.rng)
+        payload = api.build_payload(self._audio[unit % len(self._audio)], bme280, tsl2572)
+        started = time.monotonic()
+        ok = False
+        try:
+            response = self.session.post(f"{self.base_url}/api/v1/data", json=payload, timeout=REQUEST_TIMEOUT)
+            ok = response.ok
+            if ok:
+                self.task_ids.append(response.json().get("task_id"))
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"ユニット {unit}: 送信に失敗しました: {e}")
+        self.stats.add("POST /api/v1/data", time.monotonic() - started, ok)
+
+    def run(self, duration) -> dict:
+        """duration 秒間ユニットを動かし、集計結果を返す"""
+        logging.info(f"フリート: {self.units} 台, ウィンドウ {self.window_seconds}秒, "
+                     f"start_jitter={self.start_jitter}秒, upload_jitter={self.upload_jitter}秒 で開始します。")
+        start = time.monotonic()
+        self.stats.started = start
+        # (送信時刻, ユニット番号, ウィンドウ番号) のヒープ
+        schedule = []
+        phases = [self.rng.uniform(0.0, self.start_jitter) for _ in range(self.units)]
+        for unit, phase in enumerate(phases):
+            heapq.heappush(schedule, (start + phase + self.window_seconds + self.rng.uniform(0.0, self.upload_jitter),
+                                      unit, 1))
+        futures = []
+        while schedule:
+            due, unit, window = heapq.heappop(schedule)
+            if due - start > duration:
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self._executor.submit(self._upload, unit))
+            next_due = (start + phases[unit] + (window + 1) * self.window_seconds
+                        + self.rng.uniform(0.0, self.upload_jitter))
+            heapq.heappush(schedule, (next_due, unit, window + 1))
+        for future in futures:
+            future.result()
+        self._executor.shutdown()
+        self.session.close()
+        return self.stats.report()
+
+def format_report(report: dict) -> str:
+    lines = [f"requests={report['requests']} elapsed={report['elapsed_seconds']:.1f}s "
+             f"rate={report['request_rate']:.2f}/s peak={report['peak_rate']}/s"]
+    for endpoint, row in report["endpoints"].items():
+        percentiles = " ".join(f"p{p}={row[f'p{p}_ms']:.0f}ms" for p in PERCENTILES)
+        lines.append(f"{endpoint}: count={row['count']} errors={row['errors']} "
+                     f"({100 * row['error_rate']:.1f}%) {percentiles} max={row['max_ms']:.0f}ms")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_url", default=api.BASE_PATH)
+    parser.add_argument("--serve", action="store_true", help="mock_server をこのプロセス内で起動して使う")
+    parser.add_argument("--units", type=int, default=UNITS)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="同時送信数（コネクションプールの大きさ）")
+    parser.add_argument("--duration", type=float, default=DURATION_SECONDS)
+    parser.add_argument("--window_seconds", type=float, default=WINDOW_SECONDS)
+    parser.add_argument("--start_jitter", type=float, default=0.0, help="ユニットごとのウィンドウの位相のずれの最大値[s]")
+    parser.add_argument("--upload_jitter", type=float, default=0.0, help="送信ごとの遅延の最大値[s]")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if args.serve:
+        import mock_server
+        server = mock_server.create_server(port=0)
+        threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        simulator = FleetSimulator(base_url, units=args.units, concurrency=args.concurrency,
+                                   window_seconds=args.window_seconds, start_jitter=args.start_jitter,
+                                   upload_jitter=args.upload_jitter, profile=PROFILES[args.profile], seed=args.seed)
+        print(format_report(simulator.run(args.duration)))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
@@ -2,40 +2,137 @@ from pydub import AudioSegment
 from pydub.exceptions import CouldntDecodeError
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
 import logging
+import os
+from log_config import setup_logging
 
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+WIDTH_PX = 1500			# 画像の幅（= 包絡線の列数）
+HEIGHT_PX = 500
+DPI = 100
+CACHE_DIR = os.path.join("cache", "waveform")
+OUTPUT_DIR = "waveforms"
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac", ".m4a")
 
-def get_audio_waveform(file_path):
+def decode_mono(file_path):
+	"""音声ファイルをモノラルの [-1, 1] の float32 配列として読み込む。:return: (data, sample_rate)"""
+	# ファイル形式を自動判別して読み込み
+	audio = AudioSegment.from_file(file_path)
+
+	sample_rate = audio.frame_rate
+	mono_audio = audio.set_channels(1)
+
+	data = np.array(mono_audio.get_array_of_samples())
+
+	# データを[-1, 1]の範囲に正規化
+	if data.dtype == np.int16:
+		data = data.astype(np.float32) / 32768.0
+	elif data.dtype == np.int32:
+		data = data.astype(np.float32) / 2147483648.0
+	else:
+		# 他のデータ型の場合は、最大値で割る
+		max_val = np.iinfo(data.dtype).max
+		if max_val > 0:
+			data = data.astype(np.float32) / max_val
+	return data, sample_rate
+
+def compute_envelope(data, columns):
+	"""
+	サンプル列を columns 個の区間に分け、区間ごとの最小値・最大値を返す。
+	1ピクセル列に1区間を対応させれば、全サンプルを描いた場合と同じ見た目になる。
+	"""
+	if len(data) == 0:
+		return np.zeros(1, np.float32), np.zeros(1, np.float32)
+	columns = max(1, min(columns, len(data)))
+	edges = (np.arange(columns, dtype=np.int64) * len(data)) // columns
+	return np.minimum.reduceat(data, edges), np.maximum.reduceat(data, edges)
+
+def file_hash(file_path):
+	h = hashlib.sha256()
+	with open(file_path, "rb") as f:
+		for block in iter(lambda: f.read(1 << 20), b""):
+			h.update(block)
+	return h.hexdigest()
+
+def load_envelope(file_path, columns=WIDTH_PX, cache_dir=CACHE_DIR):
+	"""
+	包絡線を返す。同じ内容のファイルの結果はキャッシュ（ファイルのハッシュと列数がキー）から読む。
+	:return: (mins, maxs, duration[s])
+	"""
+	cache_path = None
+	if cache_dir:
+		cache_path = os.path.join(cache_dir, f"{file_hash(file_path)}_{columns}.npz")
+		if os.path.exists(cache_path):
+			cached = np.load(cache_path)
+			return cached["mins"], cached["maxs"], float(cached["duration"])
+
+	data, sample_rate = decode_mono(file_path)
+	mins, maxs = compute_envelope(data, columns)
+	duration = len(data) / sample_rate
+	if cache_path:
+		os.makedirs(cache_dir, exist_ok=True)
+		tmp_path = cache_path + ".tmp.npz"
+		np.savez(tmp_path, mins=mins, maxs=maxs, duration=duration)
+		os.replace(tmp_path, cache_path)
+	return mins, maxs, duration
+
+def _draw(ax, mins, maxs, duration, title):
+	x = np.linspace(0, duration, num=len(mins), endpoint=False)
+	ax.fill_between(x, mins, maxs, color='blue', linewidth=0.5)
+	ax.set_title(title)
+	ax.set_xlabel('Time (s)')
+	ax.set_ylabel('Amplitude')
+	ax.set_xlim(0, duration)
+	ax.set_ylim(-1, 1)
+	ax.grid(True)
+
+def render_png(file_path, out_path, width=WIDTH_PX, height=HEIGHT_PX, cache_dir=CACHE_DIR):
+	"""波形を PNG に保存する。画面の無い環境でも動くよう、pyplot を使わずに Agg で描画する"""
+	mins, maxs, duration = load_envelope(file_path, width, cache_dir)
+	fig = Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+	FigureCanvasAgg(fig)
+	_draw(fig.add_subplot(), mins, maxs, duration, os.path.basename(file_path))
+	fig.tight_layout()
+	os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+	fig.savefig(out_path)
+	return out_path
+
+def _render_one(args):
+	"""【ワーカープロセスで実行】失敗しても他のファイルの処理を続けられるよう、例外は文字列で返す"""
+	file_path, out_path, width, height, cache_dir = args
 	try:
-		# ファイル形式を自動判別して読み込み
-		audio = AudioSegment.from_file(file_path)
-		
-		sample_rate = audio.frame_rate
-		mono_audio = audio.set_channels(1)
-		
-		data = np.array(mono_audio.get_array_of_samples())
-
-		# データを[-1, 1]の範囲に正規化
-		if data.dtype == np.int16:
-			data = data.astype(np.float32) / 32768.0
-		elif data.dtype == np.int32:
-			data = data.astype(np.float32) / 2147483648.0
-		else:
-			# 他のデータ型の場合は、最大値で割る
-			max_val = np.iinfo(data.dtype).max
-			if max_val > 0:
-				data = data.astype(np.float32) / max_val
+		return file_path, render_png(file_path, out_path, width, height, cache_dir), None
+	except Exception as e:
+		return file_path, None, str(e)
 
-		time = np.linspace(0, len(data) / sample_rate, num=len(data), endpoint=False)
+def render_directory(directory, out_dir=OUTPUT_DIR, workers=None, width=WIDTH_PX, height=HEIGHT_PX,
+					 cache_dir=CACHE_DIR):
+	"""ディレクトリ内の音声ファイルの波形を並列に PNG へ書き出す。:return: 書き出した PNG のパスのリスト"""
+	files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+				   if name.lower().endswith(AUDIO_EXTENSIONS))
+	jobs = [(path, os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".png"),
+			 width, height, cache_dir) for path in files]
+	logging.info(f"{len(jobs)} 件の音声ファイルの波形を書き出します。")
+	written = []
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for file_path, out_path, error in executor.map(_render_one, jobs):
+			if error:
+				logging.error(f"波形の生成に失敗しました: {file_path}, Error: {error}")
+			else:
+				written.append(out_path)
+	logging.info(f"{len(written)} 件の波形を {out_dir} に保存しました。")
+	return written
+
+def get_audio_waveform(file_path):
+	try:
+		mins, maxs, duration = load_envelope(file_path)
 
 		plt.figure(figsize=(15, 5))
-		plt.plot(time, data, color='blue', linewidth=0.5)
-		plt.title('Audio Waveform')
-		plt.xlabel('Time (s)')
-		plt.ylabel('Amplitude')
-		plt.grid(True)
+		_draw(plt.gca(), mins, maxs, duration, 'Audio Waveform')
 		plt.show()
 	except FileNotFoundError:
 		logging.error(f"ファイルが見つかりません: {file_path}")
@@ -45,9 +142,29 @@ def get_audio_waveform(file_path):
 		logging.error(f"波形生成中に予期せぬエラーが発生しました: {e}")
 
 def main():
+	parser = argparse.ArgumentParser()
 	# このパスはご自身の環境に合わせて変更してください
-	filePath = "output.mp3" # 例としてカレントディレクトリのファイルを指定
-	get_audio_waveform(filePath)
+	parser.add_argument("path", nargs="?", default="output.mp3", help="音声ファイル、または音声ファイルのあるディレクトリ")
+	parser.add_argument("--show", action="store_true", help="PNG に保存せずウィンドウに表示する")
+	parser.add_argument("--out", default=OUTPUT_DIR, help="PNG の保存先ディレクトリ")
+	parser.add_argument("--workers", type=int, default=None)
+	parser.add_argument("--width", type=int, default=WIDTH_PX)
+	parser.add_argument("--height", type=int, default=HEIGHT_PX)
+	parser.add_argument("--cache_dir", default=CACHE_DIR, help="空文字列でキャッシュを使わない")
+	args = parser.parse_args()
+
+	if os.path.isdir(args.path):
+		render_directory(args.path, args.out, args.workers, args.width, args.height, args.cache_dir)
+	elif args.show:
+		get_audio_waveform(args.path)
+	else:
+		out_path = os.path.join(args.out, os.path.splitext(os.path.basename(args.path))[0] + ".png")
+		_, written, error = _render_one((args.path, out_path, args.width, args.height, args.cache_dir))
+		if error:
+			logging.error(f"波形の生成に失敗しました: {args.path}, Error: {error}")
+		else:
+			logging.info(f"波形を保存しました: {written}")
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	setup_logging()
+	main()
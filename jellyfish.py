@@ -1,15 +1,12 @@
 import numpy as np
-import random
 import matplotlib.pyplot as plt
 from time import sleep, perf_counter
-from led import hsv_to_rgb, init_led, fade_out
+from led import hsv_to_rgb_array, init_led, LedEngine
 from play_audio import get_audio_data, play_audio
 from servo import Servo
 from colorsys import rgb_to_hsv 
 import logging
-
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from log_config import setup_logging
 
 ROTATE_SERVO = 12
 VERTICAL_SERVO = 13
@@ -27,33 +24,75 @@ def simulation_motion(bpm, period):
     """
     bpm: 曲のテンポ
     period: 拍の回数
+    :return: 拍ごとのウェイポイント (times[s], angles[deg]) の numpy 配列
     """
     dt = 60 / bpm
     duration = dt * period
-    times = []
-    angles = []
+    times = np.arange(period) * dt
 
     angle_bottom = 90
     angle_top = -75
     amplitude = angle_bottom - angle_top
 
-    elapsed = 0
-    while elapsed < duration:
-        phase = (elapsed % duration) / duration
+    phase = (times % duration) / duration
+    angles = np.where(phase < 0.3,
+                      angle_bottom - amplitude * (1 - (1 - phase / 0.3)**2),
+                      angle_bottom - amplitude * (1 - (phase - 0.3) / 0.7**0.5))
+    return times, angles
 
-        if phase < 0.3:
-            angle = angle_bottom - amplitude * (1 - (1 - phase / 0.3)**2)
-        else:
-            angle = angle_bottom - amplitude * (1 - (phase - 0.3) / 0.7**0.5)
+MOTION_BEATS = 16   # サーボのモーション1周期の拍数
+CHUNK_SECONDS = 0.01    # 各拍で音量を測る区間の長さ
+FOLLOW_POLL_SECONDS = 0.05  # 再生中に再生位置・状態を確認する間隔の上限
 
-        times.append(elapsed)
-        angles.append(angle)
+def compile_show(mono_audio, bpm, min_color, max_color) -> dict:
+    """
+    曲全体の演出（拍ごとのLEDの色とサーボのモーション）を事前に計算する。
 
-        elapsed += dt
+    各拍の先頭 CHUNK_SECONDS 秒の平均振幅を曲の最大振幅で正規化し、
+    min_color〜max_color の間を HSV で補間した色にする。
 
-    return times, angles
+    :return: beat_dt（拍の間隔[s]）, colors（(拍数, 3) の RGB）, motion（(times, angles)）を含む dict
+    """
+    return compile_show_samples(np.array(mono_audio.get_array_of_samples()), mono_audio.frame_rate,
+                                bpm, min_color, max_color)
+
+def compile_show_samples(samples, sample_rate, bpm, min_color, max_color) -> dict:
+    """compile_show() のサンプル配列版（offload のワーカーから呼ばれる）"""
+    min_hsv = rgb_to_hsv(*hex_to_rgb(min_color))
+    max_hsv = rgb_to_hsv(*hex_to_rgb(max_color))
+
+    full_scale = np.iinfo(samples.dtype).max
+    # 整数のまま abs を取ると最小値（int16 の -32768）が負のまま残るため、浮動小数点にしてから取る
+    amplitudes = np.abs(samples.astype(np.float64))
+    # 累積和から各区間の平均振幅をまとめて求める
+    cumulative = np.concatenate([[0.0], np.cumsum(amplitudes)]) / full_scale
+    actual_max_amplitude = np.max(amplitudes) / full_scale if len(samples) else 0.0
+    if actual_max_amplitude == 0:
+        actual_max_amplitude = 1.0 # 無音ファイルの場合のゼロ除算を防ぐ
 
-def led_blink_reflect_music(led, mono_audio, bpm, play_obj, min_color, max_color):
+    beat_dt = 60 / bpm
+    chunk_size = max(int(sample_rate * CHUNK_SECONDS), 1)
+    starts = (np.arange(0.0, len(samples) / sample_rate, beat_dt) * sample_rate).astype(np.int64)
+    starts = starts[starts < len(samples)]
+    ends = np.minimum(starts + chunk_size, len(samples))
+    amplitude = (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+    normalized_amplitude = np.clip(np.sqrt(amplitude / actual_max_amplitude), 0.0, 1.0)
+    hue = lerp(min_hsv[0], max_hsv[0], normalized_amplitude)
+    saturation = lerp(min_hsv[1], max_hsv[1], normalized_amplitude)
+    value = lerp(min_hsv[2], max_hsv[2], normalized_amplitude)
+
+    return {
+        "beat_dt": beat_dt,
+        "colors": hsv_to_rgb_array(hue, saturation, value),
+        "motion": simulation_motion(bpm, MOTION_BEATS),
+    }
+
+def led_blink_reflect_music(led, mono_audio, bpm, play_obj, min_color, max_color, show=None):
+    """
+    led: LedEngine。色の更新とフェードはエンジンのスレッドで行われるため、この関数はブロックしない。
+    show: compile_show() の結果。省略した場合はここで計算する
+    """
     vertical = Servo(VERTICAL_SERVO)
 
     # ledがNoneの場合、何もしない
@@ -63,74 +102,67 @@ def led_blink_reflect_music(led, mono_audio, bpm, play_obj, min_color, max_color
         play_obj.wait_done()
         return
 
-    min_rgb = hex_to_rgb(min_color)
-    max_rgb = hex_to_rgb(max_color)
-    min_hsv = rgb_to_hsv(*min_rgb)
-    max_hsv = rgb_to_hsv(*max_rgb)
+    if show is None:
+        show = compile_show(mono_audio, bpm, min_color, max_color)
+    follow_track(led, vertical, show, play_obj)
 
-    samples = np.array(mono_audio.get_array_of_samples())
-    samples = samples.astype(np.float32) / np.iinfo(samples.dtype).max
-
-    actual_max_amplitude = np.max(np.abs(samples))
-    if actual_max_amplitude == 0:
-        actual_max_amplitude = 1.0 # 無音ファイルの場合のゼロ除算を防ぐ
+    # フェードアウトはLEDエンジンに任せ、サーボはすぐに解放する
+    led.fade_out(3)
+    vertical.close()
 
-    sample_rate = mono_audio.frame_rate
-    chunk_size = int(sample_rate * 0.01)
+def follow_track(led, vertical, show, play_obj, crossfade=0.0):
+    """
+    再生中の1曲に合わせてLEDとサーボを動かす（play_obj.is_playing() の間ブロックする）。
+    crossfade > 0 の場合は、直前のLEDの演出から crossfade 秒かけて切り替える
+    """
+    beat_dt = show["beat_dt"]
+    times, angles = show["motion"]
 
-    current_time = 0
+    # 再生位置が取れる場合（CallbackPlayer）はそれに合わせ、取れない場合は経過時間で代用する
+    if hasattr(play_obj, "position"):
+        clock = play_obj.position
+    else:
+        start_time = perf_counter()
+        clock = lambda: perf_counter() - start_time
 
-    current_hue = random.random()
+    # 拍ごとの色はLEDエンジンがフレーム列として再生する
+    if led is not None:
+        led.play_frames(show["colors"], beat_dt, crossfade=crossfade,
+                        clock=clock if hasattr(play_obj, "position") else None)
 
-    tempo_count = 0
+    cycle = -1
     while play_obj.is_playing():
-        if tempo_count == 0 or tempo_count % 16 == 0:
-            times, angles = simulation_motion(bpm, 16)
-            vertical.move_with_profile(times, angles)
-
-        tempo_count += 1
-        start_time = perf_counter()
-        current_sample = int(current_time * sample_rate)
-
-        chunk_start = current_sample
-        chunk_end = min(current_sample + chunk_size, len(samples))
-        if chunk_start >= chunk_end:
+        beat = int(clock() / beat_dt)
+        if beat >= len(show["colors"]):
             break
+        if beat // MOTION_BEATS != cycle:
+            cycle = beat // MOTION_BEATS
+            vertical.move_with_profile(times, angles)
+        # 次の拍までの待ち時間を時計から求め、ずれが蓄積しないようにする
+        # 曲の切り替え・停止にすぐ気付けるように、待ち時間は FOLLOW_POLL_SECONDS までにする
+        sleep(min(beat_dt, FOLLOW_POLL_SECONDS, max(0.001, (beat + 1) * beat_dt - clock())))
 
-        chunk = samples[chunk_start:chunk_end]
-
-        amplitude = np.mean(np.abs(chunk))
-
-        normalized_amplitude = amplitude / actual_max_amplitude
-        normalized_amplitude = np.sqrt(normalized_amplitude)
-        normalized_amplitude = max(0.0, min(1.0, normalized_amplitude))
-
-        hue = lerp(min_hsv[0], max_hsv[0], normalized_amplitude, )
-        saturation = lerp(min_hsv[1], max_hsv[1], normalized_amplitude)
-        value = lerp(min_hsv[2], max_hsv[2], normalized_amplitude)
-
-        current_hue = current_hue + (random.random() - 0.5) * 0.01
-        if current_hue < 0:
-            current_hue += 1.0
-        elif current_hue > 1.0:
-            current_hue -= 1.0
-
-        led.color = hsv_to_rgb(hue, saturation, value)
-
-        end_time = perf_counter()
-        elapsed_time = (end_time - start_time) / 60
-        sleep_time = 60 / bpm - elapsed_time
-        current_time = current_time + (sleep_time + elapsed_time)
-        sleep(sleep_time)
-
-    fade_out(led, 3)
-    vertical.close()
+def led_follow_playlist(led, tracks):
+    """
+    tracks: (演出データ, playback.PlaylistTrack) を曲が切り替わる順に返すイテラブル。
+    曲の変わり目では音声のクロスフェードに合わせてLEDもクロスフェードし、最後の曲の後にだけフェードアウトする
+    """
+    vertical = Servo(VERTICAL_SERVO)
+    try:
+        for show, track in tracks:
+            follow_track(led, vertical, show, track, crossfade=track.fade_in_seconds)
+    finally:
+        if led is not None:
+            led.fade_out(3)
+        vertical.close()
 
 def main():
     led = None
     try:
-        led = init_led()
-        
+        led_strip = init_led()
+        if led_strip:
+            led = LedEngine(led_strip)
+
         audio_data = get_audio_data()
         if audio_data is None:
             logging.error("音声データの取得に失敗しました。")
@@ -159,7 +191,9 @@ def main():
         logging.error(f"エラーが発生しました: {e}")
     finally:
         if led:
-            led.off()
+            led.wait_idle(5)
+            led.close()
         
 if __name__=="__main__":
+        setup_logging()
         main()
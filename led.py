@@ -1,16 +1,21 @@
 from gpiozero import RGBLED
 from gpiozero.pins.pigpio import PiGPIOFactory
-from time import sleep
+from time import sleep, perf_counter
 from colorsys import rgb_to_hsv
+from functools import lru_cache
+import numpy as np
+import threading
+import queue
 import logging
-
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from log_config import setup_logging
 
 PIN_RED=17
 PIN_GREEN=27
 PIN_BLUE=22
 
+GAMMA = 2.2
+GAMMA_LUT_SIZE = 1024
+
 def init_led():
     try:
         factory=PiGPIOFactory()
@@ -36,6 +41,19 @@ def hsv_to_rgb(h, s, v):
     if i == 4: return (t, p, v)
     if i == 5: return (v, p, q)
 
+def hsv_to_rgb_array(h, s, v):
+    """hsv_to_rgb の配列版。h, s, v は同じ長さの配列で、(N, 3) の RGB を返す"""
+    h, s, v = np.broadcast_arrays(np.asarray(h, dtype=np.float64), np.asarray(s, dtype=np.float64),
+                                  np.asarray(v, dtype=np.float64))
+    i = (h * 6).astype(np.int64)
+    f = h * 6 - i
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    i %= 6
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    return np.stack([r, g, b], axis=-1)
+
 def fade_out(led, duration, steps=100):
     step_size = 1.0 / steps
     delay_per_step = duration / steps
@@ -51,6 +69,236 @@ def fade_out(led, duration, steps=100):
     
     led.off()
 
+def build_gamma_lut(gamma=GAMMA, size=GAMMA_LUT_SIZE):
+    """知覚上の明るさ(0-1)をPWMのデューティ比(0-1)に変換するテーブルを作る"""
+    return np.linspace(0.0, 1.0, size) ** gamma
+
+@lru_cache(maxsize=64)
+def effect_curve(name, steps):
+    """
+    0→1 の補間カーブを事前計算して返す（同じ長さ・種類は再利用する）。
+
+    - name: "linear" | "ease" | "ease_in" | "ease_out" | "pulse"
+    - steps: サンプル数
+    """
+    t = np.linspace(0.0, 1.0, max(steps, 1))
+    if name == "linear":
+        curve = t
+    elif name == "ease":
+        curve = t * t * (3.0 - 2.0 * t)
+    elif name == "ease_in":
+        curve = t * t
+    elif name == "ease_out":
+        curve = 1.0 - (1.0 - t) ** 2
+    elif name == "pulse":
+        curve = 0.5 - 0.5 * np.cos(2.0 * np.pi * t)
+    else:
+        raise ValueError(f"unknown curve: {name}")
+    curve.setflags(write=False)
+    return curve
+
+class LedEngine:
+    """
+    別スレッドの一定周期ループでLEDエフェクトを再生するエンジン。
+
+    呼び出し側はコマンドをキューに積むだけでブロックしない。
+    新しいエフェクトは再生中のエフェクトを置き換える。
+    エフェクトは事前計算したカーブから (N, 3) のフレーム列として作り、
+    出力時にガンマ補正テーブルを通す。現在色はハードウェアから読み戻さず、
+    エンジン内で保持する。
+    """
+    def __init__(self, led, update_dt=1.0/100, gamma=GAMMA):
+        self.led = led
+        self.update_dt = update_dt
+        self._lut = build_gamma_lut(gamma)
+        self._color = np.zeros(3)   # 現在色（ガンマ補正前, 0-1）
+        self._written = None        # 最後にLEDへ書き込んだ値
+        self._frames = None         # 再生中のフレーム列（ガンマ補正前）
+        self._output = None         # 同フレーム列のガンマ補正後
+        self._frame_index = 0
+        self._loop_frames = False
+        self._clock = None          # フレームの位置を決める外部の時計（None なら周期ごとに1つ進む）
+
+        self._commands = queue.Queue()
+        self._idle = threading.Event()
+        self._idle.set()
+        # _put の「_idle を下ろしてから積む」と、ループの「キューが空なら _idle を立てる」を互いに割り込ませない
+        self._idle_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="led-engine", daemon=True)
+        self._thread.start()
+
+    @property
+    def color(self):
+        """現在色 (r, g, b)。ガンマ補正前の値"""
+        return tuple(self._color.tolist())
+
+    def close(self, off=True):
+        self._commands.put(None)
+        self._thread.join(timeout=1.0)
+        if off and self.led:
+            self.led.off()
+
+    def wait_idle(self, timeout=None):
+        """キューとエフェクトがすべて終わるまで待つ"""
+        return self._idle.wait(timeout)
+
+    def set_color(self, rgb):
+        self._put("set", tuple(rgb))
+
+    def off(self):
+        self._put("set", (0.0, 0.0, 0.0))
+
+    def stop(self):
+        """再生中・待機中のエフェクトを破棄して現在色で止める"""
+        self._put("stop")
+
+    def fade_to(self, rgb, duration, curve="ease"):
+        self._put("fade", tuple(rgb), duration, curve)
+
+    def fade_out(self, duration, curve="linear"):
+        self._put("fade", (0.0, 0.0, 0.0), duration, curve)
+
+    def crossfade(self, from_rgb, to_rgb, duration, curve="ease"):
+        self._put("set", tuple(from_rgb))
+        self._put("fade", tuple(to_rgb), duration, curve)
+
+    def pulse(self, rgb, period, count=1):
+        """現在色から rgb へ往復する明滅を count 回行う"""
+        self._put("pulse", tuple(rgb), period, count)
+
+    def play_frames(self, frames, frame_dt, loop=False, crossfade=0.0, clock=None):
+        """
+        (N, 3) のフレーム列を frame_dt 間隔で再生する。
+
+        crossfade > 0 の場合は、直前のエフェクトから crossfade 秒かけて滑らかに切り替える。
+        clock を渡すと、毎周期 clock()（再生開始からの秒数, 例: CallbackPlayer.position）で
+        表示するフレームを決める。音声の一時停止やシーク、出力遅延に追従する。
+        """
+        frames = np.clip(np.asarray(frames, dtype=np.float64).reshape(-1, 3), 0.0, 1.0)
+        self._put("frames", frames, frame_dt, loop, crossfade, clock)
+
+    def _put(self, *command):
+        with self._idle_lock:
+            self._idle.clear()
+            self._commands.put(command)
+
+    def _to_output(self, frames):
+        index = np.rint(frames * (len(self._lut) - 1)).astype(np.intp)
+        return self._lut[index]
+
+    def _steps(self, duration):
+        return max(int(round(duration / self.update_dt)), 1)
+
+    def _start(self, frames, loop=False, clock=None):
+        self._frames = frames
+        self._output = self._to_output(frames)
+        self._frame_index = 0
+        self._loop_frames = loop
+        self._clock = clock
+
+    def _remaining_frames(self, steps):
+        """現在のエフェクトの続きを steps 個取り出す（無い場合は現在色で埋める）"""
+        if self._frames is None:
+            return np.tile(self._color, (steps, 1))
+        index = self._frame_index + np.arange(steps)
+        if self._loop_frames:
+            index %= len(self._frames)
+        else:
+            index = np.minimum(index, len(self._frames) - 1)
+        return self._frames[index]
+
+    def _apply(self, command):
+        kind = command[0]
+        if kind == "set":
+            self._color = np.array(command[1], dtype=np.float64)
+            self._start(self._color[None, :])
+        elif kind == "stop":
+            self._frames = None
+            self._output = None
+        elif kind == "fade":
+            _, rgb, duration, curve = command
+            c = effect_curve(curve, self._steps(duration))[:, None]
+            self._start(self._color + (np.asarray(rgb) - self._color) * c)
+        elif kind == "pulse":
+            _, rgb, period, count = command
+            c = effect_curve("pulse", self._steps(period))[:, None]
+            one = self._color + (np.asarray(rgb) - self._color) * c
+            self._start(np.tile(one, (max(count, 1), 1)))
+        elif kind == "frames":
+            _, frames, frame_dt, loop, crossfade, clock = command
+            # 再生周期に合わせてフレーム列をリサンプリング
+            n_out = max(int(round(len(frames) * frame_dt / self.update_dt)), 1)
+            index = np.minimum((np.arange(n_out) * self.update_dt / frame_dt).astype(np.intp), len(frames) - 1)
+            frames = frames[index]
+            if crossfade > 0:
+                n = min(self._steps(crossfade), len(frames))
+                c = effect_curve("ease", n)[:, None]
+                frames = frames.copy()
+                frames[:n] = self._remaining_frames(n) * (1.0 - c) + frames[:n] * c
+            self._start(frames, loop, clock)
+
+    def _clock_index(self):
+        """外部の時計から表示するフレームの位置を求める（ループしない場合は末尾を超えると終了）"""
+        try:
+            index = max(int(self._clock() / self.update_dt), 0)
+        except Exception as e:
+            logging.error(f"LEDの同期用の時計の取得に失敗しました: {e}")
+            self._clock = None
+            return self._frame_index
+        if self._loop_frames:
+            return index % len(self._frames)
+        return min(index, len(self._frames) - 1)
+
+    def _loop(self):
+        next_tick = perf_counter()
+        while True:
+            commands = []
+            # エフェクトが無いときはコマンドが来るまでブロックする
+            with self._idle_lock:
+                waiting = self._frames is None and self._commands.empty()
+                if waiting:
+                    self._idle.set()
+            if waiting:
+                commands.append(self._commands.get())
+                self._idle.clear()
+                next_tick = perf_counter()
+            while True:
+                try:
+                    commands.append(self._commands.get_nowait())
+                except queue.Empty:
+                    break
+            for command in commands:
+                if command is None:
+                    return
+                self._apply(command)
+
+            if self._frames is not None:
+                if self._clock is not None:
+                    self._frame_index = self._clock_index()
+                i = self._frame_index
+                self._color = self._frames[i]
+                output = self._output[i]
+                if self._written is None or not np.array_equal(output, self._written):
+                    try:
+                        self.led.color = tuple(output.tolist())
+                        self._written = output
+                    except Exception as e:
+                        logging.error(f"LEDの更新に失敗しました: {e}")
+                self._frame_index += 1
+                if self._frame_index >= len(self._frames):
+                    if self._loop_frames:
+                        self._frame_index = 0
+                    else:
+                        self._frames = None
+                        self._output = None
+
+            next_tick += self.update_dt
+            delay = next_tick - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_tick = perf_counter()
+
 def main():
     led = init_led()
     if led is None:
@@ -112,4 +360,5 @@ def main():
         print("Program finished.")
 
 if __name__=="__main__":
+    setup_logging()
     main()
@@ -0,0 +1,126 @@
+"""
+アプリケーション全体のログ設定。
+
+各スレッド（録音コールバック、LED・サーボのループなど）は QueueHandler でレコードをキューに積むだけにし、
+コンソールや journald への書き込みは QueueListener のスレッドで行う。
+同じ呼び出し箇所から短時間に大量に出るログは RateLimitFilter で間引き、間引いた件数を次のレコードに付ける。
+
+エントリポイント（main.py や各モジュールの __main__）で setup_logging() を1回呼ぶ。
+ライブラリとして読み込まれるモジュールではログの設定を行わない。
+
+    LOG_LEVEL=WARNING python main.py        # 本番では INFO 以下を出さない
+    python main.py --log_level DEBUG --log_format json
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+RATE_LIMIT_INTERVAL = 10.0  # 呼び出し箇所ごとの集計期間[s]
+RATE_LIMIT_BURST = 20       # 集計期間内に通すレコード数
+
+class RateLimitFilter(logging.Filter):
+    """
+    呼び出し箇所（ファイル名と行番号）ごとに、interval 秒あたり burst 件を超えたレコードを捨てる。
+    捨てた件数は、その箇所で次に通したレコードの suppressed 属性に入れる。CRITICAL は常に通す。
+    """
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._sites = {}    # (pathname, lineno) -> [期間の開始時刻, 通した件数, 捨てた件数]
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.interval:
+                suppressed = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                suppressed, site[2] = site[2], 0
+            else:
+                site[2] += 1
+                return False
+        record.suppressed = suppressed
+        return True
+
+class TextFormatter(logging.Formatter):
+    """従来の形式に、間引いた件数を付け加える"""
+    def format(self, record):
+        message = super().format(record)
+        if getattr(record, "suppressed", 0):
+            message += f" (同じ箇所のログを {record.suppressed} 件省略)"
+        return message
+
+class JsonFormatter(logging.Formatter):
+    """
+    1レコード1行の JSON（journald や収集基盤で扱いやすい形式）。
+    例外のトレースバックは QueueHandler がキューに積む時点で message に含めている。
+    """
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "thread": record.threadName,
+            "site": f"{record.module}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        return json.dumps(entry, ensure_ascii=False)
+
+_listener = None
+
+def setup_logging(level=None, log_format=FORMAT_TEXT, stream=None,
+                  rate_interval=RATE_LIMIT_INTERVAL, rate_burst=RATE_LIMIT_BURST):
+    """
+    ルートロガーを QueueHandler に切り替え、出力は QueueListener のスレッドで行う。
+    2回目以降の呼び出しでは設定をやり直す。
+
+    :param level: ログレベル（省略時は環境変数 LOG_LEVEL、既定は INFO）
+    :param log_format: "text" または "json"
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == FORMAT_JSON else TextFormatter(LOG_FORMAT))
+
+    handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    handler.addFilter(RateLimitFilter(rate_interval, rate_burst))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    level = level or LOG_LEVEL
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def shutdown_logging():
+    """キューに残ったレコードを書き出してからリスナーを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
@@ -1,181 +1,680 @@
 import logging
 import time
 import threading
-import queue
-from pydub import AudioSegment
+import os
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
 # プロジェクト内のモジュール
 import bme280_sample
 import tsl2572_sample
-from record_sample import record_audio
-from api import post_data, get_task, get_mock_task, get_status
-from led import init_led
-from play_audio import get_audio_data, play_audio
-from jellyfish import led_blink_reflect_music
-from switch import setup_switch
-from servo import Servo
+from record_sample import CHANNELS, RATE
+from activity import LevelMonitor
+from audio_profile import PROFILES, DEFAULT_PROFILE
+from capture_pipeline import CapturePipeline, POLICY_DROP_OLDEST, POLICY_BLOCK
+from spool import UploadSpool, SpoolUploader, SPOOL_DIR, SPOOL_MAX_BYTES
+from sensor_archive import SensorArchive, ARCHIVE_DIR, ARCHIVE_MAX_BYTES
+import api
+from api import post_data, get_task_status, download_task_result
+from mock_cache import MockTrackCache
+from push_channel import TaskEventChannel
+from poll_scheduler import PollScheduler
+from led import init_led, LedEngine
+import play_audio as play_audio_module
+from play_audio import play_audio, play_audio_stream, decode_preview, PREVIEW_RATE
+import offload
+from jellyfish import led_blink_reflect_music, led_follow_playlist, compile_show_samples
+from playback import PlaylistPlayer, CROSSFADE_SECONDS
+from playlist import Playlist, PLAYLIST_MEMORY_BYTES
+from switch import setup_switch, SwitchDispatcher, GESTURE_SHORT, GESTURE_LONG, GESTURE_DOUBLE
+from servo import Servo, HOLD_SECONDS
+from profiler_hooks import ProfilerHooks
+from trace_harness import TraceRecorder
+from log_config import setup_logging, FORMAT_TEXT, FORMAT_JSON
+from echo_cancel import PlaybackReference, DuplexEchoCanceller
+from deadline import Deadline, Cancelled
+import memory_budget as memory_budget_module
+from memory_budget import MemoryBudget, measure, estimate_playback_bytes, rss_bytes, available_bytes
 
 # --- 設定項目 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-WAVE_OUTPUT_FILENAME = "output.wav"
-MP3_OUTPUT_FILENAME = "output.mp3"
 RECORDING_SECONDS = 60
+# 録音済みウィンドウのエンコード・送信
+CAPTURE_WORKERS = 1
+CAPTURE_QUEUE_SIZE = 2
+STATS_LOG_INTERVAL = 60
+MAIN_LOOP_INTERVAL = 0.2
+# 生成された音声のキャッシュ
+RESULT_CACHE_DIR = "cache"
+RESULT_CACHE_MAX_MB = 200    # 超えた場合は最も長く使われていない結果から削除する
+# 送信待ちデータのディスクスプール
+SPOOL_MAX_MB = SPOOL_MAX_BYTES // (1024 * 1024)
+# センサーと音量の履歴
+ARCHIVE_MAX_MB = ARCHIVE_MAX_BYTES // (1024 * 1024)
+# 有音判定（設置場所ごとにコマンドライン引数で調整する）
+ACTIVITY_MARGIN_DB = 10.0
+ACTIVITY_MIN_RATIO = 0.05
+# スイッチを押してから再生を始めるまでの上限（タスクの確認・結果の取得・デコード）。README を参照
+PRESS_DEADLINE_SECONDS = 5.0
+STATUS_TIMEOUT = 2.0    # タスクのステータス確認1回あたりのタイムアウト
+# 完了したタスクを続けて再生するプレイリスト（--playlist）
+PLAYLIST_MEMORY_MB = PLAYLIST_MEMORY_BYTES // (1024 * 1024)
+# 再生経路のメモリの上限（0 ならシステムの空きメモリだけを見る）
+MEMORY_BUDGET_MB = 0
 
 # --- グローバル変数 ---
 led_strip = None
+led_engine = None
 task_ids = []
-recording_thread = None
-stop_recording_event = threading.Event()
-event_queue = queue.Queue()
+completed_task_ids = set()
+rotate = None
+task_events = None
+poll_scheduler = PollScheduler()  # プッシュ通知が使えない間のステータス確認の予定
+prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-prefetch")
+result_fetch_lock = threading.Lock()
+mock_cache = None
+capture = None
+spool = None
+uploader = None
+level_monitor = None
+archive = None      # センサーと音量の履歴（SensorArchive）
+echo_canceller = None   # --duplex の場合の DuplexEchoCanceller
+memory_budget = MemoryBudget()  # 曲をデコードする前に、必要なメモリを確保できるかを確認する
+capture_profile = PROFILES[DEFAULT_PROFILE]
+switch_dispatcher = None
+now_playing = None      # 再生中の再生オブジェクト（スイッチで止めるため）
+last_played = None      # 最後に再生したタスク (key, task_info, audio_path, track)
+playlist_mode = False   # --playlist の場合 True
+crossfade_seconds = CROSSFADE_SECONDS
+playlist_memory_bytes = PLAYLIST_MEMORY_BYTES
+trace = None    # --trace_record で記録する場合の TraceRecorder
+result_cache_max_bytes = RESULT_CACHE_MAX_MB * 1024 * 1024
 
-def wav_to_mp3(wav_path: str, mp3_path: str) -> bool:
-    logging.info(f"{wav_path} を {mp3_path} に変換します...")
+def result_cache_path(task_id) -> str:
+    return os.path.join(RESULT_CACHE_DIR, f"{task_id}.mp3")
+
+def evict_result_cache(keep=None):
+    """
+    結果のキャッシュ（途中まで取得した .part を含む）の合計が result_cache_max_bytes を超えていれば、
+    更新時刻（使った時刻）の古いものから削除する。keep と最後に再生した曲は残す
+    """
+    protected = {keep, last_played[2] if last_played else None}
+    files = []
+    for name in os.listdir(RESULT_CACHE_DIR):
+        if not (name.endswith(".mp3") or name.endswith(".mp3.part")):
+            continue
+        path = os.path.join(RESULT_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= result_cache_max_bytes:
+            break
+        if path in protected:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        logging.info(f"結果のキャッシュが上限を超えたため削除しました: {path} ({size} bytes)")
+
+def fetch_task_result(task_id, deadline=None) -> str | None:
+    """
+    タスクの結果の音声をキャッシュに用意してパスを返す（途中まで取得済みなら続きから再開する）。
+    deadline を過ぎた場合はダウンロードを途中で止めて Cancelled を送出する（続きは次回に再開できる）
+    """
+    path = result_cache_path(task_id)
+    # 先読みと再生で同じファイルに同時に書き込まないようにする
+    if not result_fetch_lock.acquire(timeout=-1 if deadline is None else deadline.remaining()):
+        raise Cancelled("結果の取得: 先読みの完了を待てませんでした")
     try:
-        audio = AudioSegment.from_wav(wav_path)
-        audio.export(mp3_path, format="mp3")
-        logging.info("変換が完了しました。")
-        return True
-    except Exception as e:
-        logging.error(f"MP3への変換中にエラーが発生しました: {e}")
-        return False
+        if os.path.exists(path):
+            os.utime(path)  # 最近使った結果として削除を後回しにする
+            return path
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        if download_task_result(task_id, path, deadline=deadline):
+            logging.info(f"結果をキャッシュに保存しました: {path}")
+            evict_result_cache(keep=path)
+            return path
+    finally:
+        result_fetch_lock.release()
+    if deadline is not None:
+        deadline.check("結果の取得")
+    return None
 
-def play_completed_task(led_strip, task_id, response: dict):
+def play_completed_task(led_engine, task_id, response: dict, audio_path: str | None = None,
+                        audio_data=None, show=None, deadline=None):
+    """
+    audio_data（デコード済み）, audio_path（キャッシュ済みのファイル）, response の base64 の順に
+    使える音声を再生する。show は演出データ（jellyfish.compile_show の結果）。
+    デコードと演出の計算はワーカープロセス（offload）で行い、deadline までに終わらなければ再生しない。
+    デコードするとメモリの上限を超える曲は、ファイルがあればデコードしながら再生し、無ければ再生しない
+    """
     logging.info(f"タスク再生開始: {task_id}")
+    started = time.monotonic()
     try:
-        base64_audio_data = response.get('result')
-        if not base64_audio_data: return
-        audio_data = get_audio_data(base64_audio_data)
-        if not audio_data: return
-        play_obj = play_audio(audio_data)
-        if not play_obj: return
         bpm = response.get("bpm", 60)
         min_color = response.get("min_color", "#000000")
         max_color = response.get("max_color", "#ffffff")
-        led_blink_reflect_music(led_strip, audio_data, bpm, play_obj, min_color, max_color)
+        if audio_data is not None:
+            if show is None:
+                show = offload.compile_show(audio_data, bpm, min_color, max_color)
+        elif audio_path:
+            if not memory_budget.allows(estimate_playback_bytes(path=audio_path)):
+                logging.warning(f"タスク {task_id} はデコードするとメモリの上限を超えるため、デコードしながら再生します。")
+                if play_streamed(led_engine, audio_path, bpm, min_color, max_color):
+                    logging.info("再生が完了しました。")
+                    if trace:
+                        trace.record("playback", task_id=task_id, seconds=time.monotonic() - started)
+                return
+            with measure("decode"):
+                audio_data, show = offload.decode_track(path=audio_path, bpm=bpm, min_color=min_color,
+                                                        max_color=max_color, deadline=deadline)
+        else:
+            base64_audio_data = response.get('result')
+            if not base64_audio_data: return
+            if not memory_budget.allows(estimate_playback_bytes(encoded_bytes=len(base64_audio_data) * 3 // 4)):
+                logging.warning(f"タスク {task_id} の音声はデコードするとメモリの上限を超えるため、再生しません。")
+                return
+            with measure("decode"):
+                audio_data, show = offload.decode_track(base64_data=base64_audio_data, bpm=bpm,
+                                                        min_color=min_color, max_color=max_color, deadline=deadline)
+        if not audio_data: return
+        global now_playing
+        with measure("play_audio"):
+            play_obj = play_audio(audio_data)
+        if not play_obj: return
+        now_playing = play_obj
+        with measure("led_blink_reflect_music"):
+            led_blink_reflect_music(led_engine, audio_data, bpm, play_obj, min_color, max_color, show)
         logging.info("再生が完了しました。")
+        if trace:
+            trace.record("playback", task_id=task_id, seconds=time.monotonic() - started)
+    except Cancelled as e:
+        logging.warning(f"再生の準備が期限までに終わらなかったため中止しました: {e}")
     except Exception as e:
         logging.error(f"音声・LEDの再生中にエラーが発生しました: {e}")
+    finally:
+        now_playing = None
 
-def record_and_post_data():
-    """【別スレッドで実行】録音、センサーデータ取得、API投稿を行う"""
-    stop_recording_event.clear()
+def play_streamed(led_engine, audio_path, bpm, min_color, max_color):
+    """
+    audio_path をデコードしながら再生する（曲全体をメモリに載せない）。
+    演出は低いサンプリング周波数でデコードした音声から計算する。:return: 再生できた場合 True
+    """
+    global now_playing
+    samples = decode_preview(audio_path)
+    if samples is None:
+        return False
+    show = compile_show_samples(samples, PREVIEW_RATE, bpm, min_color, max_color)
+    with measure("play_audio_stream"):
+        play_obj = play_audio_stream(audio_path, duration=len(samples) / PREVIEW_RATE)
+    if not play_obj:
+        return False
+    now_playing = play_obj
+    with measure("led_blink_reflect_music"):
+        led_blink_reflect_music(led_engine, None, bpm, play_obj, min_color, max_color, show)
+    if play_obj.metrics["underruns"]:
+        logging.warning(f"デコードが再生に間に合わなかったバッファ: {play_obj.metrics['underruns']} 件")
+    return True
 
-    logging.info("録音スレッド: 処理を開始します。")
-    record_status = record_audio(RECORDING_SECONDS, WAVE_OUTPUT_FILENAME, stop_recording_event)
+def prepare_track(entry, deadline=None):
+    """
+    【先読みのスレッドで実行】プレイリストの1曲 entry = (key, task_info, audio_path, track) を用意する。
+    task_info が無いタスクは完了しているかを確認する。
+    :return: (用意した entry, AudioSegment, 演出データ)。再生できない場合は None
+    """
+    key, task_info, audio_path, track = entry
+    if track:
+        return entry, track.audio, track.show
+    if task_info is None:
+        task_info = get_task_status(key, timeout=STATUS_TIMEOUT)
+        if not task_info or task_info.get("status") != "completed":
+            return None
+        poll_scheduler.complete(key, polled=True)
+    if audio_path is None:
+        audio_path = fetch_task_result(key, deadline)
+        if not audio_path:
+            return None
+    if not memory_budget.allows(estimate_playback_bytes(path=audio_path)):
+        logging.warning(f"タスク {key} はデコードするとメモリの上限を超えるため、プレイリストから外します。")
+        return None
+    with measure("decode"):
+        audio, show = offload.decode_track(path=audio_path, bpm=task_info.get("bpm", 60),
+                                           min_color=task_info.get("min_color", "#000000"),
+                                           max_color=task_info.get("max_color", "#ffffff"), deadline=deadline)
+    if audio is None:
+        return None
+    return (key, task_info, audio_path, None), audio, show
 
-    if record_status == 'interrupted':
-        logging.info("録音スレッド: 録音が中断されたため終了します。")
+def play_playlist(entries, deadline=None):
+    """
+    entries を1本のストリームで続けて再生する。1曲目は deadline までに用意し、
+    2曲目以降は再生中に先読みする。曲の変わり目は音声とLEDをクロスフェードする
+    """
+    global now_playing, last_played
+    try:
+        first = prepare_track(entries[0], deadline)
+    except Cancelled as e:
+        logging.warning(f"再生の準備が期限までに終わらなかったため中止しました: {e}")
         return
-    if record_status == 'error':
-        logging.error("録音スレッド: 録音に失敗しました。")
+    if first is None:
+        logging.info("プレイリストの1曲目を用意できませんでした。")
         return
+    _, audio, _ = first
+    player = PlaylistPlayer(audio.channels, audio.frame_rate, crossfade=crossfade_seconds,
+                            frames_per_buffer=play_audio_module.PLAYBACK_FRAMES_PER_BUFFER,
+                            reference=play_audio_module.PLAYBACK_REFERENCE)
+    playlist = Playlist(player, prepare_track, entries[1:], playlist_memory_bytes).start(first)
+    # 1曲目の PCM はプレイヤーに渡したので、AudioSegment はプレイリストの再生中まで持たない
+    del first, audio
+    logging.info(f"プレイリスト: {len(entries)} 曲の再生を開始します。")
+
+    def tracks():
+        global last_played
+        for entry, show, track in playlist:
+            logging.info(f"プレイリスト: {entry[0]} を再生します。(クロスフェード {track.fade_in_seconds:.1f}秒)")
+            last_played = entry
+            yield show, track
+
+    now_playing = player
+    try:
+        player.start()
+        led_follow_playlist(led_engine, tracks())
+        player.wait_done()
+        logging.info(f"プレイリストの再生を{'停止' if player.stopped else '完了'}しました。{player.metrics} {playlist.metrics}")
+    except Exception as e:
+        logging.error(f"プレイリストの再生中にエラーが発生しました: {e}")
+    finally:
+        player.stop()
+        now_playing = None
+
+def encode_and_spool_window(window) -> bool:
+    """【ワーカースレッドで実行】録音済みウィンドウを変換し、センサーデータと共にスプールに積む"""
+    logging.info(f"ワーカー: ウィンドウ #{window.seq} ({window.seconds:.1f}秒) の処理を開始します。")
+    started = time.monotonic()
+    queued_seconds = max(0.0, time.time() - (window.started_at + window.seconds))
+    data = window.data
+    if window.activity is not None:
+        data = level_monitor.trim_bytes(data, window.activity, 2 * window.channels)
+
+    # 形式の変換とエンコードはワーカープロセスで行う（PCM は共有メモリで渡す）
+    # 期限切れ・取り消しの場合は一時ファイルを消し、スプールには何も残さない
+    deadline = window.deadline or Deadline()
+    encoded_path = spool.temp_path(capture_profile.extension)
+    try:
+        if not offload.encode_pcm(data, window.channels, window.rate, capture_profile, encoded_path,
+                                  deadline=deadline):
+            logging.error("ワーカー: MP3への変換に失敗しました。")
+            if os.path.exists(encoded_path):
+                os.remove(encoded_path)
+            return False
+
+        bme_data = bme280_sample.readData()
+        tsl_data = tsl2572_sample.readData()
+        archive_sensors(bme_data, tsl_data)
+        deadline.check("センサーの読み取り")
+    except Cancelled:
+        if os.path.exists(encoded_path):
+            os.remove(encoded_path)
+        raise
+
+    # 送信はスプールのアップローダーが行うため、ネットワークの状態に関係なくすぐに戻る
+    entry_id = spool.put(encoded_path, bme_data, tsl_data)
+    if trace:
+        trace.record("sensor", bme280=bme_data, tsl2572=tsl_data)
+        trace.record("window", seq=window.seq, seconds=window.seconds, activity=window.activity,
+                     queued_seconds=queued_seconds, encode_seconds=time.monotonic() - started)
+    logging.info(f"ワーカー: ウィンドウ #{window.seq} を送信待ちに追加しました。(エントリ {entry_id})")
+    return True
 
-    if not wav_to_mp3(WAVE_OUTPUT_FILENAME, MP3_OUTPUT_FILENAME):
-        logging.error("録音スレッド: MP3への変換に失敗しました。")
+def archive_sensors(bme_data, tsl_data):
+    """【ワーカースレッドで実行】センサーの値を履歴に残す（読み取りに失敗した値は残さない）"""
+    if not archive:
         return
+    # TSL2572 は失敗しても lux 0 を返すため、valid で判断する（無い列は NaN として残る）
+    values = {"lux": tsl_data["lux"]} if tsl_data.get("valid", True) else {}
+    # BME280 は失敗すると全項目 0.0 を返す（気圧 0 はあり得ない）
+    if bme_data["pressure"]:
+        values.update(temperature=bme_data["temperature"], pressure=bme_data["pressure"],
+                      humidity=bme_data["humidity"])
+    archive.append(**values)
 
-    bme_data = bme280_sample.readData()
-    tsl_data = tsl2572_sample.readData()
+def archive_window_level(window):
+    """【ディスパッチャのスレッドで実行】無音で破棄するものも含め、ウィンドウの音量を履歴に残す"""
+    if archive and window.activity.get("rms_db") is not None:
+        archive.append(window.started_at + window.seconds, rms_db=window.activity["rms_db"])
 
-    response = post_data(MP3_OUTPUT_FILENAME, bme_data, tsl_data)
-    if response and "task_id" in response:
-        new_task_id = response["task_id"]
-        logging.info(f"録音スレッド: データの投稿に成功。Task ID: {new_task_id}")
-        task_ids.append(new_task_id)
+def on_uploaded(task_id):
+    """【アップローダーのスレッドで実行】送信に成功したタスクを登録する"""
+    logging.info(f"データの投稿に成功。Task ID: {task_id}")
+    if trace:
+        trace.record("uploaded", task_id=task_id)
+    task_ids.append(task_id)
+    poll_scheduler.add(task_id)
+
+def celebrate_completion():
+    """タスクの完了を回転サーボの動きで知らせる"""
+    if rotate:
+        rotate.move_with_profile([0, 0.05, 0.15, 0.25, 0.45, 1, 2, 2.25, 2.75], [90, -90, 90, -90, 80, 90, 90, -80, -90])
+
+def on_task_completed(task_id, polled=False):
+    """【イベント受信スレッドで実行】プッシュ通知またはポーリングで完了したタスクを登録する"""
+    if trace:
+        trace.record("completed", task_id=task_id)
+    if task_id not in task_ids or task_id in completed_task_ids:
+        return
+    poll_scheduler.complete(task_id, polled)
+    logging.info(f"タスク完了の通知を受信しました: {task_id}")
+    completed_task_ids.add(task_id)
+    celebrate_completion()
+    # 再生に備えて結果を先に取得しておく
+    prefetcher.submit(fetch_task_result, task_id)
+
+def poll_task_status():
+    """【イベント受信スレッドで実行】プッシュ通知が使えない間、完了が近いタスクだけステータスを確認する"""
+    for task_id in poll_scheduler.due():
+        task_info = get_task_status(task_id, timeout=STATUS_TIMEOUT)
+        logging.debug(f"ポーリング: {task_id} {task_info}")
+        if task_info and task_info.get("status") == "completed":
+            on_task_completed(task_id, polled=True)
+
+def record_switch(gesture):
+    """【スイッチのスレッドで実行】判定したジェスチャーを記録する"""
+    if trace:
+        trace.record("switch", gesture=gesture.kind)
+
+def stop_playback():
+    """【スイッチのスレッドで実行】再生中の音声を止める（LED・サーボは再生の終了に合わせて止まる）"""
+    play_obj = now_playing
+    if play_obj is not None and play_obj.is_playing():
+        logging.info("スイッチ操作で再生を停止します。")
+        play_obj.stop()
+
+def skip_playback():
+    """【スイッチのスレッドで実行】プレイリストなら次の曲へ進み、1曲だけの再生なら止める"""
+    play_obj = now_playing
+    if play_obj is not None and hasattr(play_obj, "skip"):
+        logging.info("スイッチ操作で次の曲へ進みます。")
+        play_obj.skip()
     else:
-        logging.error("録音スレッド: データの投稿に失敗。")
-    logging.info("録音スレッド: 正常に終了します。")
+        stop_playback()
+
+def create_switch_dispatcher():
+    """処理中の短押し（スキップ）と長押し（停止）は再生を操作するだけにし、新しい確認は始めない"""
+    return SwitchDispatcher(interrupts={GESTURE_SHORT: skip_playback, GESTURE_LONG: stop_playback},
+                            on_gesture=record_switch)
+
+def handle_gesture(gesture):
+    """
+    スイッチのジェスチャーを処理する。
+    短押し: 完了したタスクを探して再生 / ダブルクリック: 最後に再生した曲をもう一度 / 長押し: 停止
+    """
+    logging.info(f"スイッチ: {gesture.kind} を処理します。(まとめた操作 {gesture.presses} 件)")
+    if gesture.kind == GESTURE_SHORT:
+        process_switch_event()
+    elif gesture.kind == GESTURE_DOUBLE:
+        replay_last_task()
+    elif gesture.kind == GESTURE_LONG:
+        stop_playback()
+
+def stop_capture_for_playback():
+    if echo_canceller is not None:
+        # 再生音の回り込みを差し引きながら録音を続ける
+        return
+    if capture and capture.is_running():
+        logging.info("再生のため録音を停止します。")
+        capture.stop()
 
-def handle_switch_press():
-    """【軽量な割り込みハンドラ】キューにイベントを追加するだけ"""
-    event_queue.put('SWITCH_PRESSED')
+def replay_last_task():
+    """最後に再生したタスクを、キャッシュ済みの音声から再生し直す（タスクの確認はしない）"""
+    if last_played is None:
+        logging.info("再生し直す曲がありません。")
+        return
+    key, task_info, audio_path, track = last_played
+    stop_capture_for_playback()
+    if track:
+        play_completed_task(led_engine, key, task_info, audio_data=track.audio, show=track.show)
+    else:
+        play_completed_task(led_engine, key, task_info, audio_path, deadline=Deadline(PRESS_DEADLINE_SECONDS))
 
 def process_switch_event():
-    """スイッチイベントを処理する"""
-    global is_mock, led_strip, recording_thread
+    """
+    スイッチイベントを処理する。
+    タスクの確認から再生の開始までを PRESS_DEADLINE_SECONDS 以内に収め、間に合わなければ中止する
+    """
+    global is_mock, led_engine, last_played
     logging.info(f"スイッチ・イベントを処理します。{is_mock}")
+    deadline = Deadline(PRESS_DEADLINE_SECONDS)
 
     # 再生可能なタスクを検索
     available_tasks = {} 
 
     if is_mock:
-        task_info = get_mock_task()
-        if task_info and task_info.get("status") == "completed":
-            available_tasks["mock"] = task_info
+        # 同じモック曲はデコード済みのものを再利用する
+        track = mock_cache.get(deadline)
+        if track:
+            available_tasks["mock"] = (track.task_info, None, track)
     else: 
-        for task_id in task_ids:
-            task_info = get_task(task_id)
-            if task_info and task_info.get("status") == "completed":
-                available_tasks[task_id] = task_info
-                break
+        # 完了通知を受けたタスクから先に確認する
+        candidates = [t for t in task_ids if t in completed_task_ids] + [t for t in task_ids if t not in completed_task_ids]
+        try:
+            for task_id in candidates:
+                deadline.check("タスクの確認")
+                # ステータスの確認には結果の音声を含まない軽量なリクエストを使う
+                task_info = get_task_status(task_id, timeout=deadline.timeout(STATUS_TIMEOUT))
+                if task_info and task_info.get("status") == "completed":
+                    poll_scheduler.complete(task_id, polled=True)
+                    try:
+                        audio_path = fetch_task_result(task_id, deadline)
+                    except Cancelled:
+                        # ダウンロードの続きは先読みに任せ、次に押したときに再生する
+                        prefetcher.submit(fetch_task_result, task_id)
+                        raise
+                    if audio_path:
+                        available_tasks[task_id] = (task_info, audio_path, None)
+                        break
+        except Cancelled as e:
+            logging.warning(f"{PRESS_DEADLINE_SECONDS}秒以内に再生できるタスクを用意できませんでした: {e}")
+            return
+        if playlist_mode and available_tasks:
+            # 残りのタスクは再生中に確認・先読みする
+            stop_capture_for_playback()
+            (task_id, (task_info, audio_path, _)), = available_tasks.items()
+            rest = candidates[candidates.index(task_id) + 1:]
+            play_playlist([(task_id, task_info, audio_path, None)] + [(t, None, None, None) for t in rest], deadline)
+            return
 
     for _ in range(len(available_tasks)):
         key, value = available_tasks.popitem()
         logging.info(f"再生タスク {key} が見つかりました。")
-        if recording_thread and recording_thread.is_alive():
-            logging.info("実行中の録音スreadに停止信号を送信します。")
-            stop_recording_event.set()
-            recording_thread.join() # スレッドが終了するのを待つ
-            logging.info("録音スレッドが停止しました。")
-        
-        play_completed_task(led_strip, key, value)
+        stop_capture_for_playback()
+
+        task_info, audio_path, track = value
+        last_played = (key, task_info, audio_path, track)
+        if track:
+            play_completed_task(led_engine, key, task_info, audio_data=track.audio, show=track.show)
+        else:
+            play_completed_task(led_engine, key, task_info, audio_path, deadline=deadline)
     else:
         logging.info("再生できる完了済みタスクがありませんでした。")
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--is_mock", action="store_true")
+    parser.add_argument("--base_url", default=api.BASE_PATH, help="バックエンドのURL（mock_server.py を使う場合など）")
+    parser.add_argument("--activity_margin_db", type=float, default=ACTIVITY_MARGIN_DB)
+    parser.add_argument("--activity_min_ratio", type=float, default=ACTIVITY_MIN_RATIO)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument("--capture_workers", type=int, default=CAPTURE_WORKERS)
+    parser.add_argument("--capture_queue_size", type=int, default=CAPTURE_QUEUE_SIZE)
+    parser.add_argument("--backpressure", choices=[POLICY_DROP_OLDEST, POLICY_BLOCK], default=POLICY_DROP_OLDEST)
+    parser.add_argument("--spool_dir", default=SPOOL_DIR)
+    parser.add_argument("--spool_max_mb", type=int, default=SPOOL_MAX_MB)
+    parser.add_argument("--result_cache_mb", type=int, default=RESULT_CACHE_MAX_MB, help="生成された音声のキャッシュの上限（MB）")
+    parser.add_argument("--archive_dir", default=ARCHIVE_DIR, help="センサーと音量の履歴の保存先（空文字列なら保存しない）")
+    parser.add_argument("--archive_max_mb", type=int, default=ARCHIVE_MAX_MB)
+    parser.add_argument("--profiler_socket", default=None, help="プロファイラを操作する Unix ソケットのパス")
+    parser.add_argument("--trace_record", default=None, help="動作を記録するトレースファイル（trace_harness.py で再生する）")
+    parser.add_argument("--playback_backend", choices=[play_audio_module.BACKEND_SIMPLEAUDIO, play_audio_module.BACKEND_PYAUDIO],
+                        default=play_audio_module.PLAYBACK_BACKEND, help="pyaudio は再生位置にLED・サーボを同期する")
+    parser.add_argument("--playback_buffer", type=int, default=play_audio_module.PLAYBACK_FRAMES_PER_BUFFER,
+                        help="pyaudio で再生する場合のバッファのフレーム数")
+    parser.add_argument("--duplex", action="store_true",
+                        help="再生中も録音を続け、再生音の回り込みを差し引く（pyaudio で再生する）")
+    parser.add_argument("--playlist", action="store_true",
+                        help="完了したタスクをすべて続けて再生する（pyaudio で再生する）")
+    parser.add_argument("--crossfade", type=float, default=CROSSFADE_SECONDS, help="プレイリストの曲の変わり目を重ねる秒数")
+    parser.add_argument("--playlist_memory_mb", type=int, default=PLAYLIST_MEMORY_MB,
+                        help="プレイリストで先読みしておく音声の上限")
+    parser.add_argument("--memory_budget_mb", type=int, default=MEMORY_BUDGET_MB,
+                        help="再生経路のメモリの上限（メインプロセスとワーカーの RSS の合計, MB）。超える曲はデコードしながら再生する（0 なら空きメモリだけを見る）")
+    parser.add_argument("--memory_trace", action="store_true",
+                        help="段階ごとのメモリの計測に tracemalloc の値も含める（ワーカーも含め、割り当てが遅くなる）")
+    parser.add_argument("--offload_workers", type=int, default=offload.OFFLOAD_WORKERS,
+                        help="エンコード・デコードを行うワーカープロセスの数（0 ならメインプロセスで行う）")
+    parser.add_argument("--log_level", default=None, help="DEBUG / INFO / WARNING など（省略時は環境変数 LOG_LEVEL）")
+    parser.add_argument("--log_format", choices=[FORMAT_TEXT, FORMAT_JSON], default=FORMAT_TEXT)
     args = parser.parse_args()
-    global is_mock, led_strip, recording_thread
+    setup_logging(args.log_level, args.log_format)
+    global is_mock, led_strip, led_engine, rotate, task_events, capture, spool, uploader, level_monitor, capture_profile
+    global archive, mock_cache, echo_canceller, trace, get_task_status, download_task_result, switch_dispatcher
+    global playlist_mode, crossfade_seconds, playlist_memory_bytes, result_cache_max_bytes
     is_mock = args.is_mock
+    result_cache_max_bytes = args.result_cache_mb * 1024 * 1024
+    if os.path.isdir(RESULT_CACHE_DIR):
+        evict_result_cache()
+    api.BASE_PATH = args.base_url
+    play_audio_module.PLAYBACK_BACKEND = args.playback_backend
+    play_audio_module.PLAYBACK_FRAMES_PER_BUFFER = args.playback_buffer
+    if args.duplex:
+        # 回り込み音の除去には出力した時刻が分かる pyaudio の再生が必要
+        if play_audio_module.PLAYBACK_BACKEND != play_audio_module.BACKEND_PYAUDIO:
+            logging.info("録音を続けたまま再生するため、再生方式を pyaudio にします。")
+            play_audio_module.PLAYBACK_BACKEND = play_audio_module.BACKEND_PYAUDIO
+        play_audio_module.PLAYBACK_REFERENCE = PlaybackReference(RATE)
+        echo_canceller = DuplexEchoCanceller(play_audio_module.PLAYBACK_REFERENCE, CHANNELS)
+    if args.playlist:
+        # 曲を切れ目なく続けるには、1本のストリームに曲を追加していける pyaudio の再生が必要
+        if play_audio_module.PLAYBACK_BACKEND != play_audio_module.BACKEND_PYAUDIO:
+            logging.info("プレイリストを再生するため、再生方式を pyaudio にします。")
+            play_audio_module.PLAYBACK_BACKEND = play_audio_module.BACKEND_PYAUDIO
+        playlist_mode = True
+        crossfade_seconds = args.crossfade
+        playlist_memory_bytes = args.playlist_memory_mb * 1024 * 1024
+    if args.memory_budget_mb > 0:
+        memory_budget.limit_bytes = args.memory_budget_mb * 1024 * 1024
+    if args.memory_trace:
+        memory_budget_module.start_tracing()
+    if is_mock:
+        mock_cache = MockTrackCache()
+    capture_profile = PROFILES[args.profile]
+    if args.offload_workers > 0:
+        offload.start(args.offload_workers, memory_trace=args.memory_trace)
+        memory_budget.worker_pids = offload.worker_pids
+    # SIGUSR1 またはソケットのコマンドで、動作中にプロファイルを取れるようにする
+    profiler = ProfilerHooks(socket_path=args.profiler_socket)
+    profiler.install()
+    level_monitor = LevelMonitor(CHANNELS, RATE, margin_db=args.activity_margin_db,
+                                 min_active_ratio=args.activity_min_ratio)
+    upload_fn = post_data
+    if args.trace_record:
+        # 外部とのやり取りを記録し、trace_harness.py で仮想時計の上で再生できるようにする
+        trace = TraceRecorder(args.trace_record, is_mock=is_mock, capture_workers=args.capture_workers)
+        get_task_status = trace.wrap_api("get_task_status", get_task_status, key=lambda a: a[0])
+        download_task_result = trace.wrap_api("download_task_result", download_task_result, key=lambda a: a[0])
+        upload_fn = trace.wrap_api("post_data", post_data)
+    if args.archive_dir:
+        archive = SensorArchive(args.archive_dir, args.archive_max_mb * 1024 * 1024)
+    spool = UploadSpool(args.spool_dir, args.spool_max_mb * 1024 * 1024)
+    uploader = SpoolUploader(spool, upload_fn, on_uploaded)
+    capture = CapturePipeline(RECORDING_SECONDS, encode_and_spool_window,
+                              workers=args.capture_workers, queue_size=args.capture_queue_size,
+                              policy=args.backpressure, level_monitor=level_monitor,
+                              echo_canceller=echo_canceller, on_activity=archive_window_level)
     try:
         # 初期化処理
         led_strip = init_led()
+        if led_strip:
+            led_engine = LedEngine(led_strip)
         bme280_sample.init()
         tsl2572_sample.init()
-        switch = setup_switch(handle_switch_press)
+        switch_dispatcher = create_switch_dispatcher().start()
+        switch = setup_switch(switch_dispatcher.on_press, switch_dispatcher.on_release)
         logging.info("アプリケーションを開始します。")
-        rotate = Servo(12)
+        rotate = Servo(12, hold_time=HOLD_SECONDS)
         #rotate.move(0, 15)
+        task_events = TaskEventChannel(on_task_completed, poll_task_status, scheduler=poll_scheduler)
+        task_events.start()
     
         count = 0
         while True:
-            if count > 60 and task_ids:
+            if count > STATS_LOG_INTERVAL:
                 count = 0
-                response = get_status(task_ids)
-                logging.info(response)
-                if response == True:
-                    rotate.move_with_profile([0, 0.05, 0.15, 0.25, 0.45, 1, 2, 2.25, 2.75], [90, -90, 90, -90, 80, 90, 90, -80, -90])
-
-            # --- スイッチイベントの処理 ---
-            try:
-                event = event_queue.get_nowait()
-                if event == 'SWITCH_PRESSED':
-                    process_switch_event()
-            except queue.Empty:
-                pass
-
-            # --- 録音スレッドの管理 ---
-            if recording_thread is None or not recording_thread.is_alive():
-                logging.info("メインループ: 新しい録音スレッドを開始します。")
-                recording_thread = threading.Thread(target=record_and_post_data)
-                recording_thread.start()
-
-            count += 0.2 
-            time.sleep(0.2)
+                logging.info(f"キャプチャ統計: {capture.metrics()}")
+                logging.info(f"スプール: 送信待ち {len(spool)} 件 ({spool.total_bytes()} bytes), "
+                             f"送信統計 {uploader.metrics()}, 容量超過による削除 {spool.evicted} 件")
+                logging.info(f"タスク通知: {'プッシュ' if task_events.connected else 'ポーリング'} {task_events.metrics}")
+                low, median, high = poll_scheduler.eta()
+                logging.info(f"ステータス確認: 生成中 {len(poll_scheduler)} 件, 完了予想 {low:.0f}〜{high:.0f}秒 "
+                             f"(中央 {median:.0f}秒), {poll_scheduler.metrics}")
+                logging.info(f"スイッチ: {switch_dispatcher.metrics}")
+                available = available_bytes()
+                logging.info(f"メモリ: RSS {rss_bytes() / 1048576:.1f}MB, "
+                             f"空き {'-' if available is None else f'{available / 1048576:.0f}MB'}, "
+                             f"段階ごとの増分 {memory_budget_module.stats.summary()}, 上限の確認 {memory_budget.metrics}")
+                if archive:
+                    archive.flush()
+                    logging.info(f"アーカイブ: {archive.metrics} ({archive.total_bytes()} bytes)")
+                if echo_canceller:
+                    erle = echo_canceller.erle_db()
+                    logging.info(f"エコー除去: 再生中のブロック {echo_canceller.metrics['cancelled_blocks']} 件, "
+                                 f"ERLE {'-' if erle is None else f'{erle:.1f}dB'}")
+
+            # --- スイッチイベントの処理（処理中の操作はディスパッチャーがまとめる） ---
+            gesture = switch_dispatcher.take()
+            if gesture:
+                try:
+                    handle_gesture(gesture)
+                finally:
+                    switch_dispatcher.done()
+
+            # --- 録音の管理（再生で止めた場合は再開する） ---
+            if not capture.is_running():
+                logging.info("メインループ: 連続録音を開始します。")
+                capture.start()
+
+            count += MAIN_LOOP_INTERVAL
+            time.sleep(MAIN_LOOP_INTERVAL)
 
     except KeyboardInterrupt:
         logging.info("シャットダウンシグナルを受信しました。")
     except Exception as e:
         logging.critical(f"メインループで予期せぬエラー: {e}", exc_info=True)
     finally:
-        if recording_thread and recording_thread.is_alive():
-            logging.info("シャットダウン前に録音スレッドを停止します...")
-            stop_recording_event.set()
-            recording_thread.join()
-        if led_strip:
+        profiler.close()
+        if switch_dispatcher:
+            switch_dispatcher.close()
+        if task_events:
+            task_events.close()
+        prefetcher.shutdown(wait=False, cancel_futures=True)
+        if capture:
+            logging.info("シャットダウン前に録音を停止します...")
+            capture.close()
+        if uploader:
+            uploader.close()
+        if led_engine:
+            led_engine.close()
+        elif led_strip:
             led_strip.off()
+        offload.shutdown()
+        if archive:
+            archive.close()
+        if trace:
+            trace.close()
         logging.info("アプリケーションをシャットダウンしました。")
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""
+再生経路のメモリ使用量の計測と上限。
+
+1曲を再生するまでに、base64 の文字列・デコードしたバイト列・AudioSegment とそのモノラル版・
+raw_data・サンプル配列などが同時にメモリに載る。小さな Pi では OOM killer にプロセスを
+止められることがあるため、段階ごとに RSS（と tracemalloc が有効なら Python の割り当て）の
+増分を記録し、曲をデコードする前に必要な大きさを見積もって MemoryBudget で確認する。
+
+    with measure("decode"):
+        audio, show = offload.decode_track(path=path)
+
+    if not budget.allows(estimate_playback_bytes(path=path)):
+        ...  # ストリーミングで再生するか、再生しない
+
+RSS と空きメモリは /proc から読む（Linux 以外では RSS は最大値、空きメモリは不明として扱う）。
+"""
+import os
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+MEMORY_BUDGET_BYTES = None              # メインプロセスとワーカーの RSS の合計の上限（None なら空きメモリだけを見る）
+MEMORY_RESERVE_BYTES = 64 * 1024 * 1024 # OS と他のプロセスのために残す空きメモリ
+DECODE_EXPANSION = 12.0         # 長さが分からない場合の、圧縮された音声に対するデコード後（16bit ステレオ）の倍率
+PLAYBACK_PEAK_FACTOR = 2.5      # デコード後の大きさに対する再生までのピーク（モノラル化・共有メモリでの受け渡しのコピー）
+MEMORY_TRACE_FRAMES = 1         # --memory_trace で tracemalloc が記録するスタックの深さ
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+class MemoryBudgetExceeded(Exception):
+    """必要なメモリが上限を超える"""
+
+def rss_bytes(pid=None) -> int:
+    """このプロセス（pid を指定した場合はそのプロセス）の現在の RSS。終了したプロセスは 0"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        if pid is not None:
+            return 0
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def peak_rss_bytes() -> int | None:
+    """このプロセスの RSS の最大値（reset_peak_rss() 以降）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """RSS の最大値を現在の値に戻す（Linux 4.0 以降）"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def available_bytes() -> int | None:
+    """システム全体で新たに使えるメモリ（MemAvailable）。分からない場合は None"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def start_tracing(frames=MEMORY_TRACE_FRAMES):
+    """段階ごとの Python の割り当ても記録する（割り当てごとにオーバーヘッドがある）"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+class MemoryStats:
+    """段階ごとのメモリの増分の記録（回数・最後の値・最大値）"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, rss_delta, peak_delta, traced_delta, traced_peak):
+        """値が None のもの（測れなかったもの）は最大値を更新しない"""
+        with self._lock:
+            row = self.stages.setdefault(stage, {"count": 0, "rss_delta": 0, "rss_delta_max": 0,
+                                                 "peak_delta_max": 0, "traced_delta_max": 0, "traced_peak_max": 0})
+            row["count"] += 1
+            row["rss_delta"] = rss_delta
+            row["rss_delta_max"] = max(row["rss_delta_max"], rss_delta)
+            if peak_delta is not None:
+                row["peak_delta_max"] = max(row["peak_delta_max"], peak_delta)
+            if traced_delta is not None:
+                row["traced_delta_max"] = max(row["traced_delta_max"], traced_delta)
+            if traced_peak is not None:
+                row["traced_peak_max"] = max(row["traced_peak_max"], traced_peak)
+
+    def drain(self) -> dict:
+        """記録を取り出して空にする（ワーカープロセスの記録を呼び出し元に返すため）"""
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages: dict):
+        """drain() で取り出した他のプロセスの記録を加える"""
+        with self._lock:
+            for stage, other in stages.items():
+                row = self.stages.setdefault(stage, dict.fromkeys(other, 0))
+                row["count"] += other["count"]
+                row["rss_delta"] = other["rss_delta"]
+                for key in ("rss_delta_max", "peak_delta_max", "traced_delta_max", "traced_peak_max"):
+                    row[key] = max(row[key], other[key])
+
+    def summary(self) -> dict:
+        """段階ごとの {回数, RSS の増分の最大値, 段階中の RSS のピークの増分の最大値}（MB）"""
+        with self._lock:
+            return {stage: {"count": row["count"],
+                            "rss_mb": round(row["rss_delta_max"] / 1048576, 1),
+                            "peak_mb": round(row["peak_delta_max"] / 1048576, 1),
+                            **({"traced_peak_mb": round(row["traced_peak_max"] / 1048576, 1)}
+                               if row["traced_peak_max"] else {})}
+                    for stage, row in self.stages.items()}
+
+stats = MemoryStats()
+
+_active_lock = threading.Lock()
+_active = []        # 実行中の measure() ごとの {"shared": 他の measure() と重なったか}
+
+@contextmanager
+def measure(stage):
+    """
+    ブロックの前後の RSS の増分と、ブロック中の RSS のピークの増分を stats に記録する。
+    tracemalloc が有効なら Python の割り当ての増分とピークも記録する。
+    ピークの記録はプロセスに1つしかなく、開始時に戻すため、他のスレッドの measure() と
+    重なった場合（入れ子を含む）はピークを記録せず、前後の増分だけを記録する
+    """
+    with _active_lock:
+        token = {"shared": bool(_active)}
+        for other in _active:
+            other["shared"] = True
+        _active.append(token)
+        before = rss_bytes()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            traced_before, _ = tracemalloc.get_traced_memory()
+        if not token["shared"]:
+            reset_peak_rss()
+            if tracing:
+                tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active.remove(token)
+            after = rss_bytes()
+            peak = None if token["shared"] else peak_rss_bytes()
+            traced_delta = traced_peak = None
+            if tracing and tracemalloc.is_tracing():
+                traced_now, traced_max = tracemalloc.get_traced_memory()
+                traced_delta = traced_now - traced_before
+                if not token["shared"]:
+                    traced_peak = traced_max - traced_before
+        peak_delta = None if peak is None else max(peak - before, 0)
+        stats.record(stage, after - before, peak_delta, traced_delta, traced_peak)
+        logging.debug(f"メモリ: {stage} RSS {before / 1048576:.1f}MB → {after / 1048576:.1f}MB"
+                      f"{'' if peak_delta is None else f' (ピーク +{peak_delta / 1048576:.1f}MB)'}"
+                      f"{'' if traced_delta is None else f' / Python +{traced_delta / 1048576:.1f}MB'}"
+                      f"{'' if traced_peak is None else f' (ピーク +{traced_peak / 1048576:.1f}MB)'}")
+
+def estimate_pcm_bytes(path=None, encoded_bytes=None) -> int:
+    """
+    音声ファイル（path）または圧縮された音声のバイト数から、16bit でデコードした大きさを見積もる。
+    path の場合は ffprobe で長さ・チャンネル数・サンプリング周波数を調べ、分からなければ倍率で見積もる
+    """
+    if path is not None:
+        try:
+            from pydub.utils import mediainfo
+            info = mediainfo(path)
+            return int(float(info["duration"]) * int(info["sample_rate"]) * int(info["channels"]) * 2)
+        except Exception as e:
+            logging.debug(f"メモリ: {path} の長さを取得できないため、ファイルサイズから見積もります: {e}")
+            encoded_bytes = os.path.getsize(path)
+    return int((encoded_bytes or 0) * DECODE_EXPANSION)
+
+def estimate_playback_bytes(path=None, encoded_bytes=None) -> int:
+    """1曲を（ストリーミングせずに）再生するまでに一時的に必要になるメモリの見積もり"""
+    return int(estimate_pcm_bytes(path, encoded_bytes) * PLAYBACK_PEAK_FACTOR)
+
+class MemoryBudget:
+    """
+    新しく needed バイトを確保してよいかを判断する。
+    - limit_bytes: このプロセスと worker_pids() のプロセスの RSS の合計の上限（None なら見ない）。
+      デコードはワーカープロセス（offload）で行うため、その分も含めて数える
+    - reserve_bytes: システム全体の空きメモリ（MemAvailable）のうち、使わずに残す量
+    """
+    def __init__(self, limit_bytes=MEMORY_BUDGET_BYTES, reserve_bytes=MEMORY_RESERVE_BYTES, worker_pids=None):
+        self.limit_bytes = limit_bytes
+        self.reserve_bytes = reserve_bytes
+        self.worker_pids = worker_pids or (lambda: [])
+        self.metrics = {"allowed": 0, "refused": 0}
+
+    def headroom(self) -> int | None:
+        """今確保できる量。制限が無い（判断できない）場合は None"""
+        limits = []
+        if self.limit_bytes is not None:
+            used = rss_bytes() + sum(rss_bytes(pid) for pid in self.worker_pids())
+            limits.append(self.limit_bytes - used)
+        available = available_bytes()
+        if available is not None:
+            limits.append(available - self.reserve_bytes)
+        return max(min(limits), 0) if limits else None
+
+    def allows(self, needed) -> bool:
+        headroom = self.headroom()
+        ok = headroom is None or needed <= headroom
+        self.metrics["allowed" if ok else "refused"] += 1
+        return ok
+
+    def check(self, needed, stage=""):
+        """needed バイトを確保できなければ MemoryBudgetExceeded を送出する"""
+        if not self.allows(needed):
+            raise MemoryBudgetExceeded(f"{stage}: {needed / 1048576:.1f}MB が必要ですが、"
+                                       f"使えるのは {self.headroom() / 1048576:.1f}MB です")
@@ -0,0 +1,131 @@
+import os
+import json
+import base64
+import binascii
+import hashlib
+import logging
+import threading
+
+from api import get_mock_task_if_modified
+import offload
+from deadline import Cancelled
+
+MOCK_CACHE_DIR = os.path.join("cache", "mock")
+
+class MockTrack:
+    """デコード済みのモック曲と、その演出データ"""
+    def __init__(self, content_hash, task_info, audio, show):
+        self.content_hash = content_hash
+        self.task_info = task_info  # result を除いたレスポンス（bpm, 色など）
+        self.audio = audio
+        self.show = show
+
+class MockTrackCache:
+    """
+    --is_mock モードで取得するモック曲のキャッシュ。
+
+    レスポンスの音声は内容のハッシュをキーにディスクへ保存し、デコード結果と演出データは
+    メモリに保持する。サーバーには ETag による条件付きリクエストで変更の有無だけを確認し、
+    サーバーに接続できない場合はキャッシュ済みの曲を使う。
+    """
+    def __init__(self, cache_dir=MOCK_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._index = self._load_index()
+        self._track = None
+        self._lock = threading.Lock()
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _audio_path(self, content_hash) -> str:
+        return os.path.join(self.cache_dir, f"{content_hash}.mp3")
+
+    def get(self, deadline=None) -> MockTrack | None:
+        """
+        モック曲を返す。変更が無ければデコード済みのものを再利用する。
+        deadline までに確認・デコードが終わらない場合は None を返す
+        """
+        with self._lock:
+            self._revalidate(deadline)
+            content_hash = self._index.get("hash")
+            if not content_hash or not os.path.exists(self._audio_path(content_hash)):
+                return None
+            task_info = self._index.get("task_info", {})
+            if self._track is not None and self._track.content_hash == content_hash:
+                return self._track
+
+            logging.info(f"モック曲をデコードします: {content_hash[:12]}")
+            try:
+                audio, show = offload.decode_track(path=self._audio_path(content_hash), bpm=task_info.get("bpm", 60),
+                                                   min_color=task_info.get("min_color", "#000000"),
+                                                   max_color=task_info.get("max_color", "#ffffff"), deadline=deadline)
+            except Cancelled as e:
+                logging.warning(f"モック曲のデコードを中止しました: {e}")
+                return None
+            if audio is None:
+                return None
+            self._track = MockTrack(content_hash, task_info, audio, show)
+            return self._track
+
+    def _revalidate(self, deadline=None, conditional=True):
+        """
+        サーバーに変更の有無を確認し、変更があれば保存し直す。
+        conditional=False なら ETag を付けずに取得する（キャッシュの音声が無くなった場合）
+        """
+        if deadline is not None and deadline.expired():
+            return
+        timeout = 5 if deadline is None else deadline.timeout(5)
+        result = get_mock_task_if_modified(self._index.get("etag") if conditional else None, timeout=timeout)
+        if result is None:
+            if self._index.get("hash"):
+                logging.warning("モックサーバーに接続できないため、キャッシュ済みの曲を使います。")
+            return
+        status, task_info, etag = result
+        if status == 304:
+            content_hash = self._index.get("hash")
+            if content_hash and os.path.exists(self._audio_path(content_hash)):
+                logging.info("モック曲に変更はありません。キャッシュを使います。")
+                return
+            # 304 のままではキャッシュから消えた音声を取り直せないため、ETag を捨てて取得し直す
+            logging.warning("モック曲に変更はありませんが、キャッシュの音声が無いため取得し直します。")
+            self._index.pop("etag", None)
+            self._save_index()
+            if conditional:
+                self._revalidate(deadline, conditional=False)
+            return
+        base64_audio_data = task_info.pop("result", None) if task_info else None
+        if not base64_audio_data or task_info.get("status") != "completed":
+            return
+
+        try:
+            audio_bytes = base64.b64decode(base64_audio_data)
+        except (binascii.Error, ValueError) as e:
+            # 壊れたレスポンスでは索引を更新せず、キャッシュ済みの曲を使い続ける
+            logging.error(f"モック曲の音声データをデコードできません。キャッシュ済みの曲を使います: {e}")
+            return
+        content_hash = hashlib.sha256(audio_bytes).hexdigest()
+        if content_hash != self._index.get("hash") or not os.path.exists(self._audio_path(content_hash)):
+            tmp_path = self._audio_path(content_hash) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio_bytes)
+            os.replace(tmp_path, self._audio_path(content_hash))
+            old_hash = self._index.get("hash")
+            if old_hash and old_hash != content_hash and os.path.exists(self._audio_path(old_hash)):
+                os.remove(self._audio_path(old_hash))
+            logging.info(f"新しいモック曲を保存しました: {content_hash[:12]}")
+        if task_info != self._index.get("task_info"):
+            self._track = None  # 色や BPM が変わった場合は演出を作り直す
+        self._index = {"etag": etag, "hash": content_hash, "task_info": task_info}
+        self._save_index()
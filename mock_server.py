@@ -0,0 +1,235 @@
+"""
+バックエンドAPIのローカル代替サーバー。
+
+実機やバックエンドが無い環境で、main.py やその他のクライアントをオフラインで試すために使う。
+投稿されたデータは generation_seconds 秒後に「完了」となり、結果の音声には result_file を返す。
+
+    python mock_server.py --port 8000 --generation_seconds 30
+    python main.py --base_url http://127.0.0.1:8000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from log_config import setup_logging
+
+DEFAULT_PORT = 8000
+GENERATION_SECONDS = 30.0
+HEARTBEAT_SECONDS = 15.0
+RESULT_FILE = "output.mp3"
+
+class MockBackend:
+    """タスクの状態と、イベントストリームの購読者を管理する"""
+    def __init__(self, result_file=RESULT_FILE, generation_seconds=GENERATION_SECONDS):
+        with open(result_file, "rb") as f:
+            self.result_bytes = f.read()
+        self.result_base64 = base64.b64encode(self.result_bytes).decode("utf-8")
+        self.mock_etag = f'"{hashlib.sha256(self.result_bytes).hexdigest()[:32]}"'
+        self.generation_seconds = generation_seconds
+        self.lock = threading.Lock()
+        self.tasks = {}         # task_id -> {"status", "created_at", "completed_at"}
+        self.subscribers = []   # イベントストリームごとの queue.Queue
+        self.requests = 0
+
+    def create_task(self) -> str:
+        task_id = uuid.uuid4().hex
+        with self.lock:
+            self.tasks[task_id] = {"status": "pending", "created_at": time.time(), "completed_at": None}
+        timer = threading.Timer(self.generation_seconds, self.complete_task, args=(task_id,))
+        timer.daemon = True
+        timer.start()
+        return task_id
+
+    def complete_task(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return
+            task["status"] = "completed"
+            task["completed_at"] = time.time()
+            subscribers = list(self.subscribers)
+        event = {"task_id": task_id, "status": "completed"}
+        for subscriber in subscribers:
+            subscriber.put(event)
+        logging.info(f"モックサーバー: タスク {task_id} が完了しました。")
+
+    def task_response(self, task_id, include_result=True) -> dict | None:
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            response = {"task_id": task_id, "status": task["status"]}
+        if task["status"] == "completed":
+            response.update({"bpm": 120, "min_color": "#0000FF", "max_color": "#FF0000"})
+            if include_result:
+                response["result"] = self.result_base64
+        return response
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+class MockHandler(BaseHTTPRequestHandler):
+    backend: MockBackend = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"モックサーバー: {self.address_string()} {format % args}")
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.backend.requests += 1
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if path != "/api/v1/data":
+            self._send_json(404, {"detail": "not found"})
+            return
+        try:
+            payload = json.loads(body)
+            base64.b64decode(payload["audio_data"], validate=True)
+            payload["environmental_data"]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(422, {"detail": "invalid payload"})
+            return
+        self._send_json(200, {"task_id": self.backend.create_task()})
+
+    def do_GET(self):
+        self.backend.requests += 1
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == "/api/v1/events":
+            self._stream_events()
+        elif url.path.startswith("/api/v1/status/"):
+            task_id = url.path.rsplit("/", 1)[-1]
+            include_result = params.get("include_result", ["true"])[0].lower() != "false"
+            response = self.backend.task_response(task_id, include_result)
+            if response is None:
+                self._send_json(404, {"detail": "task not found"})
+            else:
+                self._send_json(200, response)
+        elif url.path.startswith("/api/v1/result/"):
+            self._send_result(url.path.rsplit("/", 1)[-1])
+        elif url.path == "/api/v1/task_list":
+            task_ids = params.get("task_ids", [])
+            completed = any((self.backend.task_response(t, include_result=False) or {}).get("status") == "completed"
+                            for t in task_ids)
+            self._send_json(200, completed)
+        elif url.path == "/api/v1/get_mock_data":
+            if self.headers.get("If-None-Match") == self.backend.mock_etag:
+                self.send_response(304)
+                self.send_header("ETag", self.backend.mock_etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self._send_json(200, {"status": "completed", "result": self.backend.result_base64,
+                                  "bpm": 120, "min_color": "#0000FF", "max_color": "#FF0000"},
+                            headers={"ETag": self.backend.mock_etag})
+        else:
+            self._send_json(404, {"detail": "not found"})
+
+    def _send_result(self, task_id):
+        """結果の音声をそのまま返す。Range ヘッダーによる部分取得に対応する"""
+        response = self.backend.task_response(task_id, include_result=False)
+        if response is None or response["status"] != "completed":
+            self._send_json(404, {"detail": "result not found"})
+            return
+        data = self.backend.result_bytes
+        start, status = 0, 200
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-", 1)[0] or 0)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data) - start))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def _stream_events(self):
+        """Server-Sent Events でタスク完了を通知する"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        subscriber = self.backend.subscribe()
+        try:
+            self.wfile.write(b": connected\n\n")
+            self.wfile.flush()
+            while True:
+                try:
+                    event = subscriber.get(timeout=HEARTBEAT_SECONDS)
+                    message = f"event: task_completed\ndata: {json.dumps(event)}\n\n"
+                except queue.Empty:
+                    message = ": heartbeat\n\n"
+                self.wfile.write(message.encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.backend.unsubscribe(subscriber)
+
+def create_server(host="127.0.0.1", port=DEFAULT_PORT, result_file=RESULT_FILE,
+                  generation_seconds=GENERATION_SECONDS) -> ThreadingHTTPServer:
+    """サーバーを作成する（serve_forever() の呼び出しは呼び出し側で行う）。port=0 で空きポートを使う"""
+    backend = MockBackend(result_file, generation_seconds)
+    handler = type("BoundMockHandler", (MockHandler,), {"backend": backend})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.backend = backend
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--result_file", default=RESULT_FILE)
+    parser.add_argument("--generation_seconds", type=float, default=GENERATION_SECONDS)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.result_file, args.generation_seconds)
+    logging.info(f"モックサーバーを起動しました: http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("モックサーバーを終了します。")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
@@ -0,0 +1,367 @@
+"""
+CPU を使う音声処理（エンコード・デコード・演出の計算・送信データの作成）を常駐のワーカープロセスで行う。
+
+同じプロセスのスレッドで行うと、サーボ・LED のループと GIL を取り合ってモーションが引っかかる。
+音声は pickle せずに共有メモリ（multiprocessing.shared_memory）で受け渡し、
+ワーカーは start() の時点でモジュールの読み込みと numpy の初回実行を済ませておく。
+
+start() を呼ばない場合は、同じ処理をこのプロセスで行う。ワーカーが異常終了した場合は
+ワーカーを作り直してもう一度だけ実行し、作り直してから RESTART_BACKOFF_SECONDS（連続すると倍々に延ばす）
+以内にまた異常終了した場合は、次に作り直せるまでこのプロセスで行う。
+処理そのものが送出した例外は、そのまま呼び出し元に送出する。
+deadline（deadline.Deadline）を渡すと、期限切れや取り消しの時点で待つのをやめて Cancelled を送出する。
+実行中の処理は最後まで走るが、その結果は rollback で片付ける。このプロセスで行う場合も期限を守れるよう、
+deadline があるときは処理をスレッド（INLINE_THREADS 個）で実行して待つ。
+
+    offload.start(workers=2)
+    audio, show = offload.decode_track(path="cache/xxx.mp3", bpm=120)
+"""
+import os
+import json
+import logging
+import threading
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from deadline import Cancelled
+
+OFFLOAD_WORKERS = 1         # Pi の4コアのうち、メインプロセスとffmpegの分を残す
+WARM_UP_TIMEOUT = 30.0
+CANCEL_POLL_SECONDS = 0.02  # 期限付きで待つ場合に取り消しを確認する間隔
+RESTART_BACKOFF_SECONDS = 10.0      # ワーカーを作り直してから、次に作り直せるまでの最短の間隔
+RESTART_BACKOFF_MAX_SECONDS = 600.0 # 異常終了が続いた場合の間隔の上限
+INLINE_THREADS = 2          # ワーカーが無い場合に期限付きの処理を実行するスレッド数（期限切れで放置した処理が走っていても次を始められるように）
+DEFAULT_MIN_COLOR = "#000000"
+DEFAULT_MAX_COLOR = "#ffffff"
+
+_executor = None
+_inline_executor = None
+_pid_queue = None           # ワーカーが起動時に pid を送る（worker_pids() で受け取る）
+_start_args = None          # 作り直すときの (workers, level, memory_trace)。shutdown() で None にする
+_restart_lock = threading.Lock()
+_restart_backoff = 0.0
+_next_restart = 0.0
+_pids = set()
+_pids_lock = threading.Lock()
+_in_worker = False
+_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# --- 共有メモリ ---
+def _share(data) -> tuple:
+    """data を新しい共有メモリにコピーし、("shm", 名前, 長さ) を返す（解放は受け取った側が行う）"""
+    size = len(data)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    shm.buf[:size] = data
+    shm.close()
+    return ("shm", shm.name, size)
+
+def _is_shared(ref) -> bool:
+    return isinstance(ref, tuple) and len(ref) == 3 and ref[0] == "shm"
+
+def _receive(ref) -> bytes:
+    """_share() の参照またはバイト列から中身を取り出す。共有メモリは取り出した後に解放する"""
+    if not _is_shared(ref):
+        return ref
+    _, name, size = ref
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _output(data):
+    """ワーカーでは結果を共有メモリに置き、呼び出し元のプロセスではそのまま返す"""
+    return _share(data) if _in_worker else data
+
+# --- ワーカーで実行する処理（start() していない場合は呼び出し元で実行する） ---
+def _init_worker(level, memory_trace=False, pid_queue=None):
+    global _in_worker
+    _in_worker = True
+    if pid_queue is not None:
+        pid_queue.put(os.getpid())
+    from log_config import setup_logging
+    setup_logging(level)
+    if memory_trace:
+        import memory_budget
+        memory_budget.start_tracing()
+
+def _warm_up_job() -> int:
+    """モジュールの読み込みと numpy の初回実行を済ませる"""
+    import pydub
+    import jellyfish
+    from audio_profile import PROFILES, convert_pcm
+    convert_pcm(bytes(4 * 4410), 2, 44100, PROFILES["low"])
+    jellyfish.compile_show_samples(np.zeros(4410, dtype=np.int16), 44100, 120, DEFAULT_MIN_COLOR, DEFAULT_MAX_COLOR)
+    return os.getpid()
+
+def _encode_job(data_ref, channels, rate, profile, path) -> bool:
+    from pydub import AudioSegment
+    from audio_profile import convert_pcm
+    pcm = bytes(convert_pcm(_receive(data_ref), channels, rate, profile))
+    logging.info(f"{len(pcm)} bytes の音声を {path} にエンコードします...")
+    try:
+        audio = AudioSegment(data=pcm, sample_width=2, frame_rate=profile.sample_rate, channels=profile.channels)
+        audio.export(path, format=profile.codec, bitrate=profile.bitrate)
+        logging.info("変換が完了しました。")
+        return True
+    except Exception as e:
+        logging.error(f"MP3への変換中にエラーが発生しました: {e}")
+        return False
+
+def _decode_job(path, base64_ref, show_args):
+    """
+    :return: (モノラルの PCM, frame_rate, sample_width, 演出データ, メモリの記録) または (None, メモリの記録)。
+             メモリの記録はワーカーで測った段階ごとの増分（memory_budget.MemoryStats.drain()）
+    """
+    import memory_budget
+    from play_audio import get_audio_data, load_audio_file
+    if path:
+        audio = load_audio_file(path)
+    else:
+        audio = get_audio_data(_receive(base64_ref).decode("ascii"))
+    # 呼び出し元のプロセスで実行した場合は、すでに呼び出し元の記録に入っている
+    memory = memory_budget.stats.drain() if _in_worker else {}
+    if audio is None:
+        return (None, memory)
+    show = _show_job(audio.raw_data, audio.frame_rate, audio.sample_width, show_args) if show_args else None
+    return (_output(audio.raw_data), audio.frame_rate, audio.sample_width, show, memory)
+
+def _show_job(pcm_ref, frame_rate, sample_width, show_args) -> dict:
+    import jellyfish
+    samples = np.frombuffer(_receive(pcm_ref), dtype=_DTYPES[sample_width])
+    return jellyfish.compile_show_samples(samples, frame_rate, *show_args)
+
+def _body_job(path, bme280_data, tsl2572_data):
+    import api
+    try:
+        with open(path, "rb") as f:
+            payload = api.build_payload(f.read(), bme280_data, tsl2572_data)
+    except OSError as e:
+        logging.error(f"音声ファイルを読み込めません: {path}: {e}")
+        return None
+    return _output(json.dumps(payload).encode("utf-8"))
+
+# --- 呼び出し元のプロセス ---
+def start(workers=OFFLOAD_WORKERS, level=None, timeout=WARM_UP_TIMEOUT, memory_trace=False):
+    """
+    ワーカープロセスを起動して warm up する（終わるまで待つ）。
+    memory_trace=True ならワーカーでも tracemalloc でメモリの割り当てを記録する
+    """
+    global _executor, _start_args
+    if _executor is not None:
+        return
+    level = level if level is not None else logging.getLogger().level
+    _start_args = (workers, level, memory_trace)
+    _executor = _create(*_start_args)
+    started = perf_counter()
+    try:
+        futures = [_executor.submit(_warm_up_job) for _ in range(workers)]
+        pids = {future.result(timeout=timeout) for future in futures}
+        logging.info(f"オフロード: ワーカー {len(pids)} 個の準備が完了しました。({perf_counter() - started:.1f}秒)")
+    except Exception as e:
+        logging.error(f"オフロード: ワーカーの起動に失敗したため、このプロセスで処理します: {e}")
+        shutdown()
+
+def _create(workers, level, memory_trace) -> ProcessPoolExecutor:
+    global _pid_queue
+    # fork だとサーボ・LED のスレッドが持つロックの状態まで複製されるため、forkserver で起動する
+    context = multiprocessing.get_context("forkserver")
+    _pid_queue = context.SimpleQueue()
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                               initializer=_init_worker, initargs=(level, memory_trace, _pid_queue))
+
+def _restart(broken=None) -> ProcessPoolExecutor | None:
+    """
+    異常終了したワーカー（broken）を止め、前回作り直してから間隔が空いていれば作り直す。
+    :return: 使えるワーカー。作り直せない場合は None（このプロセスで処理する）
+    """
+    global _executor, _restart_backoff, _next_restart
+    with _restart_lock:
+        if _executor is not None and _executor is not broken:
+            return _executor    # 別のスレッドが先に作り直した
+        if _executor is not None:
+            _executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+        now = perf_counter()
+        if _start_args is None or now < _next_restart:
+            return None
+        _restart_backoff = min(max(RESTART_BACKOFF_SECONDS, _restart_backoff * 2), RESTART_BACKOFF_MAX_SECONDS)
+        _next_restart = now + _restart_backoff
+        logging.warning(f"オフロード: ワーカーを作り直します。(次に作り直せるのは {_restart_backoff:.0f}秒後)")
+        _executor = _create(*_start_args)
+        for _ in range(_start_args[0]):
+            _executor.submit(_warm_up_job)
+        return _executor
+
+def _healthy():
+    """作り直したワーカーが間隔を過ぎても動いていれば、作り直しの間隔を最短に戻す"""
+    global _restart_backoff
+    if _restart_backoff and perf_counter() >= _next_restart:
+        with _restart_lock:
+            _restart_backoff = 0.0
+
+def worker_pids() -> list[int]:
+    """動いているワーカープロセスの pid（メモリの上限の確認に使う）"""
+    with _pids_lock:
+        queue = _pid_queue
+        while queue is not None and not queue.empty():
+            _pids.add(queue.get())
+        # 終了したワーカー（ワーカーの作り直し・異常終了）は除く
+        _pids.difference_update([pid for pid in _pids if not os.path.exists(f"/proc/{pid}")])
+        return sorted(_pids)
+
+def shutdown():
+    global _executor, _inline_executor, _start_args
+    _start_args = None      # 明示的に止めた場合は作り直さない
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+    if _inline_executor is not None:
+        _inline_executor.shutdown(wait=False, cancel_futures=True)
+        _inline_executor = None
+
+def _call(job, make_args, deadline=None, rollback=None):
+    """
+    ワーカーで job を実行する。ワーカーが使えない場合はこのプロセスで実行する（deadline があればスレッドで実行して待つ）。
+    make_args(shared) は引数を作る関数で、shared=True なら大きなデータを共有メモリに置く。
+    deadline を過ぎた場合は rollback() を呼び（実行中なら終わった後にも呼ぶ）、Cancelled を送出する。
+    """
+    if deadline is not None:
+        deadline.check(job.__name__)
+    executor = _executor if _executor is not None else _restart()
+    # 異常終了した場合は、作り直したワーカーでもう一度だけ実行する
+    for _ in range(2):
+        if executor is None:
+            break
+        args = make_args(True)
+        try:
+            future = executor.submit(job, *args)
+        except (BrokenProcessPool, RuntimeError):
+            # 別のスレッドが先に異常終了に気付いてワーカーを止めた
+            for arg in args:
+                _discard(arg)
+            executor = _restart(executor)
+            continue
+        try:
+            result = _wait(future, job, args, deadline, rollback)
+        except BrokenProcessPool as e:
+            logging.error(f"オフロード: ワーカーが異常終了しました ({job.__name__}): {e}")
+            for arg in args:
+                _discard(arg)
+            executor = _restart(executor)
+            continue
+        except Cancelled:
+            raise
+        except Exception:
+            # 処理そのものの失敗は、ワーカーを止めずにそのまま送出する
+            for arg in args:
+                _discard(arg)
+            raise
+        _healthy()
+        return result
+    if _start_args is not None:
+        logging.warning(f"オフロード: ワーカーを使えないため、このプロセスで処理します ({job.__name__})")
+    if deadline is None:
+        return job(*make_args(False))
+    # このプロセスで行う場合も、期限を過ぎたら処理の終わりを待たずに Cancelled を送出する
+    args = make_args(False)
+    return _wait(_inline().submit(job, *args), job, args, deadline, rollback)
+
+def _inline() -> ThreadPoolExecutor:
+    global _inline_executor
+    if _inline_executor is None:
+        _inline_executor = ThreadPoolExecutor(max_workers=INLINE_THREADS, thread_name_prefix="offload-inline")
+    return _inline_executor
+
+def _wait(future, job, args, deadline, rollback):
+    """
+    future の結果を返す。deadline を過ぎた場合は rollback() を呼び（実行中なら終わった後にも呼ぶ）、
+    Cancelled を送出する
+    """
+    while deadline is not None and not future.done():
+        wait([future], timeout=CANCEL_POLL_SECONDS)
+        if not future.done() and deadline.expired():
+            if not future.cancel():
+                future.add_done_callback(lambda f: _abandon(f, rollback))
+            else:
+                for arg in args:
+                    _discard(arg)
+            if rollback:
+                rollback()
+            deadline.check(job.__name__)
+    return future.result()
+
+def _abandon(future, rollback):
+    """【取り消した後に終わった処理】結果を捨て、共有メモリと途中の成果物を片付ける"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    for ref in [result] if _is_shared(result) else (result if isinstance(result, tuple) else []):
+        _discard(ref)
+    if rollback:
+        rollback()
+
+def _discard(ref):
+    """ワーカーが受け取らなかった共有メモリを解放する"""
+    if _is_shared(ref):
+        try:
+            shm = shared_memory.SharedMemory(name=ref[1])
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def encode_pcm(data, channels, rate, profile, path, deadline=None) -> bool:
+    """
+    int16 の PCM をプロファイルの形式に変換・エンコードして path に保存する。
+    期限を過ぎた場合は path を削除して Cancelled を送出する
+    """
+    return _call(_encode_job, lambda shared: (_share(data) if shared else data, channels, rate, profile, path),
+                 deadline, rollback=lambda: _remove(path))
+
+def decode_track(path=None, base64_data=None, bpm=None, min_color=DEFAULT_MIN_COLOR, max_color=DEFAULT_MAX_COLOR,
+                 deadline=None):
+    """
+    音声ファイル（path）または base64 の MP3 をデコードしてモノラルにする。
+    bpm を指定すると演出データ（jellyfish.compile_show の結果）も同じワーカーで計算する。
+
+    :return: (AudioSegment, 演出データ または None)。失敗した場合は (None, None)
+    """
+    from pydub import AudioSegment
+    show_args = (bpm, min_color, max_color) if bpm else None
+
+    def make_args(shared):
+        data = base64_data.encode("ascii") if base64_data else None
+        return (path, _share(data) if shared and data else data, show_args)
+
+    import memory_budget
+    result = _call(_decode_job, make_args, deadline)
+    memory_budget.stats.merge(result[-1])
+    if result[0] is None:
+        return None, None
+    pcm_ref, frame_rate, sample_width, show, _ = result
+    audio = AudioSegment(data=_receive(pcm_ref), sample_width=sample_width, frame_rate=frame_rate, channels=1)
+    return audio, show
+
+def compile_show(mono_audio, bpm, min_color, max_color) -> dict:
+    """デコード済みの音声から演出データを計算する"""
+    data = mono_audio.raw_data
+    return _call(_show_job, lambda shared: (_share(data) if shared else data, mono_audio.frame_rate,
+                                            mono_audio.sample_width, (bpm, min_color, max_color)))
+
+def build_body(path, bme280_data, tsl2572_data) -> bytes | None:
+    """/api/v1/data に送る JSON（音声の base64 を含む）をバイト列で作る"""
+    ref = _call(_body_job, lambda shared: (path, bme280_data, tsl2572_data))
+    return None if ref is None else _receive(ref)
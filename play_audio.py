@@ -4,19 +4,31 @@ import simpleaudio as sa
 import logging
 import base64
 import io
+import subprocess
 
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import numpy as np
+
+from playback import CallbackPlayer, StreamPlayer, FRAMES_PER_BUFFER
+from memory_budget import measure
+
+BACKEND_SIMPLEAUDIO = "simpleaudio"
+BACKEND_PYAUDIO = "pyaudio"
+PLAYBACK_BACKEND = BACKEND_SIMPLEAUDIO
+PLAYBACK_FRAMES_PER_BUFFER = FRAMES_PER_BUFFER
+PLAYBACK_REFERENCE = None   # echo_cancel.PlaybackReference（録音を続けたまま再生する場合）
+STREAM_RATE = 44100         # ストリーミング再生でデコードするサンプリング周波数
+PREVIEW_RATE = 2000         # ストリーミング再生の演出の計算に使う、低いサンプリング周波数でのデコード
 
 def get_audio_data(base64_data: str):
     try:
         # Base64データをデコード
-        audio_data = base64.b64decode(base64_data)
-        # デコードしたデータをインメモリファイルとして扱う
-        audio_file = io.BytesIO(audio_data)
-        
-        audio = AudioSegment.from_mp3(audio_file)
-        mono_audio = audio.set_channels(1)
+        with measure("get_audio_data"):
+            audio_data = base64.b64decode(base64_data)
+            # デコードしたデータをインメモリファイルとして扱う
+            audio_file = io.BytesIO(audio_data)
+
+            audio = AudioSegment.from_mp3(audio_file)
+            mono_audio = audio.set_channels(1)
         return mono_audio
     except CouldntDecodeError as e:
         logging.error(f"音声ファイルのデコードに失敗しました: {e}")
@@ -25,15 +37,76 @@ def get_audio_data(base64_data: str):
         logging.error(f"音声データの取得中に予期せぬエラーが発生しました: {e}")
         return None
 
+def load_audio_file(path: str):
+    """保存済みの音声ファイルを読み込み、モノラルにして返す"""
+    try:
+        with measure("load_audio_file"):
+            audio = AudioSegment.from_file(path)
+            return audio.set_channels(1)
+    except CouldntDecodeError as e:
+        logging.error(f"音声ファイルのデコードに失敗しました: {e}")
+        return None
+    except Exception as e:
+        logging.error(f"音声ファイルの読み込み中に予期せぬエラーが発生しました: {e}")
+        return None
 
 def play_audio(mono_audio):
+    """
+    PLAYBACK_BACKEND で再生を開始し、再生オブジェクトを返す。
+    BACKEND_PYAUDIO の場合は position() で再生位置を取得できる CallbackPlayer を返す。
+    """
     if mono_audio is None:
         logging.error("音声データがNoneのため、再生できません。")
         return None
     try:
         playback_data = mono_audio.raw_data
+        if PLAYBACK_BACKEND == BACKEND_PYAUDIO:
+            return CallbackPlayer(playback_data, mono_audio.channels, mono_audio.frame_rate,
+                                  PLAYBACK_FRAMES_PER_BUFFER, reference=PLAYBACK_REFERENCE).start()
         play_obj = sa.play_buffer(playback_data, 1, 2, mono_audio.frame_rate)
         return play_obj
     except Exception as e:
         logging.error(f"音声の再生準備中にエラーが発生しました: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def open_pcm_stream(path: str, rate=STREAM_RATE) -> subprocess.Popen:
+    """音声ファイルを ffmpeg でモノラルの int16 PCM にデコードし、標準出力から少しずつ読めるようにする"""
+    command = [AudioSegment.converter, "-v", "error", "-nostdin", "-i", path,
+               "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(rate), "-"]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+def _close_process(process):
+    process.kill()
+    process.stdout.close()
+    process.wait()
+
+def play_audio_stream(path: str, duration=None):
+    """
+    曲全体をメモリに載せずに、音声ファイルをデコードしながら再生する（playback.StreamPlayer）。
+    メモリの上限を超える曲の再生に使う。再生方式は PLAYBACK_BACKEND に関係なく PyAudio になる
+    """
+    try:
+        process = open_pcm_stream(path)
+        return StreamPlayer(process.stdout, 1, STREAM_RATE, PLAYBACK_FRAMES_PER_BUFFER,
+                            reference=PLAYBACK_REFERENCE, duration=duration,
+                            on_close=lambda: _close_process(process)).start()
+    except Exception as e:
+        logging.error(f"ストリーミング再生の準備中にエラーが発生しました: {e}")
+        return None
+
+def decode_preview(path: str, rate=PREVIEW_RATE):
+    """
+    演出の計算用に、音声ファイルを低いサンプリング周波数のモノラルでデコードする
+    （44.1kHz の 1/20 程度の大きさで済む）。:return: int16 のサンプル配列。失敗した場合は None
+    """
+    try:
+        with measure("decode_preview"):
+            process = open_pcm_stream(path, rate)
+            try:
+                data = process.stdout.read()
+            finally:
+                _close_process(process)
+        return np.frombuffer(data, dtype=np.int16)
+    except Exception as e:
+        logging.error(f"演出用のデコードに失敗しました: {e}")
+        return None
@@ -0,0 +1,606 @@
+"""
+PyAudio のコールバックストリームによる再生。
+
+simpleaudio の再生オブジェクトは is_playing() / wait_done() しか持たないため、
+LED やサーボは経過時間から再生位置を推測するしかなかった。CallbackPlayer はコールバックで
+渡したフレームと、そのフレームがスピーカーから出る時刻（DAC 時刻）を記録し、
+今聞こえている位置をフレーム単位で返す。一時停止・シーク・停止にも対応する。
+
+PlaylistPlayer は1本のストリームで複数の曲を続けて再生し、曲の変わり目を重ねてクロスフェードする。
+StreamPlayer は曲全体をメモリに載せずに、デコーダーの出力を先読みしながら再生する。
+
+出力先（sink）は差し替えられる。NullSink はサウンドカードの無い環境で同じタイミングで
+コールバックを呼び、出力した PCM を記録する。
+"""
+import math
+import logging
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+import numpy as np
+import pyaudio
+
+from audio_profile import resample_poly
+
+FRAMES_PER_BUFFER = 256     # 小さいほど低遅延（44.1kHz で約5.8ms）
+POSITION_HISTORY = 32       # 再生位置の計算に使う直近のバッファ数（出力の遅延の間に出力するバッファ数に加える余裕）
+CROSSFADE_SECONDS = 3.0     # プレイリストの曲の変わり目を重ねる長さ
+SKIP_FADE_SECONDS = 0.5     # スキップしたときのフェードアウトの長さ
+STREAM_BUFFER_SECONDS = 2.0 # ストリーミング再生で先読みする長さ
+STREAM_READ_BUFFERS = 16    # ストリーミング再生で1回に読む量（コールバックのバッファ数）
+STREAM_START_TIMEOUT = 5.0  # ストリーミング再生で最初のデータを待つ上限[s]
+
+def _position_history(output_latency, frames_per_buffer, rate) -> deque:
+    """
+    再生位置の計算に使う (先頭フレーム, DAC 時刻, フレーム数) の履歴。
+    DAC 時刻が現在以前のバッファが常に残るよう、出力の遅延の間に出力するバッファ数（の2倍）に
+    POSITION_HISTORY を加えた数だけ保持する
+    """
+    in_flight = int(np.ceil(output_latency * rate / max(frames_per_buffer, 1)))
+    return deque(maxlen=2 * in_flight + POSITION_HISTORY)
+
+def _heard_frame(history, now, rate, fallback) -> float:
+    """(先頭フレーム, DAC 時刻, フレーム数) の履歴から、今スピーカーから出ているフレームを求める"""
+    # DAC 時刻が現在以前のバッファのうち最新のものを使い、その中を線形に補間する
+    for start, dac_time, frames in reversed(history):
+        if dac_time <= now:
+            return min(start + (now - dac_time) * rate, start + frames)
+    if history:
+        return history[0][0]
+    return fallback
+
+class PyAudioSink:
+    """PyAudio の出力ストリーム"""
+    def __init__(self, device_index=None):
+        self.device_index = device_index
+        self.output_latency = 0.0
+        self._audio = None
+        self._stream = None
+        self._callback = None
+
+    def open(self, channels, rate, frames_per_buffer, callback):
+        """callback(frame_count, dac_delay) -> (bytes, done) を出力のたびに呼ぶストリームを開く"""
+        self._callback = callback
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(format=pyaudio.paInt16,
+                                        channels=channels,
+                                        rate=rate,
+                                        output=True,
+                                        output_device_index=self.device_index,
+                                        frames_per_buffer=frames_per_buffer,
+                                        stream_callback=self._on_callback,
+                                        start=False)
+        self.output_latency = self._stream.get_output_latency()
+
+    def _on_callback(self, in_data, frame_count, time_info, status):
+        # DAC 時刻が取れないドライバでは、ストリームの出力遅延で代用する
+        dac = time_info.get("output_buffer_dac_time", 0.0) if time_info else 0.0
+        current = time_info.get("current_time", 0.0) if time_info else 0.0
+        delay = dac - current if dac and current else self.output_latency
+        data, done = self._callback(frame_count, delay)
+        return (data, pyaudio.paComplete if done else pyaudio.paContinue)
+
+    def start(self):
+        self._stream.start_stream()
+
+    def is_active(self) -> bool:
+        return self._stream is not None and self._stream.is_active()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._audio.terminate()
+            self._stream = None
+
+class NullSink:
+    """
+    サウンドカードの代わり。実時間でコールバックを呼び、出力した PCM を output に貯める。
+    latency は DAC までの遅延として報告する値。
+    """
+    def __init__(self, latency=0.0, capture=True):
+        self.output_latency = latency
+        self.capture = capture
+        self.output = bytearray()
+        self._thread = None
+        self._active = False
+
+    def open(self, channels, rate, frames_per_buffer, callback):
+        self._rate = rate
+        self._frames_per_buffer = frames_per_buffer
+        self._callback = callback
+
+    def start(self):
+        self._active = True
+        self._thread = threading.Thread(target=self._run, name="null-sink", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        next_tick = perf_counter()
+        while self._active:
+            data, done = self._callback(self._frames_per_buffer, self.output_latency)
+            if self.capture:
+                self.output += data
+            if done:
+                # 最後のバッファが DAC から出終わるまで待つ
+                sleep(self.output_latency + self._frames_per_buffer / self._rate)
+                break
+            next_tick += self._frames_per_buffer / self._rate
+            sleep(max(0.0, next_tick - perf_counter()))
+        self._active = False
+
+    def is_active(self) -> bool:
+        return self._active
+
+    def close(self):
+        self._active = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1.0)
+
+class CallbackPlayer:
+    """
+    int16 の PCM をコールバックストリームで再生する。simpleaudio の再生オブジェクトと同じく
+    is_playing() / wait_done() / stop() を持ち、加えて position() で今聞こえている位置を返す。
+    reference（echo_cancel.PlaybackReference）を渡すと、出力したバッファを DAC 時刻と共に書き込む。
+    """
+    def __init__(self, pcm: bytes, channels: int, rate: int, frames_per_buffer=FRAMES_PER_BUFFER, sink=None,
+                 reference=None):
+        self.channels = channels
+        self.rate = rate
+        self.reference = reference
+        self._samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+        self._lock = threading.Lock()
+        self._next_frame = 0        # 次のコールバックで渡すフレーム
+        self._paused = False
+        self._stopped = False
+        self._silence = bytes(frames_per_buffer * channels * 2)
+        self._sink = sink or PyAudioSink()
+        self._sink.open(channels, rate, frames_per_buffer, self._callback)
+        # (先頭フレーム, DAC 時刻, フレーム数)。出力の遅延はストリームを開いてから分かる
+        self._history = _position_history(self._sink.output_latency, frames_per_buffer, rate)
+
+    @property
+    def output_latency(self) -> float:
+        """書き込んでからスピーカーから出るまでの遅延[s]"""
+        return self._sink.output_latency
+
+    @property
+    def duration(self) -> float:
+        return len(self._samples) / self.rate
+
+    def start(self):
+        self._sink.start()
+        return self
+
+    def _callback(self, frame_count, dac_delay):
+        """【オーディオのスレッド】次のバッファを返す。:return: (bytes, 最後のバッファか)"""
+        with self._lock:
+            if self._stopped:
+                return (bytes(frame_count * self.channels * 2), True)
+            if self._paused:
+                return (self._silence[:frame_count * self.channels * 2], False)
+            start = self._next_frame
+            chunk = self._samples[start:start + frame_count]
+            self._next_frame = start + len(chunk)
+            dac_time = perf_counter() + dac_delay
+            self._history.append((start, dac_time, len(chunk)))
+            done = self._next_frame >= len(self._samples)
+        if self.reference is not None:
+            self.reference.write(chunk, self.channels, self.rate, dac_time)
+        data = chunk.tobytes()
+        if len(chunk) < frame_count:
+            data += bytes((frame_count - len(chunk)) * self.channels * 2)
+        return (data, done)
+
+    def position(self) -> float:
+        """今スピーカーから出ている位置[s]。一時停止中は止まり、シーク直後はシーク先を返す"""
+        now = perf_counter()
+        with self._lock:
+            history = list(self._history)
+            fallback = self._next_frame
+        return _heard_frame(history, now, self.rate, fallback) / self.rate
+
+    def frame_position(self) -> int:
+        return int(self.position() * self.rate)
+
+    def pause(self):
+        with self._lock:
+            self._paused = True
+
+    def resume(self):
+        with self._lock:
+            self._paused = False
+
+    def seek(self, seconds: float):
+        frame = int(np.clip(seconds * self.rate, 0, len(self._samples)))
+        with self._lock:
+            self._next_frame = frame
+            self._history.clear()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        self._sink.close()
+
+    def is_playing(self) -> bool:
+        return not self._stopped and self._sink.is_active()
+
+    def wait_done(self):
+        while self.is_playing():
+            sleep(0.01)
+        self._sink.close()
+
+class StreamPlayer:
+    """
+    曲全体をメモリに載せずに、source（ffmpeg の標準出力など read(n) できるもの）から int16 の PCM を
+    少しずつ読んで再生する。読み込みのスレッドが buffer_seconds 分まで先読みし、コールバックは
+    それを渡すだけにする。読み込みが間に合わなかったバッファは無音にする（metrics の underruns）。
+    duration が分かっている場合は渡しておくと、LED・サーボの演出が曲の長さを使える。
+    """
+    def __init__(self, source, channels: int, rate: int, frames_per_buffer=FRAMES_PER_BUFFER, sink=None,
+                 reference=None, buffer_seconds=STREAM_BUFFER_SECONDS, duration=None, on_close=None):
+        self.channels = channels
+        self.rate = rate
+        self.reference = reference
+        self.duration = duration
+        self.metrics = {"underruns": 0, "read_bytes": 0}
+        self._source = source
+        self._on_close = on_close
+        self._frame_bytes = channels * 2
+        self._chunk_bytes = frames_per_buffer * self._frame_bytes * STREAM_READ_BUFFERS
+        self._max_chunks = max(int(buffer_seconds * rate / (frames_per_buffer * STREAM_READ_BUFFERS)), 2)
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._chunks = deque()      # 先読みした PCM
+        self._offset = 0            # _chunks[0] の中で次に渡すバイト
+        self._eof = False
+        self._next_frame = 0
+        self._stopped = False
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_loop, name="stream-reader", daemon=True)
+        self._sink = sink or PyAudioSink()
+        self._sink.open(channels, rate, frames_per_buffer, self._callback)
+        self._history = _position_history(self._sink.output_latency, frames_per_buffer, rate)
+
+    @property
+    def output_latency(self) -> float:
+        return self._sink.output_latency
+
+    def start(self):
+        self._reader.start()
+        # 最初のバッファが揃うまで待ってから出力を始める（始まりの無音を避ける）
+        with self._room:
+            self._room.wait_for(lambda: self._chunks or self._eof or self._stopped, timeout=STREAM_START_TIMEOUT)
+        self._sink.start()
+        return self
+
+    def _read_loop(self):
+        """【読み込みのスレッド】先読みが buffer_seconds に達するまで source を読む"""
+        pending = b""   # フレームの途中で切れた分
+        try:
+            while True:
+                with self._room:
+                    self._room.wait_for(lambda: len(self._chunks) < self._max_chunks or self._stopped)
+                    if self._stopped:
+                        return
+                data = self._source.read(self._chunk_bytes)
+                if not data:
+                    return
+                data = pending + data
+                usable = len(data) - len(data) % self._frame_bytes
+                pending = data[usable:]
+                if not usable:
+                    continue
+                with self._room:
+                    self._chunks.append(data[:usable])
+                    self.metrics["read_bytes"] += usable
+                    self._room.notify_all()
+        except Exception as e:
+            logging.error(f"ストリーミング再生の読み込みに失敗しました: {e}")
+        finally:
+            with self._room:
+                self._eof = True
+                self._room.notify_all()
+
+    def _take(self, nbytes) -> bytes:
+        """【ロックを取った状態で呼ぶ】先読みした PCM から最大 nbytes を取り出す"""
+        parts = []
+        while nbytes and self._chunks:
+            head = self._chunks[0]
+            part = head[self._offset:self._offset + nbytes]
+            parts.append(part)
+            nbytes -= len(part)
+            self._offset += len(part)
+            if self._offset >= len(head):
+                self._chunks.popleft()
+                self._offset = 0
+        return b"".join(parts)
+
+    def _callback(self, frame_count, dac_delay):
+        """【オーディオのスレッド】次のバッファを返す。:return: (bytes, 最後のバッファか)"""
+        nbytes = frame_count * self._frame_bytes
+        with self._lock:
+            if self._stopped:
+                return (bytes(nbytes), True)
+            data = self._take(nbytes)
+            self._room.notify_all()
+            done = self._eof and not self._chunks
+            if len(data) < nbytes and not done:
+                self.metrics["underruns"] += 1
+            start = self._next_frame
+            frames = len(data) // self._frame_bytes
+            self._next_frame = start + frames
+            dac_time = perf_counter() + dac_delay
+            if frames:
+                self._history.append((start, dac_time, frames))
+        if self.reference is not None and frames:
+            self.reference.write(np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels),
+                                 self.channels, self.rate, dac_time)
+        if len(data) < nbytes:
+            data += bytes(nbytes - len(data))
+        return (data, done)
+
+    def buffered_bytes(self) -> int:
+        """先読みして、まだ出力していない PCM のバイト数"""
+        with self._lock:
+            return sum(len(chunk) for chunk in self._chunks) - self._offset
+
+    def position(self) -> float:
+        now = perf_counter()
+        with self._lock:
+            history = list(self._history)
+            fallback = self._next_frame
+        return _heard_frame(history, now, self.rate, fallback) / self.rate
+
+    def _close(self):
+        self._sink.close()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._on_close is not None:
+            try:
+                self._on_close()
+            except Exception as e:
+                logging.error(f"ストリーミング再生の終了処理に失敗しました: {e}")
+
+    def stop(self):
+        with self._room:
+            self._stopped = True
+            self._room.notify_all()
+        self._close()
+
+    def is_playing(self) -> bool:
+        return not self._stopped and self._sink.is_active()
+
+    def wait_done(self):
+        while self.is_playing():
+            sleep(0.01)
+        self._close()
+
+class PlaylistTrack:
+    """
+    PlaylistPlayer に追加した1曲。CallbackPlayer と同じく position() / is_playing() を持ち、
+    LED・サーボを曲ごとに同期させるのに使う。時刻・長さは再生全体の時間軸のフレーム数。
+    """
+    def __init__(self, player, samples):
+        self.player = player
+        self.samples = samples      # 出力し終わると None にしてメモリを解放する
+        self.nbytes = samples.nbytes
+        self.start = None
+        self.length = len(samples)
+        self.fade_in = 0
+        self.fade_out = 0
+        self.next = None
+
+    @property
+    def end(self) -> int:
+        return self.start + self.length
+
+    @property
+    def duration(self) -> float:
+        return self.length / self.player.rate
+
+    @property
+    def fade_in_seconds(self) -> float:
+        return self.fade_in / self.player.rate
+
+    def position(self) -> float:
+        """この曲の中で今聞こえている位置[s]"""
+        return float(np.clip(self.player.heard_frame() - self.start, 0, self.length)) / self.player.rate
+
+    def is_playing(self) -> bool:
+        """次の曲に切り替わる（次の曲のフェードインが始まる）まで True"""
+        handover = self.next.start if self.next is not None else self.end
+        return self.player.is_playing() and self.player.heard_frame() < handover
+
+    def stop(self):
+        self.player.stop()
+
+    def wait_done(self):
+        while self.is_playing():
+            sleep(0.01)
+
+class PlaylistPlayer:
+    """
+    int16 の PCM を曲ごとに追加しながら、1本のコールバックストリームで切れ目なく再生する。
+
+    曲は追加した順に、前の曲の終わり crossfade 秒と次の曲の始まりを重ねて等パワーで
+    クロスフェードする。次の曲の追加が前の曲の終わりに間に合わなかった場合だけ無音が入る
+    （metrics の gaps）。finish() の後、最後の曲が終わると再生を終える。
+    """
+    def __init__(self, channels: int, rate: int, crossfade=CROSSFADE_SECONDS, frames_per_buffer=FRAMES_PER_BUFFER,
+                 sink=None, reference=None, skip_fade=SKIP_FADE_SECONDS):
+        self.channels = channels
+        self.rate = rate
+        self.crossfade_frames = int(crossfade * rate)
+        self.skip_fade_frames = max(int(skip_fade * rate), 1)
+        self.reference = reference
+        self.metrics = {"tracks": 0, "gaps": 0, "gap_seconds": 0.0, "skips": 0}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._tracks = []           # 出力中・出力待ちの曲（開始フレーム順）
+        self._last = None           # 最後に追加した曲
+        self._written = 0           # コールバックで渡したフレーム数（全体の時間軸）
+        self._finished = False
+        self._stopped = False
+        self._sink = sink or PyAudioSink()
+        self._sink.open(channels, rate, frames_per_buffer, self._callback)
+        self._history = _position_history(self._sink.output_latency, frames_per_buffer, rate)
+
+    @property
+    def output_latency(self) -> float:
+        return self._sink.output_latency
+
+    def start(self):
+        self._sink.start()
+        return self
+
+    def enqueue(self, pcm: bytes, channels: int, rate: int) -> PlaylistTrack:
+        """曲を追加する。チャンネル数・サンプリング周波数が違う場合はこのプレイヤーに合わせる"""
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+        if channels != self.channels:
+            mono = samples.mean(axis=1, keepdims=True)
+            samples = np.repeat(mono, self.channels, axis=1).astype(np.int16)
+        if rate != self.rate and len(samples):
+            resampled = resample_poly(samples.astype(np.float32), rate, self.rate)
+            samples = np.clip(np.rint(resampled), -32768, 32767).astype(np.int16)
+        track = PlaylistTrack(self, samples)
+        with self._lock:
+            if self._stopped or self._finished:
+                raise RuntimeError("playlist is closed")
+            self._chain(self._last, track)
+            self._tracks.append(track)
+            self._last = track
+            self.metrics["tracks"] += 1
+        return track
+
+    def _chain(self, prev, track):
+        """【ロックを取った状態で呼ぶ】track を prev に続けて鳴らすように、開始フレームとフェードを決める"""
+        if prev is not None:
+            prev.next = track
+        if prev is None or prev.end <= self._written:
+            if prev is not None and prev.end < self._written:
+                self.metrics["gaps"] += 1
+                self.metrics["gap_seconds"] += (self._written - prev.end) / self.rate
+            track.start = self._written
+            track.fade_in = 0
+            return
+        if prev.fade_out and prev.end - prev.fade_out <= self._written:
+            # フェードアウトが始まっている（スキップした）場合は、残りの区間に重ねる
+            track.start = self._written
+        else:
+            overlap = min(self.crossfade_frames, prev.length, track.length)
+            track.start = max(prev.end - overlap, self._written)
+            prev.fade_out = prev.end - track.start
+        track.fade_in = min(prev.end - track.start, track.length)
+
+    def skip(self):
+        """今の曲を SKIP_FADE_SECONDS でフェードアウトし、次の曲があればすぐに始める"""
+        with self._lock:
+            now = self._written
+            current = None
+            for track in self._tracks:
+                if track.start <= now < track.end:
+                    current = track
+            if current is None or (current.fade_out and current.end - current.fade_out <= now):
+                return
+            fade = min(self.skip_fade_frames, current.end - now)
+            current.length = now - current.start + fade
+            current.fade_out = fade
+            self.metrics["skips"] += 1
+            # 後の曲を詰め直す
+            prev = current
+            for track in self._tracks:
+                if track.start > now:
+                    track.fade_out = 0
+                    self._chain(prev, track)
+                    prev = track
+
+    def finish(self):
+        """これ以上曲を追加しない（最後の曲が終わると再生を終える）"""
+        with self._lock:
+            self._finished = True
+
+    def buffered_bytes(self) -> int:
+        """出力し終わっていない曲の PCM の合計バイト数"""
+        with self._lock:
+            return sum(track.nbytes for track in self._tracks)
+
+    def pending_tracks(self) -> int:
+        """まだ始まっていない曲の数"""
+        with self._lock:
+            return sum(1 for track in self._tracks if track.start >= self._written)
+
+    def wait_changed(self, timeout):
+        """曲を出力し終わるか停止するまで待つ"""
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def _gain(self, track, index) -> np.ndarray:
+        gain = np.ones(len(index), dtype=np.float32)
+        if track.fade_in:
+            head = index < track.fade_in
+            gain[head] *= np.sin(0.5 * math.pi * (index[head] + 0.5) / track.fade_in)
+        if track.fade_out:
+            tail_start = track.length - track.fade_out
+            tail = index >= tail_start
+            gain[tail] *= np.cos(0.5 * math.pi * (index[tail] - tail_start + 0.5) / track.fade_out)
+        return gain
+
+    def _callback(self, frame_count, dac_delay):
+        """【オーディオのスレッド】重なっている曲を混ぜて次のバッファを返す。:return: (bytes, 最後のバッファか)"""
+        with self._lock:
+            if self._stopped:
+                return (bytes(frame_count * self.channels * 2), True)
+            start = self._written
+            mix = np.zeros((frame_count, self.channels), dtype=np.float32)
+            for track in self._tracks:
+                lo, hi = max(start, track.start), min(start + frame_count, track.end)
+                if hi <= lo:
+                    continue
+                index = np.arange(lo - track.start, hi - track.start)
+                mix[lo - start:hi - start] += track.samples[index[0]:index[-1] + 1] * self._gain(track, index)[:, None]
+            self._written = start + frame_count
+            finished = [track for track in self._tracks if track.end <= self._written]
+            for track in finished:
+                self._tracks.remove(track)
+                track.samples = None
+            if finished:
+                self._changed.notify_all()
+            dac_time = perf_counter() + dac_delay
+            self._history.append((start, dac_time, frame_count))
+            done = self._finished and not self._tracks
+        chunk = np.clip(np.rint(mix), -32768, 32767).astype(np.int16)
+        if self.reference is not None:
+            self.reference.write(chunk, self.channels, self.rate, dac_time)
+        return (chunk.tobytes(), done)
+
+    def heard_frame(self) -> float:
+        """今スピーカーから出ているフレーム（全体の時間軸）"""
+        now = perf_counter()
+        with self._lock:
+            history = list(self._history)
+        return _heard_frame(history, now, self.rate, 0)
+
+    def position(self) -> float:
+        return self.heard_frame() / self.rate
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        self._sink.close()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def is_playing(self) -> bool:
+        return not self._stopped and self._sink.is_active()
+
+    def wait_done(self):
+        while self.is_playing():
+            sleep(0.01)
+        self._sink.close()
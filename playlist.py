@@ -0,0 +1,98 @@
+"""
+完了した複数のタスクを続けて再生するプレイリスト。
+
+1曲ずつ再生していた頃は、曲ごとに取得・デコード・演出の計算をしてから再生を始めていたため、
+曲の間に無音が入っていた。Playlist は再生中に次の曲を先読みのスレッドで用意（prepare）し、
+playback.PlaylistPlayer に追加しておく。用意しておく曲は、出力し終わっていない PCM の合計が
+memory_budget に収まる分まで（まだ始まっていない曲が無い場合は予算に関係なく1曲用意する）。
+
+    playlist = Playlist(player, prepare_track, entries)
+    playlist.start(first)
+    for entry, show, track in playlist:     # 曲が切り替わる順に返る
+        ...
+"""
+import logging
+import threading
+from collections import deque
+
+PLAYLIST_MEMORY_BYTES = 64 * 1024 * 1024    # 44.1kHz モノラルで約12分
+BUDGET_POLL_SECONDS = 0.5
+
+class Playlist:
+    """
+    entries を順に prepare(entry) で用意して player に追加する。
+
+    prepare(entry) は先読みのスレッドで呼ばれ、(entry, AudioSegment, 演出データ) または
+    再生できない場合は None を返す。player が停止すると先読みもやめる。
+    """
+    def __init__(self, player, prepare, entries, memory_budget=PLAYLIST_MEMORY_BYTES):
+        self.player = player
+        self.prepare = prepare
+        self.entries = list(entries)
+        self.memory_budget = memory_budget
+        self.metrics = {"prepared": 0, "unavailable": 0, "max_ahead": 0, "max_buffered_bytes": 0}
+        self._ready = deque()
+        self._feeding = True
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name="playlist-prefetch", daemon=True)
+
+    def start(self, first=None):
+        """first（用意済みの1曲目）を追加して先読みを始める"""
+        if first is not None:
+            self._add(*first)
+        self._thread.start()
+        return self
+
+    def _add(self, entry, audio, show):
+        track = self.player.enqueue(audio.raw_data, audio.channels, audio.frame_rate)
+        with self._cond:
+            self._ready.append((entry, show, track))
+            self._cond.notify_all()
+        self.metrics["prepared"] += 1
+        self.metrics["max_ahead"] = max(self.metrics["max_ahead"], self.player.pending_tracks())
+        self.metrics["max_buffered_bytes"] = max(self.metrics["max_buffered_bytes"], self.player.buffered_bytes())
+        return track
+
+    def _wait_for_room(self, estimate) -> bool:
+        """次の曲（estimate バイト程度）を用意できるまで待つ。:return: 停止した場合 False"""
+        while not self.player.stopped:
+            if (self.player.pending_tracks() == 0
+                    or self.player.buffered_bytes() + estimate <= self.memory_budget):
+                return True
+            self.player.wait_changed(BUDGET_POLL_SECONDS)
+        return False
+
+    def _loop(self):
+        estimate = 0    # 次の曲の大きさの見積もり（直前の曲と同じとする）
+        try:
+            for entry in self.entries:
+                if not self._wait_for_room(estimate):
+                    return
+                try:
+                    prepared = self.prepare(entry)
+                except Exception as e:
+                    logging.error(f"プレイリスト: 曲の用意に失敗しました: {e}")
+                    prepared = None
+                if prepared is None:
+                    self.metrics["unavailable"] += 1
+                    continue
+                try:
+                    estimate = self._add(*prepared).nbytes
+                except RuntimeError:
+                    return  # 用意している間に停止した
+        finally:
+            self.player.finish()
+            with self._cond:
+                self._feeding = False
+                self._cond.notify_all()
+
+    def __iter__(self):
+        """用意できた曲を (entry, 演出データ, PlaylistTrack) の順に返す。停止するか全曲を返すと終わる"""
+        while True:
+            with self._cond:
+                while not self._ready and self._feeding and not self.player.stopped:
+                    self._cond.wait(BUDGET_POLL_SECONDS)
+                if self.player.stopped or not self._ready:
+                    return
+                item = self._ready.popleft()
+            yield item
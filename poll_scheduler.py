@@ -0,0 +1,152 @@
+"""
+プッシュ通知が使えない間の、タスクのステータス確認の間隔を決める。
+
+以前は一定間隔（60秒）で全タスクをまとめて確認していたため、完了の検出が最大60秒遅れ、
+生成中のタスクが無くてもリクエストを送り続けていた。PollScheduler は過去のタスクの
+生成時間（送信から完了まで）を覚えておき、完了しそうな時間帯のタスクだけを細かく確認する。
+
+- 完了予想の時間帯より前: 時間帯の始まりまで確認しない
+- 時間帯の中: 時間帯の幅を NEAR_POLLS 回に分けた間隔で確認する
+- 時間帯を過ぎた: 間隔を2倍ずつ延ばす（POLL_MAX_SECONDS まで）
+- 確認するタスクが無い: 確認しない（next_poll_at() が None）
+
+どの間隔にも ±POLL_JITTER の揺らぎを加え、複数台が同じ時刻に確認しないようにする。
+"""
+import random
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+DEFAULT_ETA_SECONDS = 30.0      # 生成時間の記録が少ない間の予想（mock_server.GENERATION_SECONDS と同じ）
+DEFAULT_ETA_SPREAD = 0.5        # 同上の時間帯の幅（予想の ±50%）
+ETA_HISTORY = 32                # 生成時間の予想に使う直近のタスク数
+ETA_MIN_SAMPLES = 3             # これ未満の記録しか無い場合は DEFAULT_ETA_SECONDS を使う
+ETA_PERCENTILES = (10, 50, 90)  # 完了予想の時間帯（始まり, 中央, 終わり）
+NEAR_POLLS = 4                  # 完了予想の時間帯の中で確認する回数
+POLL_MIN_SECONDS = 2.0
+POLL_MAX_SECONDS = 300.0
+POLL_JITTER = 0.2
+GIVE_UP_SECONDS = 3600.0        # 送信からこれ以上経っても完了しないタスクは確認をやめる
+
+class _Pending:
+    __slots__ = ("submitted_at", "next_at", "last_polled_at", "overdue_polls")
+
+    def __init__(self, submitted_at, next_at):
+        self.submitted_at = submitted_at
+        self.next_at = next_at
+        self.last_polled_at = None
+        self.overdue_polls = 0
+
+class PollScheduler:
+    """
+    生成中のタスクと、次に確認する時刻を管理する。
+
+    add() で送信したタスクを登録し、完了が分かったら complete() を呼ぶ。
+    確認する側は next_poll_at() の時刻になったら due() で確認するタスクを受け取る
+    （due() の時点で次の確認時刻を決めるので、確認に失敗しても詰まらない）。
+    add() のたびに changed を set するので、確認を止めているスレッドはこれで起きられる。
+    """
+    def __init__(self, eta_seconds=DEFAULT_ETA_SECONDS, clock=time.monotonic, rng: random.Random | None = None):
+        self.eta_seconds = eta_seconds
+        self.clock = clock
+        self.changed = threading.Event()
+        self.metrics = {"polls": 0, "completed": 0, "completed_by_poll": 0, "given_up": 0}
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+        self._pending = {}      # task_id -> _Pending
+        self._durations = deque(maxlen=ETA_HISTORY)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def eta(self) -> tuple[float, float, float]:
+        """完了予想の時間帯 (始まり, 中央, 終わり)。送信からの秒数"""
+        with self._lock:
+            return self._eta()
+
+    def _eta(self):
+        if len(self._durations) < ETA_MIN_SAMPLES:
+            spread = self.eta_seconds * DEFAULT_ETA_SPREAD
+            return (self.eta_seconds - spread, self.eta_seconds, self.eta_seconds + spread)
+        low, median, high = np.percentile(np.asarray(self._durations), ETA_PERCENTILES)
+        return (float(low), float(median), float(high))
+
+    def add(self, task_id, submitted_at=None):
+        """送信したタスクを登録する"""
+        now = self.clock()
+        submitted_at = now if submitted_at is None else submitted_at
+        with self._lock:
+            if task_id in self._pending:
+                return
+            task = _Pending(submitted_at, now)
+            task.next_at = self._schedule(task, now)
+            self._pending[task_id] = task
+        self.changed.set()
+
+    def complete(self, task_id, polled=False) -> float | None:
+        """
+        タスクの完了を記録し、生成時間の記録に加える。
+        polled=True（確認して分かった場合）は、前回の確認から今までの中間に完了したものとする。
+        :return: 記録した生成時間。登録されていないタスクは None
+        """
+        now = self.clock()
+        with self._lock:
+            task = self._pending.pop(task_id, None)
+            if task is None:
+                return None
+            completed_at = now
+            if polled and task.last_polled_at is not None:
+                completed_at = (task.last_polled_at + now) / 2.0
+            duration = max(completed_at - task.submitted_at, 0.0)
+            self._durations.append(duration)
+            self.metrics["completed"] += 1
+            if polled:
+                self.metrics["completed_by_poll"] += 1
+        logging.debug(f"タスク {task_id} の生成時間: {duration:.1f}秒")
+        return duration
+
+    def next_poll_at(self) -> float | None:
+        """次に確認する時刻（clock の基準）。確認するタスクが無ければ None"""
+        with self._lock:
+            if not self._pending:
+                return None
+            return min(task.next_at for task in self._pending.values())
+
+    def due(self) -> list[str]:
+        """今確認するタスクを返し、それぞれの次の確認時刻を決める"""
+        now = self.clock()
+        due = []
+        with self._lock:
+            for task_id, task in list(self._pending.items()):
+                if task.next_at > now:
+                    continue
+                if now - task.submitted_at >= GIVE_UP_SECONDS:
+                    del self._pending[task_id]
+                    self.metrics["given_up"] += 1
+                    logging.warning(f"タスク {task_id} が {GIVE_UP_SECONDS:.0f}秒経っても完了しないため、確認をやめます。")
+                    continue
+                due.append(task_id)
+                task.last_polled_at = now
+                task.next_at = self._schedule(task, now)
+            self.metrics["polls"] += len(due)
+        return due
+
+    def _schedule(self, task, now) -> float:
+        """【ロックを取った状態で呼ぶ】task を次に確認する時刻"""
+        low, _, high = self._eta()
+        age = now - task.submitted_at
+        near = max((high - low) / NEAR_POLLS, POLL_MIN_SECONDS)
+        if age < low:
+            delay = low - age
+        elif age <= high:
+            delay = near
+        else:
+            delay = near * 2 ** task.overdue_polls
+            task.overdue_polls += 1
+        delay = min(delay, POLL_MAX_SECONDS)
+        delay *= self._random.uniform(1.0 - POLL_JITTER, 1.0 + POLL_JITTER)
+        return now + max(delay, POLL_MIN_SECONDS * (1.0 - POLL_JITTER))
@@ -0,0 +1,214 @@
+"""
+実行中のプロセスを止めずにプロファイルを取るための仕組み。
+
+SIGUSR1 を受け取るか、Unix ソケットにコマンドを送ると、全スレッド（メインループ、録音、
+PyAudio のコールバック、サーボ・LED のループなど）のスタックを一定間隔でサンプリングし、
+結果をファイルに保存する。必要なら tracemalloc のスナップショットも取る。
+無効な間はスレッドもフックも動かないため、オーバーヘッドは無い。
+
+    kill -USR1 <pid>                                       # 既定の秒数だけサンプリング
+    python profiler_hooks.py --socket /tmp/fuwariumu.sock profile 30 --memory
+    python profiler_hooks.py --socket /tmp/fuwariumu.sock status
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+import tracemalloc
+from collections import Counter
+from log_config import setup_logging
+
+PROFILE_DIR = "profiles"
+PROFILE_SECONDS = 10.0
+SAMPLE_INTERVAL = 0.005     # サンプリング間隔[s]
+MEMORY_TOP_N = 30           # tracemalloc の上位何行を書き出すか
+MEMORY_FRAMES = 10          # tracemalloc で記録するスタックの深さ
+
+class ProfilerHooks:
+    """
+    サンプリングプロファイラを実行時に起動するためのシグナル・ソケットの窓口。
+
+    1回のセッションは seconds 秒で終わり、<output_dir>/<時刻>_<pid>.txt に
+    スレッドごとの関数別サンプル数と、flamegraph.pl などで読める畳み込みスタックを書き出す。
+    memory=True の場合は tracemalloc の上位の割り当てを .mem.txt に、スナップショットを .snapshot に保存する。
+    """
+    def __init__(self, output_dir=PROFILE_DIR, socket_path=None, seconds=PROFILE_SECONDS,
+                 interval=SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.socket_path = socket_path
+        self.seconds = seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._session = None
+        self._stop = threading.Event()
+        self._server = None
+        self.last_output = None
+
+    # --- 起動の窓口 ---
+    def install(self):
+        """SIGUSR1 のハンドラと（socket_path があれば）コマンド用ソケットを設定する。メインスレッドから呼ぶ"""
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+        if self.socket_path:
+            self._open_socket()
+        logging.info(f"プロファイラ: SIGUSR1 (pid {os.getpid()})"
+                     f"{' / ' + self.socket_path if self.socket_path else ''} で起動できます。")
+
+    def close(self):
+        self.stop()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+    def _on_signal(self, signum, frame):
+        # シグナルハンドラ内では重い処理をせず、セッションのスレッドを起こすだけにする
+        self.start()
+
+    def _open_socket(self):
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen(1)
+        threading.Thread(target=self._serve, name="profiler-socket", daemon=True).start()
+
+    def _serve(self):
+        server = self._server
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    command = conn.recv(1024).decode("utf-8").split()
+                    reply = self.handle_command(command)
+                except Exception as e:
+                    reply = f"error: {e}"
+                try:
+                    conn.sendall((reply + "\n").encode("utf-8"))
+                except OSError:
+                    pass
+
+    def handle_command(self, command: list[str]) -> str:
+        """
+        ソケットのコマンドを処理する。
+        profile [seconds] [--memory] / stop / status
+        """
+        if not command or command[0] == "status":
+            running = self._session is not None and self._session.is_alive()
+            return f"running={running} last_output={self.last_output}"
+        if command[0] == "profile":
+            seconds = float(command[1]) if len(command) > 1 and command[1][0].isdigit() else None
+            started = self.start(seconds, memory="--memory" in command)
+            return "started" if started else "already running"
+        if command[0] == "stop":
+            self.stop()
+            return "stopped"
+        return f"unknown command: {command[0]}"
+
+    # --- セッション ---
+    def start(self, seconds=None, memory=False) -> bool:
+        """プロファイルを開始する。既に実行中の場合は False"""
+        with self._lock:
+            if self._session is not None and self._session.is_alive():
+                return False
+            self._stop.clear()
+            self._session = threading.Thread(target=self._run, args=(seconds or self.seconds, memory),
+                                             name="profiler", daemon=True)
+            self._session.start()
+        return True
+
+    def stop(self):
+        """実行中のセッションを打ち切る（それまでの結果は書き出す）"""
+        self._stop.set()
+        session = self._session
+        if session is not None and session is not threading.current_thread():
+            session.join(timeout=5.0)
+
+    def _run(self, seconds, memory):
+        logging.info(f"プロファイラ: {seconds:.1f}秒間のサンプリングを開始します。(memory={memory})")
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES)
+            started_tracing = True
+        else:
+            started_tracing = False
+        stacks, samples = self._sample(seconds)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+        self._write_stacks(base + ".txt", stacks, samples, seconds)
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            snapshot.dump(base + ".snapshot")
+            with open(base + ".mem.txt", "w", encoding="utf-8") as f:
+                for stat in snapshot.statistics("lineno")[:MEMORY_TOP_N]:
+                    f.write(f"{stat}\n")
+        self.last_output = base + ".txt"
+        logging.info(f"プロファイラ: 結果を保存しました: {self.last_output} ({samples} サンプル)")
+
+    def _sample(self, seconds):
+        """全スレッドのスタックを interval ごとに集計する。:return: (Counter[(スレッド名, スタック)], サンプル回数)"""
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline and not self._stop.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[(names.get(ident, f"thread-{ident}"), tuple(reversed(stack)))] += 1
+            samples += 1
+            self._stop.wait(self.interval)
+        return stacks, samples
+
+    def _write_stacks(self, path, stacks: Counter, samples, seconds):
+        # スレッド・関数ごとの「自身」のサンプル数（スタックの末端）
+        self_counts = Counter()
+        for (thread, stack), count in stacks.items():
+            if stack:
+                self_counts[(thread, stack[-1])] += count
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {samples} samples over {seconds:.1f}s (interval {self.interval * 1000:.1f}ms)\n")
+            f.write("# self samples by thread/function (wall clock: blocked threads are counted too)\n")
+            for (thread, function), count in self_counts.most_common():
+                f.write(f"{count:8d} {100.0 * count / max(samples, 1):6.1f}%  [{thread}] {function}\n")
+            f.write("\n# collapsed stacks (thread;caller;...;callee count)\n")
+            for (thread, stack), count in stacks.most_common():
+                f.write(";".join((thread,) + stack) + f" {count}\n")
+
+def send_command(socket_path, command: list[str]) -> str:
+    """実行中のプロセスのソケットにコマンドを送り、応答を返す"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(" ".join(command).encode("utf-8"))
+        return conn.recv(1024).decode("utf-8").strip()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", required=True, help="main.py の --profiler_socket で指定したパス")
+    parser.add_argument("command", nargs="+", help="profile [seconds] [--memory] / stop / status")
+    args, extra = parser.parse_known_args()
+    print(send_command(args.socket, args.command + extra))
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
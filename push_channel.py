@@ -0,0 +1,144 @@
+import json
+import time
+import random
+import logging
+import threading
+import requests
+
+from api import open_task_events
+
+POLL_INTERVAL_SECONDS = 60.0
+RECONNECT_BASE_SECONDS = 2.0
+RECONNECT_MAX_SECONDS = 120.0
+READ_TIMEOUT_SECONDS = 45.0     # サーバーのハートビート間隔より長くする
+
+class TaskEventChannel:
+    """
+    タスク完了のプッシュ通知 (Server-Sent Events) を受け取るクライアント。
+
+    通知を受けると on_completed(task_id) を呼ぶ。イベントストリームに接続できない間は
+    poll_fn() を呼ぶポーリングに切り替え、バックオフしながら再接続を試みる。
+    scheduler（poll_scheduler.PollScheduler）を渡すと、その next_poll_at() の時刻に poll_fn() を呼び、
+    確認するタスクが無い間は呼ばない。渡さない場合は poll_interval 秒ごとに呼ぶ。
+    """
+    def __init__(self, on_completed, poll_fn, poll_interval=POLL_INTERVAL_SECONDS,
+                 reconnect_base=RECONNECT_BASE_SECONDS, reconnect_max=RECONNECT_MAX_SECONDS,
+                 read_timeout=READ_TIMEOUT_SECONDS, scheduler=None):
+        self.on_completed = on_completed
+        self.poll_fn = poll_fn
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.read_timeout = read_timeout
+        self.connected = False
+        self.metrics = {"events": 0, "connects": 0, "polls": 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="task-events", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self, timeout=2.0):
+        # 受信中のストリームは次のハートビートで終了する（デーモンスレッドなので待ちきらなくてよい）
+        self._stop.set()
+        if self.scheduler is not None:
+            self.scheduler.changed.set()
+        self._thread.join(timeout=timeout)
+
+    def _loop(self):
+        backoff = 0.0
+        next_poll = 0.0
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except (requests.exceptions.RequestException, ConnectionError, ValueError) as e:
+                if self._stop.is_set():
+                    return
+                if self.connected:
+                    backoff = 0.0
+                    logging.warning(f"イベントストリームが切断されました。ポーリングに切り替えます: {e}")
+                elif backoff == 0.0:
+                    logging.warning(f"イベントストリームに接続できません。ポーリングに切り替えます: {e}")
+                else:
+                    logging.debug(f"イベントストリームへの再接続に失敗しました: {e}")
+            finally:
+                self.connected = False
+
+            # 再接続までの間はポーリングで補う
+            backoff = min(self.reconnect_max, max(self.reconnect_base, backoff * 2))
+            reconnect_at = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+            while not self._stop.is_set() and time.monotonic() < reconnect_at:
+                if self.scheduler is not None:
+                    next_poll = self._scheduled_poll()
+                if next_poll is not None and time.monotonic() >= next_poll:
+                    self._poll()
+                    if self.scheduler is None:
+                        next_poll = time.monotonic() + self.poll_interval
+                    continue
+                wake_at = reconnect_at if next_poll is None else min(reconnect_at, next_poll)
+                self._wait(max(0.0, wake_at - time.monotonic()))
+
+    def _scheduled_poll(self) -> float | None:
+        """スケジューラーの次の確認時刻を time.monotonic() の基準に直す"""
+        next_at = self.scheduler.next_poll_at()
+        if next_at is None:
+            return None
+        return time.monotonic() + (next_at - self.scheduler.clock())
+
+    def _wait(self, timeout):
+        if self.scheduler is None:
+            self._stop.wait(timeout)
+        else:
+            # タスクが登録されたら、確認を止めていても予定を組み直す
+            self.scheduler.changed.wait(timeout)
+            self.scheduler.changed.clear()
+
+    def _poll(self):
+        self.metrics["polls"] += 1
+        try:
+            self.poll_fn()
+        except Exception as e:
+            logging.error(f"ステータスのポーリング中にエラーが発生しました: {e}")
+
+    def _listen(self):
+        """ストリームが切れるまでイベントを受信する"""
+        response = open_task_events(self.read_timeout)
+        self.connected = True
+        self.metrics["connects"] += 1
+        logging.info("イベントストリームに接続しました。")
+        event_type, data_lines = "message", []
+        with response:
+            # イベントは小さく間隔も空くため、1バイトずつ読んで受信した時点で処理する
+            for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                if self._stop.is_set():
+                    return
+                if line is None:
+                    continue
+                if line == "":
+                    if data_lines:
+                        self._dispatch(event_type, "\n".join(data_lines))
+                    event_type, data_lines = "message", []
+                elif line.startswith(":"):
+                    continue    # コメント（ハートビート）
+                elif line.startswith("event:"):
+                    event_type = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].strip())
+        raise ConnectionError("イベントストリームが切断されました。")
+
+    def _dispatch(self, event_type, data):
+        if event_type != "task_completed":
+            return
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError as e:
+            logging.error(f"イベントのデコードに失敗しました: {e}")
+            return
+        task_id = event.get("task_id")
+        if task_id and event.get("status", "completed") == "completed":
+            self.metrics["events"] += 1
+            try:
+                self.on_completed(task_id)
+            except Exception as e:
+                logging.error(f"タスク完了通知の処理中にエラーが発生しました: {e}")
@@ -3,23 +3,27 @@ import wave
 import logging
 import time
 import threading
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from audio_profile import convert_pcm
+from deadline import Deadline
+from log_config import setup_logging
 
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 2
 RATE = 44100
 
-def record_audio(seconds: int, filename: str, stop_event: threading.Event) -> str:
+def record_audio(seconds: int, filename: str, stop_event: threading.Event, level_monitor=None, profile=None) -> str:
     """
     ノンブロッキング（コールバック）方式で指定秒数録音し、WAVファイルとして保存する。
-    stop_eventがセットされたら録音を中断する。
+    stop_eventがセットされたらすぐに録音を中断し、ファイルは保存しない。
 
     :param seconds: 録音秒数
     :param filename: 保存ファイル名
     :param stop_event: 録音を中断するためのthreading.Eventオブジェクト
-    :return: 録音の状態 ('completed', 'interrupted', 'error')
+    :param level_monitor: activity.LevelMonitor。指定すると有音判定を行い、
+                          無音のウィンドウは保存せず、有音区間だけを保存する
+    :param profile: audio_profile.CaptureProfile。指定するとその形式に変換してから保存する
+    :return: 録音の状態 ('completed', 'interrupted', 'silent', 'error')
     """
     try:
         p = pyaudio.PyAudio()
@@ -28,6 +32,8 @@ def record_audio(seconds: int, filename: str, stop_event: threading.Event) -> st
         # コールバック関数: PyAudioが別スレッドで呼び出す
         def callback(in_data, frame_count, time_info, status):
             frames.append(in_data)
+            if level_monitor is not None:
+                level_monitor.feed(in_data)
             return (None, pyaudio.paContinue) # 録音のみなのでout_dataはNone
 
         stream = p.open(format=FORMAT,
@@ -40,41 +46,55 @@ def record_audio(seconds: int, filename: str, stop_event: threading.Event) -> st
         logging.info(f"ノンブロッキング録音を開始します... (最長{seconds}秒)")
         stream.start_stream()
 
-        start_time = time.time()
-        interrupted = False
-
         # 録音がアクティブな間、待機する
-        # 待機中に stop_event またはタイムアウトをチェック
-        while stream.is_active():
-            if stop_event.is_set():
-                logging.info("外部からの停止信号により録音を中断します。")
-                interrupted = True
-                break
-            if time.time() - start_time > seconds:
-                logging.info("指定時間が経過したため録音を終了します。")
-                break
-            time.sleep(0.1)
+        # stop_event がセットされると待機はすぐに終わる
+        deadline = Deadline(seconds, stop_event)
+        while stream.is_active() and not deadline.wait(0.5):
+            pass
+        interrupted = stop_event.is_set()
 
         logging.info("録音ストリームを停止します。")
+        if interrupted:
+            # 中断の場合は処理中のバッファを待たずに閉じ、途中までのデータは保存しない
+            logging.info("外部からの停止信号により録音を中断します。")
+            stream.close()
+            p.terminate()
+            if level_monitor is not None:
+                level_monitor.discard_window()
+            return 'interrupted'
+        logging.info("指定時間が経過したため録音を終了します。")
         stream.stop_stream()
         stream.close()
         p.terminate()
 
+        if level_monitor is not None:
+            stats = level_monitor.finish_window()
+            if not stats["keep"]:
+                return 'silent'
+            frames = level_monitor.trim_frames(frames, stats)
+
+        data = b''.join(frames)
+        channels, rate = CHANNELS, RATE
+        if profile is not None:
+            data = convert_pcm(data, CHANNELS, RATE, profile)
+            channels, rate = profile.channels, profile.sample_rate
+
         logging.info("WAVファイルに保存中...")
         with wave.open(filename, 'wb') as wf:
-            wf.setnchannels(CHANNELS)
+            wf.setnchannels(channels)
             wf.setsampwidth(p.get_sample_size(FORMAT))
-            wf.setframerate(RATE)
-            wf.writeframes(b''.join(frames))
+            wf.setframerate(rate)
+            wf.writeframes(data)
         logging.info(f"{filename} への保存が完了しました。")
 
-        return 'interrupted' if interrupted else 'completed'
+        return 'completed'
 
     except Exception as e:
         logging.error(f"録音中に予期せぬエラーが発生しました: {e}", exc_info=True)
         return 'error'
 
 if __name__ == '__main__':
+    setup_logging()
     # --- テストコード ---
     print("ノンブロッキング録音のテストを開始します。")
     
@@ -0,0 +1,349 @@
+"""
+センサーの値とウィンドウの音量の履歴を端末に残す時系列アーカイブ。
+
+API に送る値以外は捨てていたため、端末上やネットワークが切れていた間の傾向を見られなかった。
+SensorArchive は温度・気圧・湿度・照度・ウィンドウの音量（rms_db）を列ごとの numpy の
+メモリマップ（.npy）に追記し、1分・1時間・1日ごとの集計（平均・最小・最大・件数）も同時に作る。
+
+    archive/
+      raw/000000/time.npy, temperature.npy, ...   # 追記した値そのまま（無い値は NaN）
+      1m/000000/time.npy, temperature.npy, temperature_min.npy, ...
+      1h/...
+      1d/...
+
+- 各セグメントは SEGMENT_ROWS 行分を最初に確保し、満杯になると次のセグメントを作る。
+  time 列を最後に書くので、書き込み途中で止まっても time が NaN の行は無視される。
+- 合計サイズが max_bytes を超えると、細かいレベルの古いセグメントから削除する（集計は長く残る）。
+- query() は二分探索で範囲を求め、その範囲だけをメモリマップから読み出す。
+- 集計中の区間（最新の1分など）は、次の区間の値が来るまで集計のレベルには現れない。
+
+    python sensor_archive.py --hours 24 --level auto
+"""
+import os
+import math
+import shutil
+import logging
+import argparse
+import threading
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from log_config import setup_logging
+
+ARCHIVE_DIR = "archive"
+ARCHIVE_MAX_BYTES = 50 * 1024 * 1024
+SEGMENT_ROWS = 16384        # 1分に1行なら約11日分
+COLUMNS = ("temperature", "pressure", "humidity", "lux", "rms_db")
+LEVEL_RAW = "raw"
+LEVEL_AUTO = "auto"
+ROLLUPS = (("1m", 60), ("1h", 3600), ("1d", 86400))
+MAX_POINTS = 2000           # level="auto" で返す行数の目安
+
+def _schema(level) -> list[tuple[str, type]]:
+    if level == LEVEL_RAW:
+        return [("time", np.float64)] + [(name, np.float32) for name in COLUMNS]
+    schema = [("time", np.float64)]
+    for name in COLUMNS:
+        schema += [(name, np.float32), (f"{name}_min", np.float32), (f"{name}_max", np.float32),
+                   (f"{name}_count", np.int32)]
+    return schema
+
+class _Segment:
+    """1レベルの1セグメント。列ごとの .npy をメモリマップで開く"""
+    def __init__(self, directory, schema, capacity=None):
+        self.directory = directory
+        if capacity is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.columns = {}
+            # time を最後に作る（開き直したときに time が無いセグメントは作成途中のもの）
+            for name, dtype in schema[1:] + schema[:1]:
+                column = open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype, shape=(capacity,))
+                if np.issubdtype(dtype, np.floating):
+                    column[:] = np.nan
+                self.columns[name] = column
+            self.rows = 0
+        else:
+            self.columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r+")
+                            for name, _ in schema}
+            # 時刻は昇順で、未使用の行は NaN（NaN は最大として扱われる）
+            self.rows = int(np.searchsorted(self.columns["time"], np.nan))
+        self.capacity = len(self.columns["time"])
+        self.nbytes = sum(column.nbytes for column in self.columns.values())
+
+    @property
+    def first_time(self) -> float | None:
+        return float(self.columns["time"][0]) if self.rows else None
+
+    @property
+    def last_time(self) -> float | None:
+        return float(self.columns["time"][self.rows - 1]) if self.rows else None
+
+    def full(self) -> bool:
+        return self.rows >= self.capacity
+
+    def append(self, t, values: dict):
+        row = self.rows
+        for name, value in values.items():
+            self.columns[name][row] = value
+        self.columns["time"][row] = t
+        self.rows = row + 1
+
+    def span(self, rows, start, end) -> tuple[int, int]:
+        """先頭 rows 行のうち start <= time < end の行範囲"""
+        times = self.columns["time"][:rows]
+        return int(np.searchsorted(times, start, "left")), int(np.searchsorted(times, end, "left"))
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+
+class _Accumulator:
+    """集計中の1区間（列ごとの合計・件数・最小・最大）"""
+    def __init__(self, width):
+        self.width = width
+        self.bucket = None
+        self.reset()
+
+    def reset(self):
+        self.bucket = None
+        self.sums = np.zeros(len(COLUMNS))
+        self.counts = np.zeros(len(COLUMNS), dtype=np.int64)
+        self.mins = np.full(len(COLUMNS), np.nan)
+        self.maxs = np.full(len(COLUMNS), np.nan)
+
+    def add(self, means, counts, mins, maxs):
+        self.sums += np.where(counts > 0, means, 0.0) * counts
+        self.counts += counts
+        self.mins = np.fmin(self.mins, mins)
+        self.maxs = np.fmax(self.maxs, maxs)
+
+    def row(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(self.counts > 0, self.sums / np.maximum(self.counts, 1), np.nan)
+        return means, self.counts.copy(), self.mins.copy(), self.maxs.copy()
+
+class SensorArchive:
+    """
+    列指向・追記専用の時系列アーカイブ。append() は複数のスレッドから呼べる。
+
+    時刻は time.time()（UNIX 時刻）で、前の行より戻った場合は前の行の時刻に揃える。
+    """
+    def __init__(self, directory=ARCHIVE_DIR, max_bytes=ARCHIVE_MAX_BYTES, segment_rows=SEGMENT_ROWS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_rows = segment_rows
+        self.levels = [LEVEL_RAW] + [name for name, _ in ROLLUPS]
+        self.schemas = {level: _schema(level) for level in self.levels}
+        self.metrics = {"appends": 0, "rollup_rows": 0, "segments_removed": 0}
+        self._lock = threading.Lock()
+        self._segments = {level: self._load_level(level) for level in self.levels}
+        self._accumulators = [_Accumulator(width) for _, width in ROLLUPS]
+        last = self._segments[LEVEL_RAW][-1].last_time if self._segments[LEVEL_RAW] else None
+        self._last_time = last if last is not None else -math.inf
+        self._recover()
+        rows = {level: sum(segment.rows for segment in segments) for level, segments in self._segments.items()}
+        logging.info(f"アーカイブ: {directory} を開きました。{rows} ({self.total_bytes()} bytes)")
+
+    def _load_level(self, level) -> list[_Segment]:
+        directory = os.path.join(self.directory, level)
+        os.makedirs(directory, exist_ok=True)
+        segments = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            try:
+                segments.append(_Segment(path, self.schemas[level]))
+            except (OSError, ValueError) as e:
+                logging.warning(f"アーカイブ: 壊れたセグメント {path} を削除します: {e}")
+                shutil.rmtree(path, ignore_errors=True)
+        return segments
+
+    def _recover(self):
+        """
+        集計中だった区間を、1つ細かいレベルの行から作り直す。
+        粗いレベルから順に行い、細かいレベルの区間が閉じたときの値が正しく上に伝わるようにする。
+        """
+        for index in reversed(range(len(ROLLUPS))):
+            source = self.levels[index]
+            target = self._segments[self.levels[index + 1]]
+            last = target[-1].last_time if target else None
+            start = -math.inf if last is None else last + ROLLUPS[index][1]
+            rows = self.query(start, level=source)
+            for i in range(len(rows["time"])):
+                self._roll(index, rows["time"][i], *self._stats(source, rows, i))
+
+    def _stats(self, level, rows, i):
+        """query() の結果の i 行目を (平均, 件数, 最小, 最大) の列ごとの配列にする"""
+        means = np.array([rows[name][i] for name in COLUMNS], dtype=np.float64)
+        if level == LEVEL_RAW:
+            counts = (~np.isnan(means)).astype(np.int64)
+            return means, counts, means, means
+        counts = np.array([rows[f"{name}_count"][i] for name in COLUMNS], dtype=np.int64)
+        mins = np.array([rows[f"{name}_min"][i] for name in COLUMNS], dtype=np.float64)
+        maxs = np.array([rows[f"{name}_max"][i] for name in COLUMNS], dtype=np.float64)
+        return means, counts, mins, maxs
+
+    # --- 書き込み ---
+    def append(self, t=None, **values):
+        """
+        1行を追記する。values は COLUMNS のうち値があるもの（無い列は NaN になる）。
+            archive.append(temperature=24.1, humidity=40.2)
+        """
+        unknown = set(values) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown columns: {sorted(unknown)}")
+        t = time.time() if t is None else float(t)
+        means = np.array([values.get(name, np.nan) for name in COLUMNS], dtype=np.float64)
+        with self._lock:
+            t = max(t, self._last_time)
+            self._last_time = t
+            self._write(LEVEL_RAW, t, values)
+            counts = (~np.isnan(means)).astype(np.int64)
+            self._roll(0, t, means, counts, means, means)
+            self.metrics["appends"] += 1
+
+    def _roll(self, index, t, means, counts, mins, maxs):
+        """【ロックを取った状態で呼ぶ】index 番目の集計に値を加え、区間が変わったら閉じて書き込む"""
+        accumulator = self._accumulators[index]
+        bucket = math.floor(t / accumulator.width) * accumulator.width
+        if accumulator.bucket is not None and bucket > accumulator.bucket:
+            self._close_bucket(index)
+        if accumulator.bucket is None:
+            accumulator.bucket = bucket
+        accumulator.add(means, counts, mins, maxs)
+
+    def _close_bucket(self, index):
+        accumulator = self._accumulators[index]
+        bucket = accumulator.bucket
+        means, counts, mins, maxs = accumulator.row()
+        accumulator.reset()
+        values = {}
+        for i, name in enumerate(COLUMNS):
+            values[name] = means[i]
+            values[f"{name}_min"] = mins[i]
+            values[f"{name}_max"] = maxs[i]
+            values[f"{name}_count"] = counts[i]
+        self._write(self.levels[index + 1], bucket, values)
+        self.metrics["rollup_rows"] += 1
+        if index + 1 < len(ROLLUPS):
+            self._roll(index + 1, bucket, means, counts, mins, maxs)
+
+    def _write(self, level, t, values):
+        segments = self._segments[level]
+        if not segments or segments[-1].full():
+            name = "000000" if not segments else f"{int(os.path.basename(segments[-1].directory)) + 1:06d}"
+            segments.append(_Segment(os.path.join(self.directory, level, name), self.schemas[level],
+                                     self.segment_rows))
+            self._enforce_budget()
+        segments[-1].append(t, values)
+
+    def _enforce_budget(self):
+        """【ロックを取った状態で呼ぶ】容量を超えていれば、細かいレベルの古いセグメントから削除する"""
+        total = self.total_bytes()
+        for level in self.levels:
+            segments = self._segments[level]
+            while total > self.max_bytes and len(segments) > 1:
+                segment = segments.pop(0)
+                total -= segment.nbytes
+                shutil.rmtree(segment.directory, ignore_errors=True)
+                self.metrics["segments_removed"] += 1
+                logging.info(f"アーカイブ: 容量の上限を超えたため {segment.directory} を削除しました。")
+
+    def total_bytes(self) -> int:
+        return sum(segment.nbytes for segments in self._segments.values() for segment in segments)
+
+    def flush(self):
+        with self._lock:
+            for segments in self._segments.values():
+                if segments:
+                    segments[-1].flush()
+
+    def close(self):
+        self.flush()
+
+    # --- 読み出し ---
+    def count(self, start=None, end=None, level=LEVEL_RAW) -> int:
+        """start <= time < end の行数（データは読まない）"""
+        return sum(j - i for _, _, i, j in self._spans(level, start, end))
+
+    def select_level(self, start=None, end=None, max_points=MAX_POINTS) -> str:
+        """範囲の行数が max_points 以下になる最も細かいレベル（古い行を削除済みで範囲の始まりを含まないレベルは除く）"""
+        with self._lock:
+            firsts = {level: segments[0].first_time for level, segments in self._segments.items()
+                      if segments and segments[0].rows}
+        if start is not None and firsts:
+            start = max(start, min(firsts.values()))
+        for level in self.levels[:-1]:
+            first = firsts.get(level)
+            if start is not None and (first is None or first > start):
+                continue
+            if self.count(start, end, level) <= max_points:
+                return level
+        return self.levels[-1]
+
+    def query(self, start=None, end=None, level=LEVEL_RAW, columns=None, max_points=MAX_POINTS) -> dict[str, np.ndarray]:
+        """
+        start <= time < end の行を列ごとの配列で返す（"time" は必ず含む）。
+
+        - level: "raw" / "1m" / "1h" / "1d"、または "auto"（行数が max_points 以下になる最も細かいレベル）
+        - columns: 返す列。集計のレベルでは "temperature"（平均）のほか "temperature_min",
+          "temperature_max", "temperature_count" も指定できる。省略時はそのレベルのすべての列
+        """
+        if level == LEVEL_AUTO:
+            level = self.select_level(start, end, max_points)
+        if level not in self.schemas:
+            raise ValueError(f"unknown level: {level}")
+        names = [name for name, _ in self.schemas[level]]
+        if columns is not None:
+            unknown = set(columns) - set(names)
+            if unknown:
+                raise ValueError(f"unknown columns for {level}: {sorted(unknown)}")
+            names = ["time"] + [name for name in columns if name != "time"]
+        parts = {name: [] for name in names}
+        for segment, _, i, j in self._spans(level, start, end):
+            for name in names:
+                parts[name].append(np.array(segment.columns[name][i:j]))
+        dtypes = dict(self.schemas[level])
+        return {name: np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtypes[name])
+                for name, arrays in parts.items()}
+
+    def _spans(self, level, start, end):
+        """範囲に掛かるセグメントと、その中の行範囲 (segment, rows, i, j)"""
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        with self._lock:
+            segments = [(segment, segment.rows) for segment in self._segments[level]]
+        spans = []
+        for segment, rows in segments:
+            if rows == 0:
+                continue
+            times = segment.columns["time"]
+            if times[rows - 1] < start or times[0] >= end:
+                continue
+            i, j = segment.span(rows, start, end)
+            if j > i:
+                spans.append((segment, rows, i, j))
+        return spans
+
+def main():
+    parser = argparse.ArgumentParser(description="アーカイブの内容を表示する")
+    parser.add_argument("--dir", default=ARCHIVE_DIR)
+    parser.add_argument("--hours", type=float, default=24.0, help="直近の何時間分を表示するか")
+    parser.add_argument("--level", choices=[LEVEL_AUTO, LEVEL_RAW] + [name for name, _ in ROLLUPS], default=LEVEL_AUTO)
+    parser.add_argument("--columns", nargs="*", default=list(COLUMNS))
+    args = parser.parse_args()
+    archive = SensorArchive(args.dir)
+    end = time.time()
+    start = end - args.hours * 3600
+    level = archive.select_level(start, end) if args.level == LEVEL_AUTO else args.level
+    rows = archive.query(start, end, level=level, columns=args.columns)
+    print(f"level={level} rows={len(rows['time'])}")
+    print("time," + ",".join(args.columns))
+    for i in range(len(rows["time"])):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(rows["time"][i]))
+        print(stamp + "," + ",".join(f"{rows[name][i]:.2f}" for name in args.columns))
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
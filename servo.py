@@ -1,12 +1,29 @@
 from gpiozero import AngularServo
 from gpiozero.pins.pigpio import PiGPIOFactory
-from time import sleep
+from time import sleep, perf_counter
+from dataclasses import replace
 import threading
-import bisect
-from typing import Sequence, List, Optional, Tuple
+import numpy as np
+
+import trajectory
+from trajectory import AxisLimits, SHAPE_TRAPEZOID, SHAPE_MIN_JERK
+from log_config import setup_logging
+
+HOLD_SECONDS = 2.0  # 停止してから PWM を止めるまでの既定の秒数
 
 class Servo:
-    def __init__(self, pin):
+    """
+    別スレッドのループで、事前に計画した角度列を update_dt ごとに出力する。
+
+    軌道は move / move_with_profile の呼び出し側で trajectory モジュールにより
+    速度・加速度の上限と可動範囲を守るように計算し、ループは配列を順に読むだけにする。
+    軌道を出力し終えたら最後の角度のまま止まり、動かす必要が無い間はループが条件変数で待機して、
+    move / move_with_profile で即座に起きる。
+    hold_time を指定すると、停止してからその秒数が経過した時点で PWM を止め（detach）、
+    無負荷時の発熱やジッター音を抑える。次に動かすときに自動で PWM を再開する。
+    """
+    def __init__(self, pin, hold_time=None, max_velocity=trajectory.MAX_VELOCITY,
+                 max_acceleration=trajectory.MAX_ACCELERATION):
         self.SERVO_PIN = pin
         self.MIN_DEGREE = -90
         self.MAX_DEGREE = 90
@@ -16,172 +33,100 @@ class Servo:
                                   pin_factory=self.factory)
         self.update_dt = 1.0/200
         self.speed = 120
-        self._current = 0
+        self._current = 0.0
         self.target_angle = 0
+        self.limits = AxisLimits(self.MIN_DEGREE, self.MAX_DEGREE, max_velocity, max_acceleration)
 
-        self._profile_mode = False
-        self._t = []
-        self._profile_theta = []
-        self._profile_count = 0
+        self._trajectory = np.empty(0)
+        self._index = 0
 
-        self._lock = threading.Lock()
+        self.hold_time = hold_time
+        self._detached = False
+
+        self._lock = threading.Condition()
         self._event = threading.Event()
-        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread = threading.Thread(target=self._loop, name=f"servo-{pin}", daemon=True)
         self._thread.start()
 
     def close(self):
         self._event.set()
+        with self._lock:
+            self._lock.notify_all()
         self._thread.join(timeout=1.0)
         self.servo.close()
 
     def move(self, angle, speed=120):
-        # 指定した角度で指定した時間でサーボを動かす
+        # 指定した角度へ、speed[deg/s] を上限とする台形速度で動かす
+        limits = replace(self.limits, max_velocity=min(speed, self.limits.max_velocity))
+        with self._lock:
+            current = self._current
+        path = trajectory.plan_move(current, angle, self.update_dt, limits, SHAPE_TRAPEZOID)
         with self._lock:
             self.target_angle = angle
             self.speed = speed
+            self._start(path)
 
-    # time(s), angle(0-1)
-    def move_with_profile(self, t, angle):
-        self._profile_mode = True
-        self._profile_theta = self._resample_profile(t, angle, self.update_dt)
-        self._profile_count = 0
-
-    def _resample_profile(
-        self,
-        times: Sequence[float],
-        angles: Sequence[float],
-        dt: float,
-        t_start: Optional[float] = None,
-        t_end: Optional[float] = None,
-        include_endpoint: bool = True,
-        left: str = "hold",  # "hold" | "extrapolate" | "error"
-        right: str = "hold",  # "hold" | "extrapolate" | "error"
-        clamp: Optional[Tuple[float, float]] = None,  # (min_deg, max_deg)
-    ) -> List[float]:
+    # time(s), angle(deg)
+    def move_with_profile(self, t, angle, shape=SHAPE_MIN_JERK):
+        """
+        ウェイポイントを順に通る。現在角度が先頭のウェイポイントと異なる場合は、先にそこまで移動する。
+        速度・加速度の上限を超える区間は時間を延ばす（trajectory.plan を参照）。
         """
-        不等間隔 (times, angles) を線形補間し、dt ごとの角度列のみを返す。
-
-        - times: 秒。厳密な単調増加（重複なし）を仮定
-        - angles: 度。len(times) == len(angles) >= 2
-        - dt: 出力サンプリング周期 [s]
-        - t_start/t_end: 出力範囲（省略時は入力の先頭/末尾）
-        - include_endpoint: True なら t_end も含めるよう試みる
-        - left/right: 出力範囲が入力の外側にはみ出す場合の扱い
-            * "hold": 端の角度で保持
-            * "extrapolate": 端の2点で一次外挿
-            * "error": はみ出しで ValueError
-        - clamp: 角度を (min_deg, max_deg) にクリップ
+        with self._lock:
+            current = self._current
+        lead_in = trajectory.plan_move(current, angle[0], self.update_dt, self.limits, shape)
+        path = np.concatenate([lead_in, trajectory.plan(t, angle, self.update_dt, self.limits, shape)])
+        with self._lock:
+            self.target_angle = angle[-1]
+            self._start(path)
+
+    def _start(self, path):
+        """【ロックを取得した状態で呼ぶ】現在の軌道を path に置き換える"""
+        self._trajectory = path
+        self._index = 0
+        self._lock.notify_all()
+
+    def _has_motion(self):
+        return self._index < len(self._trajectory)
+
+    def _wait_for_motion(self) -> bool:
+        """
+        【ロックを取得した状態で呼ぶ】動かす必要が出るまで待機する。
+        hold_time が経過しても動きが無ければ PWM を止める。
+
+        :return: 待機した場合 True
         """
-        if dt <= 0:
-            raise ValueError("dt must be > 0")
-        if len(times) != len(angles) or len(times) < 2:
-            raise ValueError("times/angles must have same length >= 2")
-        for i in range(1, len(times)):
-            if not (times[i] > times[i - 1]):
-                raise ValueError("times must be strictly increasing (no duplicates).")
-
-        t0 = times[0] if t_start is None else t_start
-        t1 = times[-1] if t_end is None else t_end
-        if t1 < t0:
-            raise ValueError("t_end must be >= t_start")
-
-        # 進行方向に合わせて一回だけ idx を初期化（以後は単調に前進）
-        j = bisect.bisect_right(times, t0)
-        if j <= 0:
-            j = 1
-        if j >= len(times):
-            j = len(times) - 1
-
-        def interp(x: float) -> float:
-            # 左側
-            if x < times[0]:
-                if left == "hold":
-                    y = angles[0]
-                elif left == "extrapolate":
-                    x0, x1 = times[0], times[1]
-                    y0, y1 = angles[0], angles[1]
-                    m = (y1 - y0) / (x1 - x0)
-                    y = y0 + m * (x - x0)
-                else:
-                    raise ValueError(f"x={x} is left of profile (left='error').")
-                return y
-            # 右側
-            if x > times[-1]:
-                if right == "hold":
-                    y = angles[-1]
-                elif right == "extrapolate":
-                    x0, x1 = times[-2], times[-1]
-                    y0, y1 = angles[-2], angles[-1]
-                    m = (y1 - y0) / (x1 - x0)
-                    y = y1 + m * (x - x1)
-                else:
-                    raise ValueError(f"x={x} is right of profile (right='error').")
-                return y
-
-            # 中間（j は単調に増やすだけで良い）
-            nonlocal j
-            while j < len(times) - 1 and x > times[j]:
-                j += 1
-            x0, x1 = times[j - 1], times[j]
-            y0, y1 = angles[j - 1], angles[j]
-            if x1 == x0:
-                return y0
-            r = (x - x0) / (x1 - x0)
-            return y0 + (y1 - y0) * r
-
-        # 角度列を生成（タイムスタンプは返さない）
-        out: List[float] = []
-        t = t0
-        eps = dt * 1e-9
-
-        def cont(u: float) -> bool:
-            return (u <= t1 + eps) if include_endpoint else (u < t1 - eps)
-
-        while cont(t):
-            val = interp(t)
-            if clamp is not None:
-                mn, mx = clamp
-                if val < mn:
-                    val = mn
-                if val > mx:
-                    val = mx
-            out.append(val)
-            t += dt
-
-        # 範囲が極短の場合でも1点は返す（t_startのみ）
-        if not out:
-            val = interp(t0)
-            if clamp is not None:
-                mn, mx = clamp
-                if val < mn:
-                    val = mn
-                if val > mx:
-                    val = mx
-            out = [val]
-
-        return out
-        
+        if self._has_motion():
+            return False
+        woken = lambda: self._event.is_set() or self._has_motion()
+        if self.hold_time is not None and not self._detached:
+            if not self._lock.wait_for(woken, timeout=self.hold_time):
+                self.servo.detach()
+                self._detached = True
+        self._lock.wait_for(woken)
+        return True
 
     def _loop(self):
+        next_tick = perf_counter()
         while not self._event.is_set():
             with self._lock:
-                if self._profile_mode:
-                    if len(self._profile_theta)-1 <= self._profile_count:
-                        self.profile_count = 0
-                        self._profile_mode = False
-                    self.target_angle = self._profile_theta[self._profile_count]
-                    self._profile_count += 1
-                diff = self.target_angle - self._current
-                delta = self.speed * self.update_dt * (1 if 0<=diff else -1)
-                previous = self.servo.angle
-                if 1  <= abs(diff):
-                    if abs(self._current + delta) <= 90.0:
-                        self.servo.angle = self._current + delta
-                    if previous != self.servo.angle:
-                        self._current = self.servo.angle
-                    else:
-                        self._current += delta
-            self._event.wait(self.update_dt)
+                if self._wait_for_motion():
+                    next_tick = perf_counter()
+                if self._event.is_set():
+                    break
+                # detach 中でも角度を設定すれば PWM は再開する
+                self._detached = False
+                angle = float(self._trajectory[self._index])
+                self._index += 1
+                if not self._has_motion():
+                    # 軌道の最後の角度で止める（先頭の角度に戻して繰り返さない）
+                    self._trajectory = np.empty(0)
+                    self._index = 0
+                self.servo.angle = angle
+                self._current = angle
+            # 時刻の基準を固定し、処理時間によるずれが蓄積しないようにする
+            next_tick += self.update_dt
+            self._event.wait(max(0.0, next_tick - perf_counter()))
 
 def main():
     rotate = Servo(12)
@@ -207,4 +152,5 @@ def main():
 
 
 if __name__ == "__main__":
+        setup_logging()
         main()
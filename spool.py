@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SPOOL_DIR = "spool"
+SPOOL_MAX_BYTES = 200 * 1024 * 1024
+UPLOAD_CONCURRENCY = 2
+UPLOAD_BATCH_SIZE = 4
+BACKOFF_BASE_SECONDS = 5.0
+BACKOFF_MAX_SECONDS = 300.0
+MAX_ATTEMPTS = 10           # これだけ失敗したエントリは送信をあきらめて dead/ に移す
+DEAD_LETTER_DIR = "dead"    # 送信できないエントリの移動先（スプールのディレクトリの下）
+DEAD_LETTER_MAX_ENTRIES = 100
+
+class PermanentUploadError(Exception):
+    """送り直しても成功しない送信の失敗（4xx の応答、音声ファイルが無いなど）"""
+
+class UploadSpool:
+    """
+    送信待ちのウィンドウ（エンコード済み音声とセンサーデータ）をディスクに保存する有界キュー。
+
+    エントリは <id>.<拡張子>（音声）と <id>.json（センサーデータなど）の組で保存し、
+    id は作成時刻順に並ぶ。合計サイズが max_bytes を超えた場合は古い順に削除する。
+    プロセスを再起動しても、ディレクトリに残ったエントリから再開できる。
+    送信に失敗したエントリは defer() で後回しにし、送信できないエントリは dead_letter() で
+    DEAD_LETTER_DIR に移す（合計サイズには含めず、DEAD_LETTER_MAX_ENTRIES 件を超えたら古い順に削除する）。
+    """
+    def __init__(self, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._sizes = {}    # id -> 音声とメタデータの合計バイト数
+        self._deferred = {} # id -> 後回しにした順番（送信に失敗したエントリ）
+        self._defer_seq = 0
+        self.added = threading.Event()
+        self.evicted = 0
+        self._load_existing()
+
+    def _load_existing(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            entry_id = name[:-len(".json")]
+            try:
+                meta = self._read_meta(entry_id)
+                audio_path = os.path.join(self.directory, meta["audio_file"])
+                self._sizes[entry_id] = os.path.getsize(audio_path) + os.path.getsize(self._meta_path(entry_id))
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"スプール: 壊れたエントリ {entry_id} を削除します: {e}")
+                self._remove_files(entry_id)
+        if self._sizes:
+            logging.info(f"スプール: 未送信のエントリが {len(self._sizes)} 件あります。({self.total_bytes()} bytes)")
+
+    def _meta_path(self, entry_id):
+        return os.path.join(self.directory, f"{entry_id}.json")
+
+    def _read_meta(self, entry_id) -> dict:
+        with open(self._meta_path(entry_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def temp_path(self, extension: str) -> str:
+        """エンコード結果を書き込むための一時ファイルのパス（put() でエントリに移動する）"""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        return os.path.join(self.directory, f"encoding_{os.getpid()}_{seq}.{extension}.tmp")
+
+    def put(self, audio_path: str, bme280_data: dict, tsl2572_data: dict) -> str:
+        """
+        音声ファイルをスプールに移動し、センサーデータと共にエントリとして登録する。
+
+        :return: エントリID
+        """
+        with self._lock:
+            self._seq += 1
+            entry_id = f"{time.time_ns():020d}_{self._seq:06d}"
+        extension = os.path.basename(audio_path).replace(".tmp", "").rsplit(".", 1)[-1]
+        audio_file = f"{entry_id}.{extension}"
+        shutil.move(audio_path, os.path.join(self.directory, audio_file))
+
+        meta = {
+            "audio_file": audio_file,
+            "bme280": bme280_data,
+            "tsl2572": tsl2572_data,
+            "created_at": time.time(),
+            "attempts": 0,
+        }
+        self._write_meta(entry_id, meta)
+        size = os.path.getsize(os.path.join(self.directory, audio_file)) + os.path.getsize(self._meta_path(entry_id))
+        with self._lock:
+            self._sizes[entry_id] = size
+        self._evict()
+        self.added.set()
+        return entry_id
+
+    def _write_meta(self, entry_id, meta):
+        tmp_path = self._meta_path(entry_id) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path(entry_id))
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば古いエントリから削除する"""
+        while True:
+            with self._lock:
+                if sum(self._sizes.values()) <= self.max_bytes or len(self._sizes) <= 1:
+                    return
+                oldest = min(self._sizes)
+                size = self._sizes.pop(oldest)
+                self._deferred.pop(oldest, None)
+                self.evicted += 1
+            logging.warning(f"スプール: 容量上限のため最も古いエントリ {oldest} ({size} bytes) を削除しました。")
+            self._remove_files(oldest)
+
+    def entries(self) -> list[str]:
+        """エントリIDを古い順に返す。後回しにしたエントリは、その他のエントリの後に後回しにした順で並ぶ"""
+        with self._lock:
+            return sorted(self._sizes, key=lambda entry_id: (self._deferred.get(entry_id, 0), entry_id))
+
+    def defer(self, entry_id):
+        """送信に失敗したエントリを、他のエントリの後に回す"""
+        with self._lock:
+            if entry_id in self._sizes:
+                self._defer_seq += 1
+                self._deferred[entry_id] = self._defer_seq
+
+    def load(self, entry_id):
+        """:return: (音声ファイルのパス, メタデータ)"""
+        meta = self._read_meta(entry_id)
+        return os.path.join(self.directory, meta["audio_file"]), meta
+
+    def record_attempt(self, entry_id) -> int:
+        """失敗した回数を1増やす。:return: これまでに失敗した回数"""
+        try:
+            meta = self._read_meta(entry_id)
+            meta["attempts"] = meta.get("attempts", 0) + 1
+            self._write_meta(entry_id, meta)
+            return meta["attempts"]
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def dead_letter(self, entry_id, reason: str):
+        """送信できないエントリを DEAD_LETTER_DIR に移す（理由はメタデータに書き込む）"""
+        dead_dir = os.path.join(self.directory, DEAD_LETTER_DIR)
+        os.makedirs(dead_dir, exist_ok=True)
+        with self._lock:
+            self._sizes.pop(entry_id, None)
+            self._deferred.pop(entry_id, None)
+        try:
+            meta = self._read_meta(entry_id)
+            meta["dead_reason"] = reason
+            self._write_meta(entry_id, meta)
+        except (OSError, ValueError):
+            pass
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{entry_id}."):
+                try:
+                    os.replace(os.path.join(self.directory, name), os.path.join(dead_dir, name))
+                except FileNotFoundError:
+                    pass
+        logging.warning(f"スプール: エントリ {entry_id} を送信できないため {dead_dir} に移しました: {reason}")
+        # 古いものから削除して件数を抑える
+        dead_ids = sorted({name.split(".", 1)[0] for name in os.listdir(dead_dir)})
+        for old_id in dead_ids[:max(len(dead_ids) - DEAD_LETTER_MAX_ENTRIES, 0)]:
+            for name in os.listdir(dead_dir):
+                if name.startswith(f"{old_id}."):
+                    os.remove(os.path.join(dead_dir, name))
+
+    def remove(self, entry_id):
+        with self._lock:
+            self._sizes.pop(entry_id, None)
+            self._deferred.pop(entry_id, None)
+        self._remove_files(entry_id)
+
+    def _remove_files(self, entry_id):
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{entry_id}."):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sizes)
+
+class SpoolUploader:
+    """
+    スプールのエントリを古い順に送信するバックグラウンドスレッド。
+
+    最大 batch_size 件ずつ、concurrency 件まで並行に送信する。
+    失敗したエントリは後回しにし、1件も送れなかった場合は指数バックオフ（ジッター付き）で待ってから再送する。
+    同じ回に他のエントリが送れたのに失敗した（そのエントリに原因がありそうな）場合だけ失敗を数え、
+    max_attempts 回に達するか PermanentUploadError の場合は dead_letter() に移す
+    （ネットワークが切れている間の失敗は数えないので、接続が戻れば送信される）。
+    送信に成功したエントリは削除し、on_uploaded(task_id) を呼ぶ。
+    close() の後は新しい送信を始めない。送信中のリクエストはタイムアウトで終わり、
+    エントリは成功するまで残るため、途中で止めても次回の起動で送り直される。
+    """
+    def __init__(self, spool: UploadSpool, post_fn, on_uploaded=None,
+                 concurrency=UPLOAD_CONCURRENCY, batch_size=UPLOAD_BATCH_SIZE,
+                 backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.spool = spool
+        self.post_fn = post_fn
+        self.on_uploaded = on_uploaded
+        self.batch_size = batch_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_attempts = max_attempts
+        self._backoff = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="spool-upload")
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._metrics = {"uploaded": 0, "failed_attempts": 0, "dead_lettered": 0}
+        self._thread = threading.Thread(target=self._loop, name="spool-uploader", daemon=True)
+        self._thread.start()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict(self._metrics)
+
+    def _count(self, name, n=1):
+        """送信のスレッドからも呼ばれるため、ロックを取って数える"""
+        with self._lock:
+            self._metrics[name] += n
+
+    def close(self, timeout=5.0):
+        self._stop.set()
+        self.spool.added.set()
+        self._thread.join(timeout=timeout)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _upload(self, entry_id) -> bool | None:
+        """:return: 送信した（またはスプールから外した）場合 True, 失敗した場合 False, 停止中は None"""
+        if self._stop.is_set():
+            return None
+        try:
+            audio_path, meta = self.spool.load(entry_id)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"スプール: エントリ {entry_id} を読み込めないため削除します: {e}")
+            self.spool.remove(entry_id)
+            return True
+        try:
+            response = self.post_fn(audio_path, meta["bme280"], meta["tsl2572"])
+        except PermanentUploadError as e:
+            self.spool.dead_letter(entry_id, str(e))
+            self._count("dead_lettered")
+            return True
+        if response and "task_id" in response:
+            self.spool.remove(entry_id)
+            self._count("uploaded")
+            if self.on_uploaded:
+                self.on_uploaded(response["task_id"])
+            return True
+        return False
+
+    def _loop(self):
+        while not self._stop.is_set():
+            entries = self.spool.entries()
+            if not entries:
+                self.spool.added.wait()
+                self.spool.added.clear()
+                continue
+
+            batch = entries[:self.batch_size]
+            results = list(self._executor.map(self._upload, batch))
+            if self._stop.is_set():
+                break
+            uploaded = sum(results)
+            self._count("failed_attempts", len(results) - uploaded)
+
+            failed = [entry_id for entry_id, ok in zip(batch, results) if not ok]
+            for entry_id in failed:
+                # 他のエントリは送れた場合だけ、このエントリの失敗として数える
+                if uploaded and self.spool.record_attempt(entry_id) >= self.max_attempts:
+                    self.spool.dead_letter(entry_id, f"{self.max_attempts} 回送信に失敗しました")
+                    self._count("dead_lettered")
+                else:
+                    self.spool.defer(entry_id)
+            if uploaded:
+                self._backoff = 0.0
+                continue
+            # 失敗した場合は指数バックオフ（ジッター付き）で待つ
+            self._backoff = min(self.backoff_max, max(self.backoff_base, self._backoff * 2))
+            delay = self._backoff * random.uniform(0.5, 1.0)
+            logging.warning(f"スプール: {len(results) - uploaded} 件の送信に失敗しました。"
+                            f"{delay:.1f}秒後に再送します。(残り {len(self.spool)} 件)")
+            self._stop.wait(delay)
@@ -1,41 +1,212 @@
 from gpiozero import Button
 import logging
 import signal
+import threading
 import time
+from dataclasses import dataclass
+from log_config import setup_logging
 
 # --- 設定項目 ---
 SWITCH_PIN = 10
+LONG_PRESS_SECONDS = 1.0      # これ以上押し続けると長押し
+DOUBLE_PRESS_SECONDS = 0.35   # 離してからこの時間内にもう一度押すとダブルクリック
 
-def setup_switch(callback_function):
+GESTURE_SHORT = "short"
+GESTURE_LONG = "long"
+GESTURE_DOUBLE = "double"
+
+def setup_switch(callback_function, release_function=None):
     """
     スイッチの割り込みを設定する関数。
 
     Args:
         callback_function: スイッチが押されたときに呼び出す関数。
+        release_function: スイッチが離されたときに呼び出す関数（省略可）。
     """
     try:
         logging.info(f"GPIO {SWITCH_PIN} でスイッチの割り込みを設定します。")
         # スイッチはプルダウンされているため、立ち上がりエッジ(pressed)を検出
         switch = Button(SWITCH_PIN, bounce_time=0.1) # 0.1秒のバウンス時間を追加
         switch.when_pressed = callback_function
+        if release_function:
+            switch.when_released = release_function
         logging.info("スイッチの準備が完了しました。")
         return switch # switchオブジェクトを返すように変更
     except Exception as e:
         logging.critical(f"スイッチの初期化中にエラーが発生しました: {e}", exc_info=True)
         return None
 
+@dataclass
+class SwitchGesture:
+    kind: str           # GESTURE_SHORT / GESTURE_LONG / GESTURE_DOUBLE
+    pressed_at: float   # 最初に押した時刻（SwitchDispatcher.clock の値）
+    presses: int = 1    # まとめた操作の数
+
+class SwitchDispatcher:
+    """
+    スイッチのエッジ（押した・離した）に時刻を付け、短押し・長押し・ダブルクリックを判定する。
+
+    判定したジェスチャーはメインループが take() で取り出し、処理が終わったら done() を呼ぶ。
+    処理中（take() から done() まで）に判定したジェスチャーは、interrupts に関数があれば
+    すぐに呼んで捨て（再生の停止など）、無ければ最後の1つだけを残して次の take() で返す。
+    連打しても、タスクの確認やデコードが処理の終わった後に積み重ならない。
+    """
+    def __init__(self, interrupts=None, on_gesture=None, long_press=LONG_PRESS_SECONDS,
+                 double_press=DOUBLE_PRESS_SECONDS, clock=time.monotonic):
+        self.interrupts = interrupts or {}
+        self.on_gesture = on_gesture    # 判定したジェスチャーをすべて受け取る（記録用）
+        self.long_press = long_press
+        self.double_press = double_press
+        self.clock = clock
+        self.metrics = {"edges": 0, "gestures": 0, "coalesced": 0, "interrupts": 0}
+        self._cond = threading.Condition()
+        self._pressed_at = None     # 押している間はその時刻
+        self._first_at = None       # 判定中のジェスチャーで最初に押した時刻
+        self._released_at = None    # 短押しの候補（ダブルクリックの2回目を待っている）
+        self._held = False          # 長押しと判定済み（離すまで何もしない）
+        self._second = False        # ダブルクリックの2回目を押している
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        """長押しとダブルクリックの待ち時間を判定するスレッドを起動する"""
+        self._thread = threading.Thread(target=self._loop, name="switch-dispatch", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def on_press(self):
+        """【gpiozero のスレッド】押した時刻を記録する"""
+        now = self.clock()
+        gesture = None
+        with self._cond:
+            self.metrics["edges"] += 1
+            if self._released_at is not None and now - self._released_at <= self.double_press:
+                self._second = True
+                gesture = SwitchGesture(GESTURE_DOUBLE, self._first_at)
+            else:
+                if self._released_at is not None:
+                    # 判定スレッドより先に次の押下が来た場合は、前の短押しを確定させる
+                    gesture = SwitchGesture(GESTURE_SHORT, self._first_at)
+                self._first_at = now
+            self._released_at = None
+            self._pressed_at = now
+            self._cond.notify()
+        if gesture:
+            self._route(gesture)
+
+    def on_release(self):
+        """【gpiozero のスレッド】離した時刻を記録する"""
+        now = self.clock()
+        with self._cond:
+            self.metrics["edges"] += 1
+            if self._pressed_at is None:
+                return
+            if not self._held and not self._second:
+                self._released_at = now
+            self._pressed_at = None
+            self._held = False
+            self._second = False
+            self._cond.notify()
+
+    def _loop(self):
+        with self._cond:
+            while not self._closed:
+                now = self.clock()
+                deadline = None
+                gesture = None
+                if self._pressed_at is not None and not self._held and not self._second:
+                    if now - self._pressed_at >= self.long_press:
+                        self._held = True
+                        gesture = SwitchGesture(GESTURE_LONG, self._first_at)
+                    else:
+                        deadline = self._pressed_at + self.long_press
+                elif self._released_at is not None and self._pressed_at is None:
+                    if now - self._released_at > self.double_press:
+                        self._released_at = None
+                        gesture = SwitchGesture(GESTURE_SHORT, self._first_at)
+                    else:
+                        deadline = self._released_at + self.double_press
+                if gesture:
+                    self._cond.release()
+                    try:
+                        self._route(gesture)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                self._cond.wait(None if deadline is None else max(deadline - now, 0.001))
+
+    def inject(self, kind, pressed_at=None):
+        """判定済みのジェスチャーを渡す（トレースの再生など、エッジを経由しない場合）"""
+        self._route(SwitchGesture(kind, self.clock() if pressed_at is None else pressed_at))
+
+    def _route(self, gesture):
+        if self.on_gesture:
+            self.on_gesture(gesture)
+        interrupt = None
+        with self._cond:
+            self.metrics["gestures"] += 1
+            if self._busy and gesture.kind in self.interrupts:
+                interrupt = self.interrupts[gesture.kind]
+                self.metrics["interrupts"] += 1
+            else:
+                if self._pending is not None:
+                    gesture.pressed_at = self._pending.pressed_at
+                    gesture.presses += self._pending.presses
+                    self.metrics["coalesced"] += 1
+                self._pending = gesture
+        if interrupt:
+            logging.info(f"スイッチ: 処理中の {gesture.kind} を割り込みとして処理します。")
+            try:
+                interrupt()
+            except Exception as e:
+                logging.error(f"スイッチの割り込み処理に失敗しました: {e}")
+
+    def pending(self) -> bool:
+        with self._cond:
+            return self._pending is not None
+
+    def take(self):
+        """次に処理するジェスチャーを取り出す（無ければ None）。取り出したら done() まで処理中とする"""
+        with self._cond:
+            gesture, self._pending = self._pending, None
+            if gesture is not None:
+                self._busy = True
+            return gesture
+
+    def done(self):
+        with self._cond:
+            self._busy = False
+
 # --- デバッグ用のコード ---
 def _handle_test_press():
     "テスト用にスイッチが押されたことを出力する関数"
     print("スイッチが押されました！")
 
+def _print_gesture(gesture):
+    print(f"ジェスチャー: {gesture.kind}")
+
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
+    setup_logging()
     print("スイッチのデバッグモードです。")
     print(f"GPIO {SWITCH_PIN} に接続されたスイッチを押してください。")
     print("終了するには Ctrl+C を押してください。")
 
-    switch_device = setup_switch(_handle_test_press)
+    dispatcher = SwitchDispatcher(on_gesture=_print_gesture).start()
+
+    def _on_press():
+        _handle_test_press()
+        dispatcher.on_press()
+
+    switch_device = setup_switch(_on_press, dispatcher.on_release)
     if switch_device:
         try:
             while True:
@@ -44,6 +215,7 @@ if __name__ == '__main__':
             print("\nプログラムを終了します。")
         finally:
             switch_device.close()
+            dispatcher.close()
             print("GPIOリソースをクリーンアップしました。")
     else:
         print("スイッチのセットアップに失敗しました。")
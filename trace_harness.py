@@ -0,0 +1,363 @@
+"""
+実機の動作を記録し、仮想時計で高速に再生するためのハーネス。
+
+記録: main.py を --trace_record で起動すると、スイッチ操作、センサー値、API の応答と所要時間、
+録音ウィンドウの処理時間、再生時間をタイムスタンプ付きの JSON Lines で保存する。
+
+再生: 記録したイベントを main.py のハンドラ（スイッチのディスパッチャーと handle_gesture,
+on_uploaded, on_task_completed）に同じ時刻で渡す。API・再生は記録した応答と所要時間で置き換え、
+time.sleep / perf_counter は仮想時計に差し替えるため、1日分の記録でも数秒で再生できる。
+結果はスイッチを押してから再生が始まるまでの遅延などの分布として保存し、版ごとに比較できる。
+
+    python main.py --trace_record traces/field.jsonl
+    python trace_harness.py replay traces/field.jsonl --out base.json
+    python trace_harness.py compare base.json new.json
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import numpy as np
+from log_config import setup_logging
+from poll_scheduler import PollScheduler
+
+TRACE_VERSION = 1
+PERCENTILES = (50, 90, 99)
+
+# --- 記録 ---
+class TraceRecorder:
+    """イベントを {"t": 記録開始からの秒数, "kind": 種類, ...} の JSON Lines で追記する（スレッドセーフ）"""
+    def __init__(self, path, **header):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self._start = time.monotonic()
+        self.record("header", version=TRACE_VERSION, started_at=time.time(), **header)
+
+    def record(self, kind, **fields):
+        line = json.dumps({"t": time.monotonic() - self._start, "kind": kind, **fields}, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def wrap_api(self, name, fn, key=None):
+        """API 関数を包み、応答と所要時間を記録する。key(args) は再生時に応答を引くためのキー"""
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            response = fn(*args, **kwargs)
+            self.record("api", name=name, key=key(args) if key else None,
+                        latency=time.monotonic() - started, response=response)
+            return response
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def load_trace(path) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if not events or events[0].get("kind") != "header":
+        raise ValueError(f"{path} はトレースファイルではありません。")
+    if events[0].get("version") != TRACE_VERSION:
+        raise ValueError(f"未対応のトレースのバージョンです: {events[0].get('version')}")
+    return events
+
+# --- 仮想時計 ---
+class _TimeModuleProxy:
+    """time モジュールの代わりに差し込むオブジェクト。時刻と sleep だけを仮想時計に向ける"""
+    def __init__(self, clock):
+        self._clock = clock
+        self.time = clock.time
+        self.sleep = clock.sleep
+        self.perf_counter = clock.perf_counter
+        self.monotonic = clock.monotonic
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class VirtualClock:
+    """
+    sleep で進むだけの時計。再生は1スレッドで行うため、sleep は待たずに時刻を進める。
+    detached() の中の sleep は時刻を進めない（本来は別スレッドで並行に行われる処理に使う）。
+    """
+    def __init__(self, epoch=0.0):
+        self.epoch = epoch
+        self._now = 0.0
+        self._detached = 0
+
+    def perf_counter(self) -> float:
+        return self._now
+
+    monotonic = perf_counter
+
+    def time(self) -> float:
+        return self.epoch + self._now
+
+    def sleep(self, seconds):
+        if not self._detached:
+            self._now += max(0.0, seconds)
+
+    def advance_to(self, t):
+        self._now = max(self._now, t)
+
+    @contextmanager
+    def detached(self):
+        self._detached += 1
+        try:
+            yield
+        finally:
+            self._detached -= 1
+
+    @contextmanager
+    def patch(self, *modules):
+        """モジュールの time / sleep / perf_counter / monotonic を仮想時計に差し替える"""
+        proxy = _TimeModuleProxy(self)
+        saved = []
+        for module in modules:
+            for name, value in (("time", proxy), ("sleep", self.sleep),
+                                ("perf_counter", self.perf_counter), ("monotonic", self.monotonic)):
+                current = getattr(module, name, None)
+                if current is not None and current is (time if name == "time" else getattr(time, name)):
+                    saved.append((module, name, current))
+                    setattr(module, name, value)
+        try:
+            yield self
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+
+class _InlineExecutor:
+    """先読み用のスレッドプールの代わり。並行処理として扱い、仮想時計を進めずにその場で実行する"""
+    def __init__(self, clock):
+        self._clock = clock
+
+    def submit(self, fn, *args, **kwargs):
+        with self._clock.detached():
+            fn(*args, **kwargs)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+# --- 再生 ---
+class TraceReplayer:
+    """
+    記録したイベントを main.py のハンドラに仮想時刻で渡し、遅延を計測する。
+
+    - スイッチ: 押された時刻から、再生が始まる（または再生できるものが無いと分かる）までの遅延
+    - ウィンドウ: 録音完了からエンコード完了までの遅延。記録したエンコード時間を使い、
+      ワーカー数 workers のキューとして再計算する
+    """
+    def __init__(self, events: list[dict], workers=None):
+        self.header = events[0]
+        self.events = events[1:]
+        self.workers = workers or self.header.get("capture_workers", 1)
+        self.clock = VirtualClock(epoch=self.header.get("started_at", 0.0))
+        self.api_calls = Counter()
+
+        # API の応答は (名前, キー) ごとに時刻順で引けるようにする
+        self._api = {}
+        for event in self.events:
+            if event["kind"] == "api":
+                times, records = self._api.setdefault((event["name"], event.get("key")), ([], []))
+                times.append(event["t"])
+                records.append(event)
+        self._playback = {e["task_id"]: e["seconds"] for e in self.events if e["kind"] == "playback"}
+        self._default_playback = float(np.median(list(self._playback.values()))) if self._playback else 0.0
+
+        self._playback_started = None
+        self.presses = []
+        self.window_latency = []
+
+    def _api_response(self, name, key):
+        """現在の仮想時刻以前で最も新しい記録（無ければ最初の記録）を返し、その所要時間だけ時計を進める"""
+        self.api_calls[name] += 1
+        times, records = self._api.get((name, key), ([], []))
+        if not records:
+            return None
+        index = max(bisect.bisect_right(times, self.clock.perf_counter()) - 1, 0)
+        record = records[index]
+        self.clock.sleep(record["latency"])
+        return record["response"]
+
+    def _download(self, task_id, dest_path, deadline=None):
+        ok = self._api_response("download_task_result", task_id)
+        if ok:
+            # fetch_task_result がキャッシュ済みと判断できるように空のファイルを置く
+            open(dest_path, "wb").close()
+        return ok
+
+    def _play(self, led_engine, task_id, response, *args, **kwargs):
+        self._playback_started = self.clock.perf_counter()
+        self.clock.sleep(self._playback.get(task_id, self._default_playback))
+
+    @contextmanager
+    def _bind(self, app, cache_dir):
+        """main モジュールの外部とのやり取りを記録で置き換える"""
+        dispatcher = app.create_switch_dispatcher()
+        dispatcher.clock = self.clock.perf_counter
+        replacements = {
+            "switch_dispatcher": dispatcher, "now_playing": None, "last_played": None,
+            "trace": None, "is_mock": False, "capture": None, "rotate": None, "led_engine": None,
+            "task_ids": [], "completed_task_ids": set(),
+            "prefetcher": _InlineExecutor(self.clock),
+            "RESULT_CACHE_DIR": cache_dir,
+            "get_task_status": lambda task_id, timeout=None: self._api_response("get_task_status", task_id),
+            "poll_scheduler": PollScheduler(clock=self.clock.perf_counter),
+            "download_task_result": self._download,
+            "play_completed_task": self._play,
+        }
+        saved = {name: getattr(app, name, None) for name in replacements}
+        for name, value in replacements.items():
+            setattr(app, name, value)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                setattr(app, name, value)
+
+    def _deliver(self, app, event):
+        kind = event["kind"]
+        if kind == "switch":
+            # ジェスチャーの無い古い記録は短押しとして扱う
+            app.switch_dispatcher.inject(event.get("gesture", app.GESTURE_SHORT), event["t"])
+        elif kind == "uploaded":
+            app.on_uploaded(event["task_id"])
+        elif kind == "completed":
+            app.on_task_completed(event["task_id"])
+        elif kind == "window":
+            ready = event["t"] - event["encode_seconds"] - event.get("queued_seconds", 0.0)
+            self._windows.append((ready, event["encode_seconds"]))
+
+    def _replay_windows(self):
+        """録音が完了した時刻とエンコード時間から、workers 個のワーカーで処理した場合の遅延を求める"""
+        free_at = [0.0] * self.workers
+        for ready, encode in sorted(self._windows):
+            worker = int(np.argmin(free_at))
+            start = max(ready, free_at[worker])
+            free_at[worker] = start + encode
+            self.window_latency.append(free_at[worker] - ready)
+
+    def run(self, app=None) -> dict:
+        """
+        再生して結果を返す。app は main モジュール（テスト用に差し替え可能）
+        """
+        if app is None:
+            import main as app
+        import jellyfish
+        import deadline
+        wall_started = time.perf_counter()
+        self._windows = []
+        interval = getattr(app, "MAIN_LOOP_INTERVAL", 0.2)
+        events = deque(sorted(self.events, key=lambda e: e["t"]))
+        with tempfile.TemporaryDirectory() as cache_dir, self._bind(app, cache_dir), \
+                self.clock.patch(app, jellyfish, deadline):
+            dispatcher = app.switch_dispatcher
+            while events or dispatcher.pending():
+                while events and events[0]["t"] <= self.clock.perf_counter():
+                    self._deliver(app, events.popleft())
+                gesture = dispatcher.take()
+                if gesture:
+                    self._playback_started = None
+                    try:
+                        app.handle_gesture(gesture)
+                    finally:
+                        # 処理中に押された分は、処理中の操作としてディスパッチャーに渡す
+                        done = self._playback_started if self._playback_started is not None else self.clock.perf_counter()
+                        while events and events[0]["t"] <= self.clock.perf_counter():
+                            self._deliver(app, events.popleft())
+                        dispatcher.done()
+                    self.presses.append({"t": gesture.pressed_at, "gesture": gesture.kind, "presses": gesture.presses,
+                                         "latency": done - gesture.pressed_at,
+                                         "played": self._playback_started is not None})
+                    self.clock.sleep(interval)
+                elif events:
+                    # 何も起きない間はメインループの周期に合わせて次のイベントまで進める
+                    now = self.clock.perf_counter()
+                    ticks = max(1, int(np.ceil((events[0]["t"] - now) / interval)))
+                    self.clock.advance_to(now + ticks * interval)
+        self._replay_windows()
+
+        result = {
+            "trace_started_at": self.header.get("started_at"),
+            "virtual_seconds": self.clock.perf_counter(),
+            "wall_seconds": time.perf_counter() - wall_started,
+            "workers": self.workers,
+            "api_calls": dict(self.api_calls),
+            "presses": self.presses,
+            "switch": dict(dispatcher.metrics),
+            "metrics": {
+                "switch_latency": [p["latency"] for p in self.presses],
+                "window_latency": self.window_latency,
+            },
+        }
+        logging.info(f"再生完了: 仮想時間 {result['virtual_seconds']:.0f}秒 を {result['wall_seconds']:.2f}秒 で再生しました。"
+                     f"(スイッチ {len(self.presses)} 回, ウィンドウ {len(self.window_latency)} 件)")
+        return result
+
+# --- 比較 ---
+def summarize(values) -> dict:
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {"count": 0}
+    summary = {"count": int(len(values)), "mean": float(values.mean()), "max": float(values.max())}
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f"p{p}"] = float(v)
+    return summary
+
+def compare(base: dict, new: dict) -> dict:
+    """2つの再生結果の遅延の分布を比較する。:return: 指標 -> {"base", "new"} の要約"""
+    names = sorted(set(base["metrics"]) | set(new["metrics"]))
+    return {name: {"base": summarize(base["metrics"].get(name, [])),
+                   "new": summarize(new["metrics"].get(name, []))} for name in names}
+
+def format_table(rows) -> str:
+    """rows: (指標名, ラベル, summarize() の結果) の並び"""
+    columns = ["count", "mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+    lines = [f"{'metric':<16}{'':>6}" + "".join(f"{c:>10}" for c in columns)]
+    for name, label, row in rows:
+        lines.append(f"{name:<16}{label:>6}" + "".join(
+            f"{row[c]:>10.3f}" if isinstance(row.get(c), float) else f"{row.get(c, '-'):>10}" for c in columns))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay = sub.add_parser("replay", help="トレースを仮想時計で再生し、遅延を計測する")
+    replay.add_argument("trace")
+    replay.add_argument("--out", default=None, help="結果を保存する JSON ファイル")
+    replay.add_argument("--workers", type=int, default=None, help="ウィンドウ処理のワーカー数（省略時は記録時の値）")
+    diff = sub.add_parser("compare", help="2つの再生結果の遅延の分布を比較する")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        result = TraceReplayer(load_trace(args.trace), workers=args.workers).run()
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+        print(format_table((name, "", summarize(values)) for name, values in result["metrics"].items()))
+    else:
+        with open(args.base, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, "r", encoding="utf-8") as f:
+            new = json.load(f)
+        print(format_table((name, label, pair[label]) for name, pair in compare(base, new).items()
+                           for label in ("base", "new")))
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
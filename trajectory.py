@@ -0,0 +1,97 @@
+"""
+サーボの軌道計画。
+
+ウェイポイント間を台形速度または最小ジャークの軌道で結び、update_dt ごとの角度列を
+numpy でまとめて生成する。速度・加速度の上限を超える区間は所要時間を延ばし、
+角度は [min_degree, max_degree] に収める。生成した配列はサーボのループが順に出力するだけでよい。
+"""
+from dataclasses import dataclass
+import numpy as np
+
+SHAPE_TRAPEZOID = "trapezoid"
+SHAPE_MIN_JERK = "min_jerk"
+
+MAX_VELOCITY = 600.0        # deg/s（SG90 程度: 60度/0.1秒）
+MAX_ACCELERATION = 6000.0   # deg/s^2
+
+# 最小ジャーク軌道 s(τ) = 10τ^3 - 15τ^4 + 6τ^5 の速度・加速度のピーク係数
+_MIN_JERK_PEAK_VELOCITY = 1.875
+_MIN_JERK_PEAK_ACCELERATION = 10.0 / np.sqrt(3.0)
+
+@dataclass(frozen=True)
+class AxisLimits:
+    """1軸ぶんの可動範囲と速度・加速度の上限"""
+    min_degree: float = -90.0
+    max_degree: float = 90.0
+    max_velocity: float = MAX_VELOCITY
+    max_acceleration: float = MAX_ACCELERATION
+
+def min_durations(distances: np.ndarray, limits: AxisLimits, shape: str = SHAPE_TRAPEZOID) -> np.ndarray:
+    """各区間の移動量 |Δθ| を、速度・加速度の上限内で移動するのに必要な最短時間を返す"""
+    d = np.abs(np.asarray(distances, dtype=np.float64))
+    v, a = limits.max_velocity, limits.max_acceleration
+    if shape == SHAPE_TRAPEZOID:
+        # 最高速度に達するなら台形、達しないなら三角形の速度プロファイル
+        return np.where(d >= v * v / a, d / v + v / a, 2.0 * np.sqrt(d / a))
+    if shape == SHAPE_MIN_JERK:
+        return np.maximum(_MIN_JERK_PEAK_VELOCITY * d / v, np.sqrt(_MIN_JERK_PEAK_ACCELERATION * d / a))
+    raise ValueError(f"unknown shape: {shape}")
+
+def _trapezoid_position(t, T, d, a):
+    """
+    所要時間 T で距離 d (>=0) を加速度 a の台形速度で移動するときの、時刻 t での移動量。
+    巡航速度は d = vc * (T - vc / a) を満たす小さい方の解。
+    """
+    disc = np.maximum(a * a * T * T - 4.0 * a * d, 0.0)
+    vc = (a * T - np.sqrt(disc)) / 2.0
+    ta = np.divide(vc, a, out=np.zeros_like(vc), where=a > 0)
+    accel = 0.5 * a * t * t
+    cruise = 0.5 * a * ta * ta + vc * (t - ta)
+    decel = d - 0.5 * a * (T - t) ** 2
+    return np.where(t < ta, accel, np.where(t < T - ta, cruise, decel))
+
+def plan(times, angles, dt: float, limits: AxisLimits = AxisLimits(),
+         shape: str = SHAPE_MIN_JERK) -> np.ndarray:
+    """
+    ウェイポイント (times[s], angles[deg]) を順に通る角度列を dt ごとに生成する。
+
+    各ウェイポイントでは一旦停止する（区間ごとに速度 0 から始まり 0 で終わる）。
+    上限を超える区間は所要時間を延ばすため、以降のウェイポイントは後ろにずれる。
+    先頭のウェイポイントの時刻は 0 からの待ち時間として扱い、その間は先頭の角度を保持する。
+    """
+    times = np.asarray(times, dtype=np.float64)
+    angles = np.clip(np.asarray(angles, dtype=np.float64), limits.min_degree, limits.max_degree)
+    if dt <= 0:
+        raise ValueError("dt must be > 0")
+    if times.ndim != 1 or times.shape != angles.shape or len(times) < 1:
+        raise ValueError("times/angles must be 1-D with the same length >= 1")
+    if np.any(np.diff(times) <= 0):
+        raise ValueError("times must be strictly increasing (no duplicates).")
+
+    delta = np.diff(angles)
+    durations = np.maximum(np.diff(times), min_durations(delta, limits, shape))
+    starts = max(times[0], 0.0) + np.concatenate([[0.0], np.cumsum(durations)])
+
+    t = np.arange(0.0, starts[-1] + dt * 0.5, dt)
+    if len(durations) == 0:
+        return np.full(max(len(t), 1), angles[0])
+
+    # 各サンプルが属する区間と、区間内の経過時間を一括で求める
+    seg = np.clip(np.searchsorted(starts, t, side="right") - 1, 0, len(durations) - 1)
+    local = np.clip(t - starts[seg], 0.0, durations[seg])
+    T = durations[seg]
+    d = delta[seg]
+    if shape == SHAPE_TRAPEZOID:
+        a = np.full_like(T, limits.max_acceleration)
+        moved = _trapezoid_position(local, T, np.abs(d), a) * np.sign(d)
+    else:
+        tau = np.divide(local, T, out=np.ones_like(local), where=T > 0)
+        moved = d * (tau ** 3 * (10.0 - 15.0 * tau + 6.0 * tau * tau))
+    out = angles[seg] + moved
+    out[-1] = angles[-1]
+    return np.clip(out, limits.min_degree, limits.max_degree)
+
+def plan_move(start: float, target: float, dt: float, limits: AxisLimits = AxisLimits(),
+              shape: str = SHAPE_TRAPEZOID) -> np.ndarray:
+    """現在角度 start から target までを最短時間で移動する角度列（先頭の start は含まない）"""
+    return plan([0.0, dt], [start, target], dt, limits, shape)[1:]
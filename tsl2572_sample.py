@@ -1,8 +1,6 @@
 import smbus
 import logging
-
-# loggingの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from log_config import setup_logging
 
 try:
     i2c = smbus.SMBus(1)
@@ -86,9 +84,10 @@ def getTSL2572reg(reg) :
 
 
 def getTSL2572adc() :
+    """[adc0, adc1]。読み取れない場合は None"""
     if i2c is None:
         logging.error("I2Cバスが利用できません。")
-        return [0, 0]
+        return None
     try:
         dat = i2c.read_i2c_block_data(TSL2572_ADR,TSL2572_COMMAND | TSL2572_TYPE_INC | TSL2572_C0DATA,4)
         adc0 = (dat[1] << 8) | dat[0]
@@ -96,23 +95,29 @@ def getTSL2572adc() :
         return[adc0,adc1]
     except IOError as e:
         logging.error(f"ADCデータの読み取りに失敗しました: {e}")
-        return [0, 0]
+        return None
 
 
 def readData() -> dict[str, float]:
+    """
+    照度を読み取る。失敗した場合も送信データの形を保つため lux は 0 を返し、valid を False にする
+    （0 lux は暗い場所では実際にあり得るため、値だけでは失敗と区別できない）
+    """
     if (initTSL2572()!=0) :
-        print("Failed. Check connection!!")
-        return {"adc0": 0, "adc1": 0, "lux": 0}
+        logging.error("TSL2572の初期化に失敗しました。接続を確認してください。")
+        return {"adc0": 0, "adc1": 0, "lux": 0, "valid": False}
 
     adc = getTSL2572adc()
+    if adc is None:
+        return {"adc0": 0, "adc1": 0, "lux": 0, "valid": False}
     cpl = (2.73 * (256 - ATIME) * GAIN)/(60.0)
     if cpl == 0:
         logging.error("CPLが0になりました。ATIMEとGAINの設定を確認してください。")
-        return {"adc0": adc[0], "adc1": adc[1], "lux": 0}
+        return {"adc0": adc[0], "adc1": adc[1], "lux": 0, "valid": False}
     lux1 = ((adc[0] * 1.00) - (adc[1] * 1.87)) / cpl
     lux2 = ((adc[0] * 0.63) - (adc[1] * 1.00)) / cpl
     lux = max(lux1, lux2, 0)
-    return {"adc0": adc[0], "adc1": adc[1], "lux": lux}
+    return {"adc0": adc[0], "adc1": adc[1], "lux": lux, "valid": True}
 
 def init():
     initTSL2572()
@@ -123,4 +128,5 @@ def main():
         print(f"lux: {data['lux']}")
 
 if __name__ == '__main__':
+    setup_logging()
     main()
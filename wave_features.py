@@ -0,0 +1,335 @@
+"""
+録音した WAV ファイルの特徴量をまとめて計算する。
+
+有音判定のしきい値（activity.py）や LED の色の対応を設置場所ごとに調整するために、
+何千もの録音（output.wav と同じ形式）から音量・帯域ごとのエネルギー・オンセットの頻度・無音の割合を求め、
+1つの列指向のファイル（.npz, 列ごとの配列）に書き出す。
+
+- WAV は pydub でデコードせず、データの部分を np.memmap で直接読む
+- 1ファイルは BLOCK_SECONDS ごとに読み、ブロックごとの集計だけを残す（長い録音でもメモリは増えない）
+- ファイルはワーカープロセスに分けて並列に処理する
+- 前回の出力があれば、パス・大きさ・更新時刻が同じファイルの結果はそのまま使う
+
+    python wave_features.py recordings/ --out features.npz --workers 4
+
+読み込み:
+    features = np.load("features.npz")
+    features["path"], features["rms_db"], features["band_150_400"], ...
+"""
+import argparse
+import logging
+import os
+import struct
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from activity import MARGIN_DB, MIN_LEVEL_DB, NOISE_PERCENTILE
+from log_config import setup_logging
+
+OUTPUT_PATH = "features.npz"
+FRAME_SAMPLES = 1024        # 解析の1フレーム（録音のコールバックのブロック record_sample.CHUNK と同じ）
+BLOCK_SECONDS = 10.0        # 1回に読み込む長さ
+LEVEL_MIN_DB = -120.0       # フレームの音量のヒストグラムの範囲と刻み
+LEVEL_BIN_DB = 0.5
+BAND_EDGES_HZ = (0, 150, 400, 1000, 2500, 6000, None)   # 帯域の境界（None はナイキスト周波数）
+ONSET_WINDOW_FRAMES = 43    # オンセットのしきい値を求める直前のフレーム数（約1秒, ブロックの境界をまたいで続ける）
+ONSET_K = 5.0               # スペクトルフラックスが 直前の中央値 + ONSET_K × 中央絶対偏差 を超えた山をオンセットとする
+ONSET_RATIO = 1.3           # ただし 直前の中央値 × ONSET_RATIO 以下の山は数えない（雑音の揺らぎ）
+ONSET_MIN_FLUX = 1.0        # 無音が続いて中央値が 0 になった場合のための、しきい値の下限（中央値からの差）
+ONSET_MIN_GAP_SECONDS = 0.05    # これより短い間隔で続くオンセットは1つとして数える
+CHUNKSIZE = 8               # ワーカーに1回で渡すファイル数
+FEATURES_VERSION = 2        # 計算方法を変えたら上げる（前回の出力を使わずに計算し直す）
+
+BANDS = [f"band_{lo}_{hi if hi is not None else 'nyq'}" for lo, hi in zip(BAND_EDGES_HZ[:-1], BAND_EDGES_HZ[1:])]
+COLUMNS = ["duration", "rate", "channels", "rms_db", "peak_db", "loudness_p10_db", "loudness_p50_db",
+           "loudness_p95_db", "noise_floor_db", "active_ratio", "silence_ratio", "onset_rate", "centroid_hz"] + BANDS
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_PCM_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+def open_wav(path) -> tuple[np.memmap, int]:
+    """
+    WAV ファイルのデータの部分を (フレーム数, チャンネル数) の memmap として開く。
+    対応する形式は 8/16/32bit の PCM と 32bit の浮動小数点。:return: (memmap, サンプリング周波数)
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(12)
+        if len(head) < 12 or head[:4] != b"RIFF" or head[8:] != b"WAVE":
+            raise ValueError("WAV ファイルではありません")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("data チャンクがありません")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                body = f.read(chunk_size)
+                fmt = struct.unpack("<HHIIHH", body[:16])
+                if fmt[0] == _WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    fmt = (struct.unpack("<H", body[24:26])[0],) + fmt[1:]
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    if fmt is None:
+        raise ValueError("fmt チャンクがありません")
+    format_tag, channels, rate, _, block_align, bits = fmt
+    if format_tag == _WAVE_FORMAT_FLOAT and bits == 32:
+        dtype = np.float32
+    elif format_tag == _WAVE_FORMAT_PCM and bits // 8 in _PCM_DTYPES:
+        dtype = _PCM_DTYPES[bits // 8]
+    else:
+        raise ValueError(f"対応していない形式です (format={format_tag}, bits={bits})")
+    # 録音の途中で止まったファイルは data チャンクの大きさが実際と合わないため、ファイルの大きさで切る
+    frames = min(chunk_size, size - offset) // block_align
+    if frames == 0:
+        return np.zeros((0, channels), dtype=dtype), rate
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(frames, channels)), rate
+
+def _to_float(samples) -> np.ndarray:
+    """(フレーム数, チャンネル数) のサンプルをモノラルの [-1, 1] の float32 にする"""
+    if samples.dtype == np.uint8:
+        mono = samples.mean(axis=1, dtype=np.float32) - 128.0
+        return mono / 128.0
+    mono = samples.mean(axis=1, dtype=np.float32)
+    if samples.dtype == np.float32:
+        return mono
+    return mono / float(-np.iinfo(samples.dtype).min)
+
+def _level_percentile(histogram, q) -> float:
+    """フレームの音量のヒストグラムから q パーセンタイル[dB]を求める"""
+    total = histogram.sum()
+    if total == 0:
+        return float("nan")
+    index = int(np.searchsorted(np.cumsum(histogram), total * q / 100.0))
+    return LEVEL_MIN_DB + (index + 0.5) * LEVEL_BIN_DB
+
+class OnsetCounter:
+    """
+    スペクトルフラックスのフレームごとの値を順に受け取り、オンセットを数える。
+
+    しきい値は直前の ONSET_WINDOW_FRAMES フレームの中央値と中央絶対偏差から求め、
+    その状態をブロックの境界をまたいで持ち越すため、結果は読み込むブロックの長さによらない。
+    音が止まる瞬間も（窓で切れた波形の広帯域の成分で）フラックスが増えるため、音量が下がるフレームは数えない。
+    """
+    def __init__(self, min_gap_frames, window=ONSET_WINDOW_FRAMES):
+        self.window = window
+        self.min_gap_frames = min_gap_frames
+        self.count = 0
+        self._flux = np.full(window + 1, np.nan)    # 直前の window フレームと、次のフレームを待っている最後のフレーム
+        self._levels = np.full(2, np.nan)           # 判定を待っているフレームとその前のフレームの音量[dB]
+        self._next = -window - 1                    # _flux[0] の通し番号
+        self._last_onset = None
+
+    def feed(self, flux, levels):
+        """flux: フレームごとのスペクトルフラックス, levels: 同じフレームの音量[dB]"""
+        if len(flux) == 0:
+            return
+        f = np.concatenate([self._flux, flux])
+        lv = np.concatenate([self._levels, levels])
+        # 判定するのは、次のフレームまで分かっているフレーム（f の window 番目から最後の1つ前まで）
+        history = np.lib.stride_tricks.sliding_window_view(f[:-2], self.window)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)     # ファイルの先頭では直前のフレームがまだ無い
+            median = np.nanmedian(history, axis=1)
+            deviation = np.nanmedian(np.abs(history - median[:, None]), axis=1)
+        median = np.nan_to_num(median)
+        deviation = np.nan_to_num(deviation)
+        middle = f[self.window:-1]
+        before = np.nan_to_num(f[self.window - 1:-2])
+        after = f[self.window + 1:]
+        rising = ~(lv[1:-1] < lv[:-2])      # 音量が下がっていない（前のフレームが無い場合も含む）
+        margin = np.maximum(np.maximum(ONSET_K * deviation, (ONSET_RATIO - 1.0) * median), ONSET_MIN_FLUX)
+        peaks = ((middle > median + margin)
+                 & (middle >= before) & (middle > after) & rising)
+        for index in np.flatnonzero(peaks) + self._next + self.window:
+            if self._last_onset is None or index - self._last_onset >= self.min_gap_frames:
+                self.count += 1
+                self._last_onset = index
+        self._next += len(flux)
+        self._flux = f[-(self.window + 1):]
+        self._levels = lv[-2:]
+
+def extract_features(path, block_seconds=BLOCK_SECONDS) -> np.ndarray:
+    """1ファイルの特徴量を COLUMNS の順に返す"""
+    data, rate = open_wav(path)
+    frames_per_block = max(int(block_seconds * rate) // FRAME_SAMPLES, 1) * FRAME_SAMPLES
+    window = np.hanning(FRAME_SAMPLES).astype(np.float32)
+    freqs = np.fft.rfftfreq(FRAME_SAMPLES, 1.0 / rate)
+    edges = [int(np.searchsorted(freqs, hz)) if hz is not None else len(freqs) for hz in BAND_EDGES_HZ]
+    histogram = np.zeros(int(-LEVEL_MIN_DB / LEVEL_BIN_DB), dtype=np.int64)
+    spectrum = np.zeros(len(freqs), dtype=np.float64)     # 周波数ビンごとのエネルギーの合計
+    sum_squares = 0.0
+    peak = 0.0
+    onsets = OnsetCounter(max(int(round(ONSET_MIN_GAP_SECONDS * rate / FRAME_SAMPLES)), 1))
+    previous = None     # 直前のブロックの最後のフレームの対数スペクトル（フラックスをブロックの境界で続ける）
+
+    for start in range(0, len(data), frames_per_block):
+        x = _to_float(data[start:start + frames_per_block])
+        sum_squares += float(np.dot(x, x))
+        peak = max(peak, float(np.max(np.abs(x))))
+        usable = len(x) - len(x) % FRAME_SAMPLES
+        if usable == 0:
+            continue
+        frames = x[:usable].reshape(-1, FRAME_SAMPLES)
+
+        # 音量（録音の有音判定と同じ、フレームごとの RMS[dBFS]）
+        levels = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+        bins = np.clip(((levels - LEVEL_MIN_DB) / LEVEL_BIN_DB).astype(np.int64), 0, len(histogram) - 1)
+        histogram += np.bincount(bins, minlength=len(histogram))
+
+        # 帯域ごとのエネルギーとスペクトル重心は、ビンごとの合計から最後に求める
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+        spectrum += power.sum(axis=0)
+
+        # オンセット（対数スペクトルの増加分の和が、直前のフレームに比べて目立って大きいフレーム）
+        log_spectrum = np.log1p(np.sqrt(power))
+        if previous is not None:
+            log_spectrum_prev = np.vstack([previous, log_spectrum[:-1]])
+        else:
+            log_spectrum_prev = np.vstack([log_spectrum[:1], log_spectrum[:-1]])
+        flux = np.maximum(log_spectrum - log_spectrum_prev, 0.0).sum(axis=1)
+        previous = log_spectrum[-1:]
+        onsets.feed(flux, levels)
+
+    duration = len(data) / rate
+    cumulative = np.concatenate([[0.0], np.cumsum(spectrum)])
+    band_energy = np.array([cumulative[hi] - cumulative[lo] for lo, hi in zip(edges[:-1], edges[1:])])
+    total_energy = cumulative[-1]
+    noise_floor = _level_percentile(histogram, NOISE_PERCENTILE)
+    threshold_db = max(noise_floor + MARGIN_DB, MIN_LEVEL_DB)
+    bin_floor = LEVEL_MIN_DB + np.arange(len(histogram)) * LEVEL_BIN_DB
+    n_frames = histogram.sum()
+    row = [duration, rate, data.shape[1],
+           10.0 * np.log10(sum_squares / max(len(data), 1) + 1e-12),
+           20.0 * np.log10(peak + 1e-12),
+           _level_percentile(histogram, 10), _level_percentile(histogram, 50), _level_percentile(histogram, 95),
+           noise_floor,
+           histogram[bin_floor >= threshold_db].sum() / n_frames if n_frames else 0.0,
+           histogram[bin_floor < MIN_LEVEL_DB].sum() / n_frames if n_frames else 1.0,
+           onsets.count / duration if duration else 0.0,
+           float(spectrum @ freqs) / total_energy if total_energy else 0.0]
+    row += list(band_energy / total_energy if total_energy else band_energy)
+    return np.asarray(row, dtype=np.float32)
+
+def _extract_one(args):
+    """【ワーカープロセスで実行】1ファイルの特徴量。:return: (パス, 特徴量 または None, エラーの文字列 または None)"""
+    path, block_seconds = args
+    try:
+        return path, extract_features(path, block_seconds), None
+    except Exception as e:
+        return path, None, str(e)
+
+def find_wav_files(directory) -> list[str]:
+    """directory 以下の WAV ファイル（サブディレクトリを含む）"""
+    files = []
+    for root, _, names in os.walk(directory):
+        files.extend(os.path.join(root, name) for name in names if name.lower().endswith(".wav"))
+    return sorted(files)
+
+def _file_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def _load_previous(out_path) -> dict:
+    """前回の出力から {パス: (大きさ, 更新時刻, 特徴量)} を作る。列か計算方法が変わっていれば使わない"""
+    if not out_path or not os.path.exists(out_path):
+        return {}
+    try:
+        with np.load(out_path) as previous:
+            version = int(previous["version"]) if "version" in previous else 1
+            if list(previous["columns"]) != COLUMNS or version != FEATURES_VERSION:
+                return {}
+            table = np.stack([previous[name] for name in COLUMNS], axis=1)
+            return {path: (int(size), int(mtime), row) for path, size, mtime, row
+                    in zip(previous["path"], previous["size"], previous["mtime_ns"], table)}
+    except Exception as e:
+        logging.warning(f"前回の出力 {out_path} を読み込めないため、すべて計算し直します: {e}")
+        return {}
+
+def extract_directory(directory, out_path=OUTPUT_PATH, workers=None, block_seconds=BLOCK_SECONDS, reuse=True) -> int:
+    """
+    directory 以下の WAV ファイルの特徴量を並列に計算し、out_path に列ごとの配列として保存する。
+    :return: 保存したファイル数
+    """
+    files = find_wav_files(directory)
+    previous = _load_previous(out_path) if reuse else {}
+    table = np.full((len(files), len(COLUMNS)), np.nan, dtype=np.float32)
+    keys = np.zeros((len(files), 2), dtype=np.int64)
+    ok = np.zeros(len(files), dtype=bool)
+    index = {path: i for i, path in enumerate(files)}
+    jobs = []
+    for i, path in enumerate(files):
+        keys[i] = _file_key(path)
+        relative = os.path.relpath(path, directory)
+        cached = previous.get(relative)
+        if cached is not None and cached[:2] == tuple(keys[i]):
+            table[i] = cached[2]
+            ok[i] = True
+        else:
+            jobs.append((path, block_seconds))
+    logging.info(f"{len(files)} 件の WAV ファイルのうち {len(jobs)} 件の特徴量を計算します。")
+
+    started = time.perf_counter()
+    audio_seconds = 0.0
+    failed = 0
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, row, error in executor.map(_extract_one, jobs, chunksize=CHUNKSIZE):
+                if error:
+                    failed += 1
+                    logging.error(f"特徴量の計算に失敗しました: {path}, Error: {error}")
+                    continue
+                table[index[path]] = row
+                ok[index[path]] = True
+                audio_seconds += float(row[0])
+    elapsed = time.perf_counter() - started
+    if jobs:
+        logging.info(f"{len(jobs) - failed} 件（音声 {audio_seconds / 3600:.2f} 時間）を {elapsed:.1f}秒 で処理しました "
+                     f"({(len(jobs) - failed) / max(elapsed, 1e-9):.1f} 件/秒, 実時間の {audio_seconds / max(elapsed, 1e-9):.0f} 倍)。")
+
+    paths = np.array([os.path.relpath(path, directory) for path in files], dtype=str)[ok]
+    tmp_path = out_path + ".tmp.npz"
+    np.savez(tmp_path, path=paths, size=keys[ok, 0], mtime_ns=keys[ok, 1], columns=np.array(COLUMNS),
+             version=FEATURES_VERSION,
+             **{name: table[ok, i] for i, name in enumerate(COLUMNS)})
+    os.replace(tmp_path, out_path)
+    logging.info(f"{len(paths)} 件の特徴量を {out_path} に保存しました。")
+    return len(paths)
+
+def summarize(out_path, columns=("rms_db", "noise_floor_db", "active_ratio", "silence_ratio", "onset_rate")):
+    """保存した特徴量の分布（パーセンタイル）を表示する。しきい値の調整の目安にする"""
+    with np.load(out_path) as features:
+        print(f"{'column':<18}{'p10':>10}{'p50':>10}{'p90':>10}")
+        for name in columns:
+            values = features[name][np.isfinite(features[name])]
+            if len(values) == 0:
+                continue
+            p10, p50, p90 = np.percentile(values, (10, 50, 90))
+            print(f"{name:<18}{p10:>10.3f}{p50:>10.3f}{p90:>10.3f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="WAV ファイルのあるディレクトリ（サブディレクトリも含める）")
+    parser.add_argument("--out", default=OUTPUT_PATH, help="特徴量の保存先（.npz）")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--block_seconds", type=float, default=BLOCK_SECONDS)
+    parser.add_argument("--rebuild", action="store_true", help="前回の出力を使わずにすべて計算し直す")
+    parser.add_argument("--summary", action="store_true", help="保存した特徴量の分布を表示する")
+    args = parser.parse_args()
+
+    extract_directory(args.directory, args.out, args.workers, args.block_seconds, reuse=not args.rebuild)
+    if args.summary:
+        summarize(args.out)
+
+if __name__ == "__main__":
+    setup_logging()
+    main()